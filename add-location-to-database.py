@@ -14,78 +14,150 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import argparse
+import geocoding
 import os
-import time
+import profiling
+import spatial
+import streets
 import switrs
 import sqlite3
-import sys
-
-from googlegeocoder import GoogleGeocoder
 
 class CollisionGoecoder():
-    def __init__(self, city_directory):
+    def __init__(self, city_directory, pipeline, retry_failures=False, location_cache_path=None):
         self.city_directory = city_directory
-        self.city_name = os.path.basename(city_directory)
-        self.geocoder = GoogleGeocoder()
-        self.read_location_database()
-
-    def location_database_path(self):
-        return os.path.join(self.city_directory, "locations.json")
-
-    def read_location_database(self):
-        with open(self.location_database_path(), 'r') as location_file:
-           self.location_database = json.loads(location_file.read())
-
-    def write_location_database(self):
-        with open(self.location_database_path(), 'w') as location_file:
-           return location_file.write(json.dumps(self.location_database, sort_keys=True))
-
-    def get_location_for_collision(self, collision):
-        location_key = collision.intersection_string()
-
-        # This is a bit of a hack!
-        # Google doesn't know how to properly decode the Bay Bridge metering
-        # lights, so we just emit the proper geolocation when we detect this
-        # location.
-        if "RT 80" in location_key and "METERING" in location_key:
-            return [37.82479, -122.31384]
-
-        if location_key in self.location_database:
-            return self.location_database[location_key]
-
-        try:
-            time.sleep(1) # Be kind.
-            search = self.geocoder.get('{0}, Oakland, CA'.format(location_key))
-            self.location_database[location_key] = [search[0].geometry.location.lat, search[0].geometry.location.lng]
-        except:
+        self.city_name = os.path.basename(os.path.normpath(city_directory))
+        self.pipeline = pipeline
+        self.retry_failures = retry_failures
+        self.open_location_database(location_cache_path or os.path.join(city_directory, "locations.db"))
+
+    def open_location_database(self, path):
+        self.location_database = geocoding.LocationCache(path, self.city_name)
+
+        # The first run for a city seeds the cache from its old locations.json.
+        json_path = os.path.join(self.city_directory, "locations.json")
+        if len(self.location_database) == 0 and os.path.exists(json_path):
+            count = self.location_database.import_json(json_path)
+            print('Imported {0} locations from {1}'.format(count, json_path))
+
+    def needs_geocoding(self, location_key):
+        if streets.special_location(location_key) is not None:
+            return False
+        (cached, location) = self.location_database.lookup(location_key)
+        if not cached:
+            return True
+
+        # Addresses that could not be geocoded are cached as None.
+        return self.retry_failures and location is None
+
+    def geocode_locations(self, location_keys):
+        location_keys = dict((geocoding.normalize_location_key(key), key)
+                             for key in set(location_keys) if self.needs_geocoding(key))
+        print('Geocoding {0} new locations'.format(len(location_keys)))
+
+        addresses = dict(('{0}, {1}, CA'.format(key, self.city_name), key) for key in location_keys.values())
+        for (address, location, error) in self.pipeline.geocode_all(addresses):
+            if error is None:
+                self.location_database.store(addresses[address], location)
+            elif isinstance(error, geocoding.NoResultError):
+                self.location_database.store(addresses[address], None)
+            else:
+                print('Could not geocode {0}: {1}'.format(address, error))
+
+    def get_location(self, location_key):
+        location = streets.special_location(location_key)
+        if location is None:
+            location = self.location_database.get(location_key)
+        if location is None:
             return [0, 0]
-        return self.location_database[location_key]
+        return location
 
     def update_collision_locations_in_database(self, connection, collisions):
-        for collision in collisions:
-            connection.execute('UPDATE collisions SET latitude=?,longitude=? WHERE id=?', (collision.latitude, collision.longitude, collision.id))
-        connection.commit()
+        with connection:
+            # Databases collected before the spatial index existed get it here.
+            # Its triggers index these locations as they are written, but only
+            # until the next collect that loads changed years, which drops the
+            # index and rebuilds it from the collisions table. It is keyed by
+            # collisions.rowid, which VACUUM can renumber, so a vacuumed database
+            # needs spatial.drop_spatial_index before it is geocoded again.
+            spatial.create_spatial_index(connection)
+            connection.executemany('UPDATE collisions SET latitude=?,longitude=? WHERE id=?',
+                                   [(collision.latitude, collision.longitude, collision.id) for collision in collisions])
 
     def fill_query_results_location(self, query):
         connection = sqlite3.connect(os.path.join(self.city_directory, "all-collisions.db"))
-        collisions = []
         try:
-            for row in connection.execute('SELECT * FROM collisions WHERE {0};'.format(query)):
-                collision = switrs.Collision(row)
-                collisions.append(collision)
-                (collision.latitude, collision.longitude) = self.get_location_for_collision(collision)
-                print(collision)
-
-            self.update_collision_locations_in_database(connection, collisions)
+            # The store indexes collisions by intersection, so every location is
+            # geocoded and looked up once however many collisions happened there.
+            with profiling.phase('query'):
+                store = switrs.CollisionStore()
+                store.add_rows(connection.execute('SELECT * FROM collisions WHERE {0};'.format(query)))
+            with profiling.phase('geocode'):
+                self.geocode_locations(store.intersections())
+
+            with profiling.phase('locate'):
+                for intersection in store.intersections():
+                    location = self.get_location(intersection)
+                    for collision in store.at_intersection(intersection):
+                        (collision.latitude, collision.longitude) = location
+                        print(collision)
+
+            with profiling.phase('update'):
+                self.update_collision_locations_in_database(connection, store)
 
         finally:
             connection.close()
-            self.write_location_database()
+            self.location_database.close()
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Must specify city directory")
-        sys.exit(1)
+def create_backend(args):
+    if args.backend == 'http':
+        return geocoding.HTTPBackend(args.url)
+    return geocoding.GoogleBackend()
+
+def create_offline_geocoder(geocoder, street_files):
+    index = streets.IntersectionIndex()
+    for path in street_files:
+        index.load(path)
+    index.load_locations(geocoder.location_database.items())
+    return streets.OfflineGeocoder(index)
 
-    CollisionGoecoder(sys.argv[1]).fill_query_results_location('motor_vehicle_with = "G" OR motor_vehicle_with = "B"')
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Geocode bike and pedestrian collisions in all-collisions.db.')
+    parser.add_argument('city_directory')
+    parser.add_argument('--backend', choices=['google', 'http', 'offline'], default='google',
+                        help='geocoding service to use (default: %(default)s)')
+    parser.add_argument('--url',
+                        help='URL template for the http backend, with an {address} placeholder')
+    parser.add_argument('--streets', nargs='+', default=[],
+                        help='street intersection data for the offline backend: OpenStreetMap .osm extracts, ' + \
+                             'locations.json files or CSV files of road, road, latitude, longitude')
+    parser.add_argument('--rate', type=float, default=5.0,
+                        help='maximum requests per second (default: %(default)s)')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='number of requests that may be sent at once after idling (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent requests (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='times to retry a failed request, with exponential backoff (default: %(default)s)')
+    parser.add_argument('--retry-failures', action='store_true',
+                        help='geocode again the locations that previously had no result')
+    parser.add_argument('--location-cache',
+                        help='SQLite geocode cache, which may be shared between cities (default: CITY_DIRECTORY/locations.db)')
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.enable(args.profile, 'geocode')
+    if args.backend == 'http' and not args.url:
+        parser.error('--url is required with the http backend')
+
+    if args.backend == 'offline':
+        pipeline = None
+    else:
+        pipeline = geocoding.GeocodingPipeline(create_backend(args), rate=args.rate, burst=args.burst,
+                                               workers=args.workers, retries=args.retries)
+
+    geocoder = CollisionGoecoder(args.city_directory, pipeline, args.retry_failures, args.location_cache)
+    if pipeline is None:
+        # The offline index also learns every location already in the cache.
+        with profiling.phase('index'):
+            geocoder.pipeline = create_offline_geocoder(geocoder, args.streets)
+    geocoder.fill_query_results_location("motor_vehicle_with IN ('G', 'B')")
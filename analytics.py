@@ -0,0 +1,349 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Columnar, NumPy backed copies of the SWITRS tables. Integer and real columns
+# become int64 and float64 arrays, and text columns become categoricals, which
+# are an array of integer codes into a sorted table of distinct strings. Group
+# by counts and rollups over these run as array operations instead of Python
+# loops over switrs.Collision objects.
+
+import collections
+import csv
+import numpy
+import os
+import sqlite3
+import switrs
+
+# Integer columns have no NaN, so NULL and unparseable values become this.
+MISSING = -1
+
+TABLE_SCHEMAS = collections.OrderedDict([
+    ('collisions', switrs.COLLISION_SCHEMA),
+    ('parties', switrs.PARTY_SCHEMA),
+    ('victims', switrs.VICTIM_SCHEMA),
+])
+
+SEVERITIES = ['property damage only', 'fatal', 'severe injury', 'other visible injury', 'complaint of pain']
+
+# These match TIMES_OF_DAY in ui/main.js: 6am-12pm, 12pm-6pm, 6pm-12am and 12am-6am.
+TIME_OF_DAY_BY_HOUR = numpy.array([3] * 6 + [0] * 6 + [1] * 6 + [2] * 6)
+
+
+class Categorical(object):
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    @classmethod
+    def from_values(cls, values):
+        values = numpy.array(values, dtype=object)
+        values[numpy.equal(values, None)] = ''
+        (categories, codes) = numpy.unique(values.astype(str), return_inverse=True)
+        return cls(codes.astype(numpy.int32), categories)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, selection):
+        return Categorical(self.codes[selection], self.categories)
+
+    def code_for(self, value):
+        index = numpy.searchsorted(self.categories, value)
+        if index < len(self.categories) and self.categories[index] == value:
+            return index
+        return MISSING
+
+    def isin(self, values):
+        return numpy.isin(self.codes, [self.code_for(value) for value in values])
+
+    # Maps every category through a dictionary, returning an integer array with
+    # one value per row.
+    def map(self, mapping, default=MISSING):
+        lookup = numpy.array([mapping.get(category, default) for category in self.categories], dtype=numpy.int64)
+        return lookup[self.codes]
+
+    def values(self):
+        return self.categories[self.codes]
+
+
+def integer_or_missing(value):
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def real_or_nan(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+
+# Converting a whole column at once is much faster than a value at a time, so
+# only fall back to converting values one by one when a column has NULLs or
+# text that NumPy cannot convert.
+def column_from_values(sqltype, values):
+    if sqltype.startswith('integer'):
+        try:
+            return numpy.array(values, dtype=numpy.int64)
+        except (TypeError, ValueError):
+            return numpy.fromiter((integer_or_missing(value) for value in values), dtype=numpy.int64, count=len(values))
+    if sqltype.startswith('real'):
+        try:
+            return numpy.array(values, dtype=numpy.float64)
+        except (TypeError, ValueError):
+            return numpy.fromiter((real_or_nan(value) for value in values), dtype=numpy.float64, count=len(values))
+    return Categorical.from_values(values)
+
+
+class Table(object):
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    # Returns the rows selected by a boolean mask or an array of row indices.
+    def select(self, selection):
+        return Table(collections.OrderedDict((name, column[selection]) for (name, column) in self.columns.items()))
+
+    @classmethod
+    def from_rows(cls, rows, schema, columns=None):
+        types = switrs.column_types(schema)
+        names = columns or switrs.field_names(schema)
+        values = list(zip(*rows)) or [()] * len(names)
+        return cls(collections.OrderedDict((name, column_from_values(types[name], column_values))
+                                           for (name, column_values) in zip(names, values)))
+
+
+def load_table(connection, table, columns=None):
+    schema = TABLE_SCHEMAS[table]
+    names = columns or switrs.field_names(schema)
+    rows = connection.execute('SELECT {0} FROM {1};'.format(', '.join(names), table)).fetchall()
+    return Table.from_rows(rows, schema, names)
+
+
+# Reads one of the SWITRS CSV files, which have no header and whose columns are
+# in schema order. Rows are parsed as collect parses them, so the values have
+# the same types and normalization as those loaded from a database.
+def load_csv(path, table, columns=None):
+    schema = TABLE_SCHEMAS[table]
+    names = switrs.field_names(schema)
+    indices = [names.index(name) for name in columns or names]
+    with open(path, 'r', newline='') as csv_file:
+        rows = [[row[index] for index in indices]
+                for row in switrs.RecordParser(schema).parse_rows(csv.reader(csv_file))]
+    return Table.from_rows(rows, schema, columns)
+
+
+def save_tables(path, tables, key):
+    arrays = {'key': numpy.array(key, dtype=numpy.int64)}
+    for (table_name, table) in tables.items():
+        for (name, column) in table.columns.items():
+            prefix = '{0}/{1}'.format(table_name, name)
+            if isinstance(column, Categorical):
+                arrays[prefix + '/codes'] = column.codes
+                arrays[prefix + '/categories'] = column.categories
+            else:
+                arrays[prefix] = column
+
+    # numpy.savez adds .npz to names without it, so write to a name that has it.
+    temporary_path = path + '.tmp.npz'
+    numpy.savez(temporary_path, **arrays)
+    os.replace(temporary_path, path)
+
+
+def read_saved_tables(path, key):
+    with numpy.load(path, allow_pickle=False) as saved:
+        if 'key' not in saved or list(saved['key']) != list(key):
+            return None
+
+        tables = collections.OrderedDict()
+        for name in saved.files:
+            parts = name.split('/')
+            if len(parts) < 2:
+                continue
+            columns = tables.setdefault(parts[0], collections.OrderedDict())
+            if len(parts) == 2:
+                columns[parts[1]] = saved[name]
+            elif parts[2] == 'codes':
+                columns[parts[1]] = Categorical(saved[name], saved['/'.join(parts[:2] + ['categories'])])
+    return collections.OrderedDict((name, Table(columns)) for (name, columns) in tables.items())
+
+
+# Changes whenever the data does. In WAL mode, commits stay in the -wal file
+# until a checkpoint, so its size and modification time are part of the key
+# along with the database file's.
+def database_key(database_path):
+    key = []
+    for path in [database_path, database_path + '-wal']:
+        try:
+            stat = os.stat(path)
+            key += [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            key += [MISSING, MISSING]
+    return key
+
+
+# Loads every table of a database. Converting rows to arrays is the slow part,
+# so with a cache path the arrays are saved after the first load and reused
+# until the database changes.
+def load_database(database_path, cache_path=None):
+    key = database_key(database_path)
+    if cache_path is not None and os.path.exists(cache_path):
+        tables = read_saved_tables(cache_path, key)
+        if tables is not None:
+            return tables
+
+    connection = sqlite3.connect(database_path)
+    try:
+        tables = collections.OrderedDict((table, load_table(connection, table)) for table in TABLE_SCHEMAS)
+    finally:
+        connection.close()
+
+    if cache_path is not None:
+        save_tables(cache_path, tables, key)
+    return tables
+
+
+def concatenate_tables(tables):
+    tables = list(tables)
+    columns = collections.OrderedDict()
+    for name in tables[0].columns:
+        parts = [table[name] for table in tables]
+        if not isinstance(parts[0], Categorical):
+            columns[name] = numpy.concatenate(parts)
+            continue
+
+        # Each part has its own category table, so map all of them onto the
+        # union of their categories.
+        categories = numpy.unique(numpy.concatenate([part.categories for part in parts]))
+        codes = [numpy.searchsorted(categories, part.categories)[part.codes] for part in parts]
+        columns[name] = Categorical(numpy.concatenate(codes).astype(numpy.int32), categories)
+    return Table(columns)
+
+
+def years(collisions):
+    date = collisions['date']
+    return numpy.where(date > 0, date // 10000, MISSING)
+
+
+def hours(collisions):
+    time = collisions['time']
+    return numpy.where(time >= 0, time // 100, MISSING)
+
+
+def times_of_day(collisions):
+    hour = hours(collisions)
+    return numpy.where(hour >= 0, TIME_OF_DAY_BY_HOUR[numpy.clip(hour, 0, 23)], MISSING)
+
+
+def hour_histogram(collisions):
+    hour = hours(collisions)
+    return numpy.bincount(hour[hour >= 0], minlength=24)
+
+
+# Numbers collision types as json-for-collisions.py does: pedestrian 0, bike 1
+# and everything else 2.
+def collision_types(collisions):
+    return collisions['motor_vehicle_with'].map({'B': 0, 'G': 1}, 2)
+
+
+def victim_sexes(victims):
+    return victims['sex'].map({'F': 0, 'M': 1}, 2)
+
+
+# Returns, for every row of a table with a collision_id column, the index of
+# its collision's row, or MISSING when the collision is not in the table.
+def collision_rows(collisions, table):
+    ids = collisions['id']
+    row_for_code = numpy.full(len(ids.categories), MISSING, dtype=numpy.int64)
+    row_for_code[ids.codes] = numpy.arange(len(ids))
+
+    collision_ids = table['collision_id']
+    positions = numpy.searchsorted(ids.categories, collision_ids.categories)
+    found = positions < len(ids.categories)
+    found[found] = ids.categories[positions[found]] == collision_ids.categories[found]
+    row_for_category = numpy.where(found, row_for_code[numpy.minimum(positions, len(ids.categories) - 1)], MISSING)
+    return row_for_category[collision_ids.codes]
+
+
+def group_key(key):
+    if isinstance(key, Categorical):
+        return (key.codes, key.categories)
+    return (numpy.asarray(key), None)
+
+
+# Numbers the distinct combinations of the keys. Returns the combinations, as
+# tuples of key values, and the combination number of every row.
+def factorize(keys):
+    keys = [group_key(key) for key in keys]
+    combined = numpy.zeros(len(keys[0][0]), dtype=numpy.int64)
+    levels = []
+    for (values, categories) in keys:
+        (distinct, inverse) = numpy.unique(values, return_inverse=True)
+        combined = combined * len(distinct) + inverse
+        levels.append((distinct, categories))
+
+    (groups, inverse) = numpy.unique(combined, return_inverse=True)
+    columns = []
+    for (distinct, categories) in reversed(levels):
+        values = distinct[groups % len(distinct)]
+        groups = groups // len(distinct)
+        if categories is not None:
+            values = categories[values]
+        columns.append(values.tolist())
+    return (list(zip(*reversed(columns))), inverse)
+
+
+def group_counts(keys, weights=None):
+    if len(keys[0]) == 0:
+        return collections.OrderedDict()
+    (groups, inverse) = factorize(keys)
+    counts = numpy.bincount(inverse, weights=weights, minlength=len(groups))
+    return collections.OrderedDict(zip(groups, counts.tolist()))
+
+
+# Counts collisions by severity for every group, along with the number of
+# people killed and injured in them.
+def severity_rollup(collisions, keys):
+    rollup = collections.OrderedDict()
+    if len(collisions) == 0:
+        return rollup
+
+    (groups, inverse) = factorize(keys)
+    severity = collisions['collision_severity']
+    valid = (severity >= 0) & (severity < len(SEVERITIES))
+    counts = numpy.zeros((len(groups), len(SEVERITIES)), dtype=numpy.int64)
+    numpy.add.at(counts, (inverse[valid], severity[valid]), 1)
+    killed = numpy.bincount(inverse, weights=numpy.maximum(collisions['killed_count'], 0), minlength=len(groups))
+    injured = numpy.bincount(inverse, weights=numpy.maximum(collisions['injured_count'], 0), minlength=len(groups))
+
+    for (index, group) in enumerate(groups):
+        row = collections.OrderedDict(zip(SEVERITIES, counts[index].tolist()))
+        row['killed'] = int(killed[index])
+        row['injured'] = int(injured[index])
+        rollup[group] = row
+    return rollup
@@ -0,0 +1,174 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Finds and opens the SWITRS records of each year of a city, which may be kept
+# either extracted or in the archives they are downloaded as. A year is either
+# a directory or a zip archive in the city directory. A year directory holds
+# CollisionRecords.txt, PartyRecords.txt and VictimRecords.txt, each of which
+# may be compressed with gzip, bzip2 or xz, or a zip archive containing them.
+# Compressed records are decompressed as they are read, never to disk.
+
+import bz2
+import collections
+import contextlib
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+import zipfile
+
+CHUNK_SIZE = 1024 * 1024
+QUEUED_CHUNKS = 8
+
+COMPRESSED_SUFFIXES = collections.OrderedDict([
+    ('.gz', gzip.open),
+    ('.bz2', bz2.open),
+    ('.xz', lzma.open),
+])
+
+# A year of records. The key identifies the year in the database, paths are
+# the files on disk it is read from and records maps the name of each SWITRS
+# file to its location, a (path, zip member) pair whose member is None for
+# files that are not in a zip archive.
+YearSource = collections.namedtuple('YearSource', ['key', 'paths', 'records'])
+
+
+def zip_members(path, filenames):
+    with zipfile.ZipFile(path) as archive:
+        members = dict((os.path.basename(name), name) for name in archive.namelist() if not name.endswith('/'))
+    return dict((filename, (path, members[filename])) for filename in filenames if filename in members)
+
+
+def find_records(directory, filenames):
+    records = {}
+    for filename in filenames:
+        for suffix in [''] + list(COMPRESSED_SUFFIXES):
+            path = os.path.join(directory, filename + suffix)
+            if os.path.isfile(path):
+                records[filename] = (path, None)
+                break
+
+    for name in sorted(os.listdir(directory)):
+        if len(records) == len(filenames):
+            break
+        if name.endswith('.zip'):
+            members = zip_members(os.path.join(directory, name), filenames)
+            records.update((filename, location) for (filename, location) in members.items() if filename not in records)
+    return records
+
+
+def year_source(city_directory, path, filenames):
+    if os.path.isdir(path):
+        records = find_records(path, filenames)
+    else:
+        records = zip_members(path, filenames)
+
+    missing = [filename for filename in filenames if filename not in records]
+    if missing:
+        raise IOError('{0} has no {1}'.format(path, ', '.join(missing)))
+    paths = sorted(set(location[0] for location in records.values()))
+    return YearSource(os.path.relpath(path, city_directory), paths, records)
+
+
+def find_year_sources(city_directory, filenames):
+    paths = [os.path.join(city_directory, name) for name in sorted(os.listdir(city_directory))]
+    return [year_source(city_directory, path, filenames) for path in paths
+            if os.path.isdir(path) or (path.endswith('.zip') and os.path.isfile(path))]
+
+
+# A raw stream over the contents of a file that another thread reads, and for
+# compressed files decompresses, a chunk ahead of the consumer. zlib, bz2 and
+# lzma release the GIL while decompressing, so decompression overlaps parsing
+# and inserting in the consuming thread. At most QUEUED_CHUNKS chunks are
+# decompressed ahead, which bounds memory use.
+class BackgroundReader(io.RawIOBase):
+    def __init__(self, open_file, chunk_size=CHUNK_SIZE):
+        self.chunks = queue.Queue(QUEUED_CHUNKS)
+        self.chunk = memoryview(b'')
+        self.finished = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.read_chunks, args=(open_file, chunk_size), daemon=True)
+        self.thread.start()
+
+    def read_chunks(self, open_file, chunk_size):
+        try:
+            with open_file() as source:
+                while not self.stopping.is_set():
+                    chunk = source.read(chunk_size)
+                    self.chunks.put(chunk)
+                    if not chunk:
+                        return
+        except Exception as error:
+            self.chunks.put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk:
+            if self.finished:
+                return 0
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                self.finished = True
+                raise chunk
+            if not chunk:
+                self.finished = True
+                return 0
+            self.chunk = memoryview(chunk)
+
+        count = min(len(buffer), len(self.chunk))
+        buffer[:count] = self.chunk[:count]
+        self.chunk = self.chunk[count:]
+        return count
+
+    def close(self):
+        if not self.closed:
+            # Empty the queue until the reading thread notices it should stop, in
+            # case it is blocked waiting for room to put a chunk.
+            self.stopping.set()
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        super().close()
+
+
+@contextlib.contextmanager
+def open_zip_member(path, member):
+    with zipfile.ZipFile(path) as archive, archive.open(member) as records:
+        yield records
+
+
+def open_compressed(path):
+    for (suffix, open_file) in COMPRESSED_SUFFIXES.items():
+        if path.endswith(suffix):
+            return lambda: open_file(path, 'rb')
+    return None
+
+
+# Opens the records at a location for reading as text, in the same way that the
+# extracted files are opened, so CSV parsing does not depend on how they are stored.
+def open_records(location):
+    (path, member) = location
+    if member is not None:
+        open_file = lambda: open_zip_member(path, member)
+    else:
+        open_file = open_compressed(path)
+        if open_file is None:
+            return open(path, 'r', newline='')
+    return io.TextIOWrapper(io.BufferedReader(BackgroundReader(open_file), CHUNK_SIZE), newline='')
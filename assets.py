@@ -0,0 +1,64 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Content-addressed files for the UI. A file's name includes a hash of its
+# contents, so a name always refers to the same data: browsers can cache these
+# files forever, an export that produces the same data again finds the file
+# already written, and the top-level manifest.json that points at them is the
+# only file whose contents ever change.
+
+import hashlib
+import os
+import re
+
+HASH_LENGTH = 16
+
+# Matches names like 13/1312/3165.0123456789abcdef.bin.
+HASHED_NAME = re.compile(r'\.[0-9a-f]{%d}\.[A-Za-z0-9]+$' % HASH_LENGTH)
+
+
+def is_hashed(path):
+    return HASHED_NAME.search(path) is not None
+
+
+def hashed_name(template, digest):
+    return template.format(hash=digest.hexdigest()[:HASH_LENGTH])
+
+
+# Writes data under template, a path relative to directory with a {hash}
+# placeholder, and returns the resulting name. A file that already exists holds
+# the same data, so it is left alone.
+def write_hashed(directory, template, data):
+    name = hashed_name(template, hashlib.sha1(data))
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as hashed_file:
+            hashed_file.write(data)
+        os.replace(temporary_path, path)
+    return name
+
+
+# Removes every file under directory that is not one of the given names, along
+# with directories left empty, once nothing refers to older versions anymore.
+def remove_unreferenced(directory, names):
+    directory = os.path.normpath(directory)
+    referenced = set(os.path.normpath(os.path.join(directory, name)) for name in names)
+    for (path, directories, filenames) in os.walk(directory, topdown=False):
+        for filename in filenames:
+            if os.path.join(path, filename) not in referenced:
+                os.remove(os.path.join(path, filename))
+        if path != directory and not os.listdir(path):
+            os.rmdir(path)
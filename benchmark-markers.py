@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Measures how marker assignment and the whole JSON export scale with the size of
+# the dataset, using synthetic SWITRS data spread over half as many intersections
+# as there are collisions.
+
+import argparse
+import markers
+import os
+import sqlite3
+import subprocess
+import sys
+import synthetic
+import tempfile
+import time
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# The linear scan the exporter used before MarkerIndex.
+def linear_marker_index(location, marker_list):
+    for (i, marker) in enumerate(marker_list):
+        if marker == location:
+            return i
+
+    marker_list.append(location)
+    return len(marker_list) - 1
+
+def read_locations(city_directory):
+    connection = sqlite3.connect(os.path.join(city_directory, 'all-collisions.db'))
+    try:
+        return [[latitude, longitude] for (latitude, longitude) in connection.execute(
+            "SELECT latitude, longitude FROM collisions WHERE motor_vehicle_with IN ('G', 'B')")]
+    finally:
+        connection.close()
+
+def time_linear(locations):
+    start = time.perf_counter()
+    marker_list = []
+    for location in locations:
+        linear_marker_index(location, marker_list)
+    return (time.perf_counter() - start, len(marker_list))
+
+def time_hashed(locations):
+    start = time.perf_counter()
+    marker_index = markers.MarkerIndex()
+    for (latitude, longitude) in locations:
+        marker_index.index_for_location(latitude, longitude)
+    return (time.perf_counter() - start, len(marker_index))
+
+def run_script(name, *args, cwd=None):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, os.path.join(SCRIPT_DIRECTORY, name)] + list(args),
+                          cwd=cwd, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark marker deduplication and export against dataset size.')
+    parser.add_argument('--sizes', default='1000,4000,16000,64000',
+                        help='comma-separated numbers of collisions to generate (default: %(default)s)')
+    parser.add_argument('--max-linear-size', type=int, default=16000,
+                        help='largest dataset to time the old linear scan on (default: %(default)s)')
+    args = parser.parse_args()
+
+    print('{0:>10} {1:>10} {2:>12} {3:>12} {4:>12}'.format('collisions', 'markers', 'linear s', 'hashed s', 'export s'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory() as city_directory:
+            synthetic.write_city(city_directory, [2013], size, max(1, size // 2), geocoded=True)
+            run_script('collect-switr-data-into-sqlite.py', city_directory)
+            locations = read_locations(city_directory)
+
+            linear = 'n/a'
+            if size <= args.max_linear_size:
+                linear = '{0:.3f}'.format(time_linear(locations)[0])
+            (hashed, marker_count) = time_hashed(locations)
+
+            os.mkdir(os.path.join(city_directory, 'ui'))
+            export = run_script('json-for-collisions.py', city_directory, cwd=city_directory)
+
+            print('{0:>10} {1:>10} {2:>12} {3:>12.3f} {4:>12.3f}'.format(size, marker_count, linear, hashed, export))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs the generate-data pipeline (collect, geocode and export) on synthetic
+# SWITRS data of increasing size and reports the wall time, rows per second,
+# peak memory and output size of every stage. Each stage runs as its own process,
+# exactly as the Makefile runs it, so the peak RSS is the stage's alone. Geocoding
+# uses the offline backend with the synthetic intersections, so no network
+# service is involved.
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import synthetic
+import tempfile
+import time
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_YEARS = [2012, 2013]
+
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(directory, filename))
+               for (directory, subdirectories, filenames) in os.walk(path) for filename in filenames)
+
+
+def count_lines(city_directory, filename):
+    count = 0
+    for year_directory in sorted(os.listdir(city_directory)):
+        path = os.path.join(city_directory, year_directory, filename)
+        if os.path.isfile(path):
+            with open(path, 'rb') as records:
+                count += sum(1 for line in records)
+    return count
+
+
+def count_map_collisions(city_directory):
+    connection = sqlite3.connect(os.path.join(city_directory, 'all-collisions.db'))
+    try:
+        return connection.execute("SELECT count(*) FROM collisions WHERE motor_vehicle_with IN ('G', 'B')").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def write_streets(path, intersections):
+    with open(path, 'w', newline='') as streets_file:
+        csv.writer(streets_file).writerows(intersections)
+
+
+# Returns the wall time in seconds and the peak resident set size in bytes of a
+# script run to completion in its own process.
+def run_stage(script, arguments, cwd):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIRECTORY, script)] + arguments,
+                               cwd=cwd, stdout=subprocess.DEVNULL)
+    (pid, status, usage) = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, script)
+
+    # Linux reports ru_maxrss in KiB.
+    return (elapsed, usage.ru_maxrss * 1024)
+
+
+def benchmark_size(working_directory, size, years, intersections_per_collision, jobs, profile_directory):
+    city_directory = os.path.join(working_directory, 'City')
+    intersections = synthetic.write_city(city_directory, years, max(1, size // len(years)),
+                                         max(1, int(size * intersections_per_collision)))
+    streets_path = os.path.join(working_directory, 'streets.csv')
+    write_streets(streets_path, intersections)
+
+    profile_arguments = []
+    if profile_directory is not None:
+        profile_arguments = ['--profile', os.path.join(profile_directory, str(size))]
+
+    input_rows = sum(count_lines(city_directory, filename)
+                     for filename in ['CollisionRecords.txt', 'PartyRecords.txt', 'VictimRecords.txt'])
+    results = []
+    (seconds, peak) = run_stage('collect-switr-data-into-sqlite.py',
+                                [city_directory, '--jobs', str(jobs)] + profile_arguments, working_directory)
+    database_path = os.path.join(city_directory, 'all-collisions.db')
+    results.append(('collect', input_rows, seconds, peak, directory_size(database_path)))
+
+    # The collect stage reads every subdirectory of the city as a year, so only
+    # create the export's output directory once it has run.
+    os.mkdir(os.path.join(city_directory, 'ui'))
+    map_collisions = count_map_collisions(city_directory)
+    (seconds, peak) = run_stage('add-location-to-database.py',
+                                [city_directory, '--backend', 'offline', '--streets', streets_path] + \
+                                profile_arguments, working_directory)
+    results.append(('geocode', map_collisions, seconds, peak, directory_size(os.path.join(city_directory, 'locations.db'))))
+
+    (seconds, peak) = run_stage('json-for-collisions.py', ['.'] + profile_arguments, city_directory)
+    results.append(('export', map_collisions, seconds, peak, directory_size(os.path.join(city_directory, 'ui'))))
+
+    return [{'size': size, 'stage': stage, 'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds,
+             'peak_rss': peak, 'output_bytes': output_bytes}
+            for (stage, rows, seconds, peak, output_bytes) in results]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time each stage of the data pipeline on synthetic data.')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma-separated numbers of collisions to generate, such as 1000,10000,50000 for a ' + \
+                        'longer run (default: %(default)s)')
+    parser.add_argument('--years', default=','.join(str(year) for year in DEFAULT_YEARS),
+                        help='comma-separated years to spread the collisions over (default: %(default)s)')
+    parser.add_argument('--intersections-per-collision', type=float, default=0.5,
+                        help='number of distinct intersections relative to collisions (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='worker processes for the collect stage (default: %(default)s)')
+    parser.add_argument('--profile', metavar='DIRECTORY',
+                        help='also have every stage write per-phase timings and cProfile dumps to DIRECTORY/SIZE')
+    parser.add_argument('--json', metavar='FILE', help='write the results to FILE as JSON, for comparing runs')
+    args = parser.parse_args()
+
+    profile_directory = os.path.abspath(args.profile) if args.profile else None
+    years = [int(year) for year in args.years.split(',')]
+
+    results = []
+    print('{0:>8} {1:<8} {2:>9} {3:>9} {4:>11} {5:>10} {6:>11}'.format(
+        'size', 'stage', 'rows', 'seconds', 'rows/s', 'peak MiB', 'output KiB'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory() as working_directory:
+            for result in benchmark_size(working_directory, size, years, args.intersections_per_collision,
+                                         args.jobs, profile_directory):
+                results.append(result)
+                print('{size:>8} {stage:<8} {rows:>9} {seconds:>9.3f} {rows_per_second:>11.0f} '.format(**result) + \
+                      '{0:>10.1f} {1:>11.1f}'.format(result['peak_rss'] / 2 ** 20, result['output_bytes'] / 2 ** 10))
+                sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Compares the memory use and construction speed of the switrs record classes
+# with the dict-based records they replaced, using a city's SWITRS CSV files.
+
+import argparse
+import csv
+import gc
+import os
+import switrs
+import time
+import tracemalloc
+
+# The layout the records had before they used __slots__: every field is an entry
+# in the instance __dict__ and the CSV row is kept alongside in self.array.
+class DictCollision(object):
+    set_fields = switrs.record_initializer(switrs.Collision.fields)
+
+    def __init__(self, csvarray):
+        self.parties = []
+        self.victims = []
+        self.array = list(csvarray)
+        self.set_fields(csvarray)
+
+
+class DictParty(object):
+    set_fields = switrs.record_initializer(switrs.Party.fields)
+
+    def __init__(self, csvarray):
+        self.array = csvarray
+        self.set_fields(csvarray)
+
+
+class DictVictim(object):
+    set_fields = switrs.record_initializer(switrs.Victim.fields)
+
+    def __init__(self, csvarray):
+        self.array = csvarray
+        self.set_fields(csvarray)
+
+
+# Rows are converted the same way as when they are loaded into the database, so
+# the records hold the same typed values that they would be built from there.
+def read_rows(city_directory, filename, schema):
+    parser = switrs.RecordParser(schema)
+    rows = []
+    for subdir in sorted(os.listdir(city_directory)):
+        path = os.path.join(city_directory, subdir, filename)
+        if os.path.isfile(path):
+            with open(path, 'r', newline='') as csvfile:
+                rows.extend(parser.parse_rows(csv.reader(csvfile)))
+    return rows
+
+def build_records(classes, rows):
+    records = []
+    for (cls, class_rows) in zip(classes, rows):
+        records.extend([cls(row) for row in class_rows])
+    return records
+
+def measure(classes, rows, repeat):
+    timings = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        records = build_records(classes, rows)
+        timings.append(time.perf_counter() - start)
+        del records
+
+    gc.collect()
+    tracemalloc.start()
+    records = build_records(classes, rows)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (len(records), min(timings), memory)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the SWITRS record classes.')
+    parser.add_argument('city_directory')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rows = [read_rows(args.city_directory, 'CollisionRecords.txt', switrs.COLLISION_SCHEMA),
+            read_rows(args.city_directory, 'PartyRecords.txt', switrs.PARTY_SCHEMA),
+            read_rows(args.city_directory, 'VictimRecords.txt', switrs.VICTIM_SCHEMA)]
+
+    print('{0:<10} {1:>10} {2:>12} {3:>12} {4:>14}'.format('records', 'count', 'seconds', 'MiB', 'bytes/record'))
+    for (name, classes) in [('dict', (DictCollision, DictParty, DictVictim)),
+                            ('slots', (switrs.Collision, switrs.Party, switrs.Victim))]:
+        (count, seconds, memory) = measure(classes, rows, args.repeat)
+        print('{0:<10} {1:>10} {2:>12.3f} {3:>12.1f} {4:>14.0f}'.format(
+            name, count, seconds, memory / (1024 * 1024), memory / count))
@@ -14,172 +14,362 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import archives
+import argparse
+import collections
+import concurrent.futures
 import csv
+import hashlib
+import itertools
 import os
+import profiling
+import shutil
+import spatial
 import sqlite3
 import switrs
-import sys
+import tempfile
+
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_JOURNAL_MODE = 'WAL'
+DEFAULT_SYNCHRONOUS = 'NORMAL'
+DEFAULT_CACHE_SIZE = 64 * 1024
+JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+TABLES = ['collisions', 'parties', 'victims']
+SOURCE_FILES = ['CollisionRecords.txt', 'PartyRecords.txt', 'VictimRecords.txt']
+
+# Databases written with a different schema version are rebuilt from scratch.
+SCHEMA_VERSION = 4
+
+SCHEMAS = {
+    'collisions': switrs.COLLISION_SCHEMA,
+    'parties': switrs.PARTY_SCHEMA,
+    'victims': switrs.VICTIM_SCHEMA,
+}
+
+def create_table(connection, table, schema):
+    columns = ', '.join('{0} {1}'.format(name, column_type)
+                        for (name, column_type) in switrs.column_types(schema).items())
+    connection.execute('CREATE TABLE IF NOT EXISTS {0}({1})'.format(table, columns))
 
 def create_tables(connection):
-    connection.execute('CREATE TABLE collisions(' + \
-        'id text, ' + \
-        'year text, ' + \
-        'process_date text, ' + \
-        'jurisdiction text, ' + \
-        'date text, ' + \
-        'time text, ' + \
-        'officer_id text, ' + \
-        'reporting_district text, ' + \
-        'day_of_week text, ' + \
-        'chp_shift text, ' + \
-        'population text, ' + \
-        'county_city_location text, ' + \
-        'special_condition text, ' + \
-        'beat_type text, ' + \
-        'chp_beat_type text, ' + \
-        'city_division_lapd text, ' + \
-        'chp_beat_class text, ' + \
-        'beat_number text, ' + \
-        'primary_road text, ' + \
-        'secondary_road text, ' + \
-        'distance text, ' + \
-        'direction text, ' + \
-        'intersection text, ' + \
-        'weather1 text, ' + \
-        'weather2 text, ' + \
-        'state_highway text, ' + \
-        'caltrans_county text, ' + \
-        'caltrans_distruct text, ' + \
-        'state_route text, ' + \
-        'route_suffix text, ' + \
-        'postmile_prefix text, ' + \
-        'postmile text, ' + \
-        'location_type text, ' + \
-        'ramp_intersection text, ' + \
-        'side_of_highway text, ' + \
-        'tow_away text, ' + \
-        'collision_severity text, ' + \
-        'killed_count text, ' + \
-        'injured_count text, ' + \
-        'party_count text, ' + \
-        'primary_collision_factor text, ' + \
-        'pcf_violation_code text, ' + \
-        'pcf_violation_category text, ' + \
-        'pcf_violation text, ' + \
-        'pcf_violation_subsection text, ' + \
-        'hit_and_run text, ' + \
-        'collision_type text, ' + \
-        'motor_vehicle_with text, ' + \
-        'pedestrian_action text, ' + \
-        'road_surface text, ' + \
-        'road_condition1 text, ' + \
-        'road_condition2 text, ' + \
-        'lighting text, ' + \
-        'control_device text, ' + \
-        'chp_road_type text, ' + \
-        'pedestrian_collision text, ' + \
-        'bicycle_collision text, ' + \
-        'motorcycle_collision text, ' + \
-        'truck_collision text, ' + \
-        'not_private_property text, ' + \
-        'alcohol_involved text, ' + \
-        'statewide_vehicle_type_at_fault text, ' + \
-        'chp_vehicle_type_at_fault text, ' + \
-        'severe_injury_count text, ' + \
-        'other_visible_injury_count text, ' + \
-        'complaint_of_pain_injury_count text, ' + \
-        'pedestrian_killed_count text, ' + \
-        'pedestrian_injured_count text, ' + \
-        'bicyclist_killed_count text, ' + \
-        'bicyclist_injured_count text, ' + \
-        'motorcyclist_killed_count text, ' + \
-        'motorcyclist_injured_count text, ' + \
-        'primary_ramp text, ' + \
-        'secondary_ramp text, ' + \
-        'latitude text, ' + \
-        'longitude text)')
-
-    connection.execute('CREATE TABLE parties(' + \
-        'collision_id text, ' + \
-        'number text, ' + \
-        'party_type text, ' + \
-        'at_fault text, ' + \
-        'sex text, ' + \
-        'age text, ' + \
-        'sobriety text, ' + \
-        'impairment text, ' + \
-        'direction_of_travel text, ' + \
-        'safety_equipment1 text, ' + \
-        'safety_equipment2 text, ' + \
-        'financial_responsibility text, ' + \
-        'special_information1 text, ' + \
-        'special_information2 text, ' + \
-        'special_information3 text, ' + \
-        'oaf_violation_code text, ' + \
-        'oaf_violation_category text, ' + \
-        'oaf_violation_section text, ' + \
-        'oaf_violation_suffix text, ' + \
-        'other_associated_factor text, ' + \
-        'other_associated_factor2 text, ' + \
-        'number_killed text, ' + \
-        'number_injured text, ' + \
-        'movement_preceding_collision text, ' + \
-        'vehicle_year text, ' + \
-        'vehicle_make text, ' + \
-        'statewide_vehicle_type text, ' + \
-        'chp_vehicle_type_towing text, ' + \
-        'chp_vehicle_type_towed text, ' + \
-        'race text)')
-
-    connection.execute('CREATE TABLE victims(' + \
+    create_table(connection, 'collisions', switrs.COLLISION_SCHEMA)
+    create_table(connection, 'parties', switrs.PARTY_SCHEMA)
+    create_table(connection, 'victims', switrs.VICTIM_SCHEMA)
+
+    # The manifest of source files that have been loaded, and which collisions came
+    # from each year directory, so that a changed directory can be replaced. A
+    # collision id may come from more than one directory, and is only removed
+    # along with the last of them.
+    connection.execute('CREATE TABLE IF NOT EXISTS source_files(' + \
+        'path text primary key, ' + \
+        'directory text, ' + \
+        'size integer, ' + \
+        'mtime_ns integer, ' + \
+        'hash text)')
+    connection.execute('CREATE TABLE IF NOT EXISTS source_collisions(' + \
+        'directory text, ' + \
         'collision_id text, ' + \
-        'party_id text, ' + \
-        'role text, ' + \
-        'sex text, ' + \
-        'age text, ' + \
-        'degree_of_injury text, ' + \
-        'seating_position text, ' + \
-        'safety_equipment1 text, ' + \
-        'safety_equipment2 text, ' + \
-        'ejected text)')
-
-def create_database(database_name):
-    connection = sqlite3.connect(database_name)
-    create_tables(connection)
-
-    for collision in switrs.Collision.collisions.values():
-        connection.execute('INSERT INTO collisions VALUES (?' + (', ?' * 75) + ')', tuple(collision.array))
-
-        for party in collision.parties:
-            # There seems to be two extra undocumented and unused fields in the Parties data.
-            connection.execute('INSERT INTO parties VALUES (?' + (', ?' * 29) + ')', tuple(party.array[0:30]))
-        for victim in collision.victims:
-            connection.execute('INSERT INTO victims VALUES (?' + (', ?' * 9) + ')', tuple(victim.array))
-
-    connection.commit()
-    connection.close()
-
-def read_data(filename, cls):
-    with open(filename, 'r') as csvfile:
-       return [cls(row) for row in csv.reader(csvfile)]
-
-def read_data_from_directory(directory):
-    print('Reading data from {0}'.format(directory))
-    read_data(os.path.join(directory, 'CollisionRecords.txt'), switrs.Collision)
-    for party in read_data(os.path.join(directory, 'PartyRecords.txt'), switrs.Party):
-        switrs.Collision.collisions[party.collision_id].parties.append(party)
-    for victim in read_data(os.path.join(directory, 'VictimRecords.txt'), switrs.Victim):
-        switrs.Collision.collisions[victim.collision_id].victims.append(victim)
+        'primary key (directory, collision_id))')
+    connection.execute('CREATE INDEX IF NOT EXISTS source_collisions_collision_id ON source_collisions(collision_id)')
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print('Must specify city directory')
-        sys.exit(1)
+    # Replacing a collision deletes its parties and victims, which would scan both
+    # tables without these. Rows are inserted in collision order, so keeping them
+    # up to date during a load costs little.
+    connection.execute('CREATE INDEX IF NOT EXISTS parties_collision_id ON parties(collision_id)')
+    connection.execute('CREATE INDEX IF NOT EXISTS victims_collision_id ON victims(collision_id)')
+    connection.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+
+def create_indexes(connection):
+    # These are created after the initial load, since maintaining them while
+    # inserting every row of a fresh database is slower than building them once.
+    connection.execute('CREATE INDEX IF NOT EXISTS collisions_motor_vehicle_with ON collisions(motor_vehicle_with)')
+    connection.execute('CREATE INDEX IF NOT EXISTS collisions_date ON collisions(date)')
+    # The exporter reads each jurisdiction separately.
+    connection.execute('CREATE INDEX IF NOT EXISTS collisions_county_city_location ON collisions(county_city_location)')
+    connection.execute('ANALYZE')
+
+def configure_for_bulk_load(connection, journal_mode, synchronous, cache_size):
+    # The defaults keep each year's replacement atomic while still avoiding an
+    # fsync per transaction. For one-off loads, journaling and syncing can be
+    # turned off entirely with --journal-mode OFF --synchronous OFF, since a load
+    # that fails part way is simply rerun with --rebuild.
+    connection.execute('PRAGMA journal_mode = {0}'.format(journal_mode))
+    connection.execute('PRAGMA synchronous = {0}'.format(synchronous))
+    connection.execute('PRAGMA cache_size = {0}'.format(-cache_size))
+
+def read_rows(location):
+    with archives.open_records(location) as csvfile:
+        yield from csv.reader(csvfile)
+
+def batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def insert_rows(connection, table, parser, rows, batch_size):
+    # Rows are converted to typed values before they reach SQLite, so later stages
+    # never need to parse strings again. There seems to be two extra undocumented
+    # and unused fields in the Parties data, which the parser ignores.
+    placeholders = ', '.join('?' * len(parser.fields))
+    statement = 'INSERT INTO {0} VALUES ({1})'.format(table, placeholders)
+    for batch in batches(parser.parse_rows(rows), batch_size):
+        connection.executemany(statement, batch)
+
+# A collision that was already loaded, by this or another directory, is deleted
+# along with its parties and victims and inserted again, rather than replaced
+# with INSERT OR REPLACE, whose implicit delete fires no triggers and leaves the
+# old parties and victims behind. When an id appears more than once, the last
+# row wins. Each id is recorded as coming from the directory. Most ids of a
+# batch are new, so only the ones that are already stored are deleted.
+def insert_collisions(connection, directory_key, parser, rows, batch_size):
+    placeholders = ', '.join('?' * len(parser.fields))
+    statement = 'INSERT INTO collisions VALUES ({0})'.format(placeholders)
+    connection.execute('CREATE TEMP TABLE IF NOT EXISTS batch_ids(id text primary key)')
+    for batch in batches(parser.parse_rows(rows), batch_size):
+        batch = list(collections.OrderedDict((row[0], row) for row in batch).values())
+        connection.execute('DELETE FROM temp.batch_ids')
+        connection.executemany('INSERT INTO temp.batch_ids VALUES (?)', [(row[0],) for row in batch])
+        stored = connection.execute('SELECT id FROM temp.batch_ids JOIN main.collisions USING (id)').fetchall()
+        if stored:
+            connection.executemany('DELETE FROM victims WHERE collision_id = ?', stored)
+            connection.executemany('DELETE FROM parties WHERE collision_id = ?', stored)
+            connection.executemany('DELETE FROM collisions WHERE id = ?', stored)
+        connection.executemany(statement, batch)
+        connection.executemany('INSERT OR IGNORE INTO source_collisions VALUES (?, ?)',
+                               [(directory_key, row[0]) for row in batch])
+
+# Returns the number of malformed values of each field, keyed by table and field.
+def read_data_from_directory(connection, source, batch_size):
+    print('Reading data from {0}'.format(source.key))
+    parsers = dict((table, switrs.RecordParser(SCHEMAS[table])) for table in TABLES)
+    insert_collisions(connection, source.key, parsers['collisions'],
+                      read_rows(source.records['CollisionRecords.txt']), batch_size)
+    insert_rows(connection, 'parties', parsers['parties'],
+                read_rows(source.records['PartyRecords.txt']), batch_size)
+    insert_rows(connection, 'victims', parsers['victims'],
+                read_rows(source.records['VictimRecords.txt']), batch_size)
+
+    errors = collections.Counter()
+    for table in TABLES:
+        for (field, count) in parsers[table].errors.items():
+            errors['{0}.{1}'.format(table, field)] += count
+    return errors
+
+def report_parse_errors(directory_key, errors):
+    for (field, count) in sorted(errors.items()):
+        print('{0}: {1} malformed values of {2} were stored as NULL'.format(directory_key, count, field))
+
+# The ids of the collisions that only one directory provides.
+EXCLUSIVE_COLLISIONS = '(SELECT collision_id FROM source_collisions AS mine WHERE directory = ? AND NOT EXISTS ' + \
+    '(SELECT 1 FROM source_collisions AS other WHERE other.collision_id = mine.collision_id ' + \
+    'AND other.directory <> mine.directory))'
+
+def remove_data_from_directory(connection, directory_key):
+    connection.execute('DELETE FROM victims WHERE collision_id IN ' + EXCLUSIVE_COLLISIONS, (directory_key,))
+    connection.execute('DELETE FROM parties WHERE collision_id IN ' + EXCLUSIVE_COLLISIONS, (directory_key,))
+    connection.execute('DELETE FROM collisions WHERE id IN ' + EXCLUSIVE_COLLISIONS, (directory_key,))
+    connection.execute('DELETE FROM source_collisions WHERE directory = ?', (directory_key,))
+    connection.execute('DELETE FROM source_files WHERE directory = ?', (directory_key,))
 
-    city_directory = sys.argv[1]
-    for subdir in os.listdir(city_directory):
-        subdir = os.path.join(city_directory, subdir)
-        if os.path.isdir(subdir):
-            read_data_from_directory(subdir)
+def record_source_files(connection, source_files):
+    connection.executemany('INSERT OR REPLACE INTO source_files VALUES (?, ?, ?, ?, ?)', source_files)
+
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Returns whether a year changed since it was last loaded, along with up-to-date
+# manifest rows for its source files. An archive is a single source file, so the
+# records in it are only read again when the archive itself changes.
+def examine_source_files(connection, city_directory, source):
+    changed = False
+    source_files = []
+    for source_path in source.paths:
+        path = os.path.relpath(source_path, city_directory)
+        stat = os.stat(source_path)
+        recorded = connection.execute('SELECT size, mtime_ns, hash FROM source_files WHERE path = ?',
+                                      (path,)).fetchone()
+
+        # Only hash files whose size or modification time differ from the manifest.
+        if recorded is not None and recorded[0:2] == (stat.st_size, stat.st_mtime_ns):
+            content_hash = recorded[2]
+        else:
+            content_hash = file_hash(source_path)
+            changed = changed or recorded is None or recorded[2] != content_hash
+        source_files.append((path, source.key, stat.st_size, stat.st_mtime_ns, content_hash))
+    return (changed, source_files)
+
+# Returns the keys of the directories that provide some of the same collisions
+# as the given ones, and so have to be loaded again after them for their own
+# versions of those collisions to be kept.
+def overlapping_directories(connection, directory_keys):
+    overlapping = set()
+    pending = set(directory_keys)
+    while pending:
+        directory_key = pending.pop()
+        for (other_key,) in connection.execute('SELECT DISTINCT other.directory FROM source_collisions AS mine ' + \
+                                               'JOIN source_collisions AS other ON other.collision_id = mine.collision_id ' + \
+                                               'WHERE mine.directory = ? AND other.directory <> ?',
+                                               (directory_key, directory_key)).fetchall():
+            if other_key not in overlapping and other_key not in directory_keys:
+                overlapping.add(other_key)
+                pending.add(other_key)
+    return overlapping
+
+def build_shard(source, shard_name, batch_size, cache_size):
+    # Shards are private to one worker and thrown away after merging, so they are
+    # written with no journal or syncing at all.
+    connection = sqlite3.connect(shard_name)
+    try:
+        configure_for_bulk_load(connection, 'OFF', 'OFF', cache_size)
+        create_tables(connection)
+        with connection:
+            errors = read_data_from_directory(connection, source, batch_size)
+    finally:
+        connection.close()
+    return (shard_name, errors)
+
+def merge_shard(connection, shard_name, directory_key, source_files):
+    connection.execute('ATTACH DATABASE ? AS shard', (shard_name,))
+    try:
+        with connection:
+            remove_data_from_directory(connection, directory_key)
+            connection.execute('DELETE FROM victims WHERE collision_id IN (SELECT id FROM shard.collisions)')
+            connection.execute('DELETE FROM parties WHERE collision_id IN (SELECT id FROM shard.collisions)')
+            connection.execute('DELETE FROM collisions WHERE id IN (SELECT id FROM shard.collisions)')
+            for table in TABLES + ['source_collisions']:
+                connection.execute('INSERT INTO {0} SELECT * FROM shard.{0}'.format(table))
+            record_source_files(connection, source_files)
+    finally:
+        connection.execute('DETACH DATABASE shard')
+
+def read_data_in_parallel(connection, updates, batch_size, cache_size, jobs):
+    # Each worker parses one year into its own shard database. Shards are merged in
+    # the same order as the serial path, so the result is identical. They go in
+    # the system's temporary directory rather than the city directory, where the
+    # shards of an interrupted run would be mistaken for a year of records.
+    shard_directory = tempfile.mkdtemp(prefix='switrs-shards-')
+    try:
+        # Workers forked while the parent profiles would inherit its profiler.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=profiling.disable) as executor:
+            shards = [(executor.submit(build_shard, source,
+                                       os.path.join(shard_directory, '{0}.db'.format(index)),
+                                       batch_size, cache_size), source.key, source_files)
+                      for (index, (source, source_files)) in enumerate(updates)]
+            for (shard, directory_key, source_files) in shards:
+                (shard_name, errors) = shard.result()
+                report_parse_errors(directory_key, errors)
+                merge_shard(connection, shard_name, directory_key, source_files)
+                os.remove(shard_name)
+    finally:
+        shutil.rmtree(shard_directory, ignore_errors=True)
+
+def open_database(database_name, rebuild):
+    if os.path.exists(database_name) and not rebuild:
+        connection = sqlite3.connect(database_name)
+        has_tables = connection.execute('SELECT count(*) FROM sqlite_master').fetchone()[0] > 0
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if not has_tables or version == SCHEMA_VERSION:
+            return connection
+        print('{0} was created by an older version of this script, rebuilding'.format(database_name))
+        connection.close()
+
+    if os.path.exists(database_name):
+        os.remove(database_name)
+    return sqlite3.connect(database_name)
+
+def update_database(database_name, city_directory, batch_size=DEFAULT_BATCH_SIZE,
+                    journal_mode=DEFAULT_JOURNAL_MODE, synchronous=DEFAULT_SYNCHRONOUS,
+                    cache_size=DEFAULT_CACHE_SIZE, jobs=1, rebuild=False):
+    connection = open_database(database_name, rebuild)
+    try:
+        configure_for_bulk_load(connection, journal_mode, synchronous, cache_size)
+        create_tables(connection)
+
+        with profiling.phase('scan'):
+            year_sources = archives.find_year_sources(city_directory, SOURCE_FILES)
+            directory_keys = set(source.key for source in year_sources)
+            removed_keys = set(directory_key for (directory_key,) in
+                               connection.execute('SELECT DISTINCT directory FROM source_files').fetchall()
+                               if directory_key not in directory_keys)
+
+            examined = [(source,) + examine_source_files(connection, city_directory, source)
+                        for source in year_sources]
+            changed_keys = set(source.key for (source, changed, source_files) in examined if changed)
+            changed_keys |= overlapping_directories(connection, changed_keys | removed_keys)
+
+            for directory_key in sorted(removed_keys):
+                print('Removing data from {0}'.format(directory_key))
+                with connection:
+                    remove_data_from_directory(connection, directory_key)
+
+            updates = []
+            for (source, changed, source_files) in examined:
+                if source.key in changed_keys:
+                    updates.append((source, source_files))
+                else:
+                    # Keep the recorded modification times current, so the next run
+                    # does not need to hash these files again.
+                    with connection:
+                        record_source_files(connection, source_files)
+
+        with profiling.phase('load'):
+            if not updates:
+                print('{0} is up to date'.format(database_name))
+            else:
+                # Collisions are loaded without the spatial index and its triggers,
+                # and the index is built again from scratch in the index phase.
+                with connection:
+                    spatial.drop_spatial_index(connection)
+                if jobs > 1:
+                    read_data_in_parallel(connection, updates, batch_size, cache_size, jobs)
+                else:
+                    for (source, source_files) in updates:
+                        with connection:
+                            remove_data_from_directory(connection, source.key)
+                            errors = read_data_from_directory(connection, source, batch_size)
+                            record_source_files(connection, source_files)
+                        report_parse_errors(source.key, errors)
+
+        with profiling.phase('index'):
+            create_indexes(connection)
+            with connection:
+                spatial.create_spatial_index(connection)
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Collect SWITRS records for a city into all-collisions.db.')
+    parser.add_argument('city_directory',
+                        help='directory containing one subdirectory or zip archive of SWITRS records per year')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of rows sent to SQLite per executemany call (default: %(default)s)')
+    parser.add_argument('--journal-mode', default=DEFAULT_JOURNAL_MODE, choices=JOURNAL_MODES,
+                        help='SQLite journal mode used during the load (default: %(default)s)')
+    parser.add_argument('--synchronous', default=DEFAULT_SYNCHRONOUS, choices=SYNCHRONOUS_MODES,
+                        help='SQLite synchronous setting used during the load (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='SQLite page cache size in KiB (default: %(default)s)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='discard the existing database instead of only loading new or changed years')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of year directories to parse in parallel worker processes (default: %(default)s)')
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.enable(args.profile, 'collect')
 
-    create_database(os.path.join(city_directory, 'all-collisions.db'))
+    update_database(os.path.join(args.city_directory, 'all-collisions.db'),
+                    args.city_directory,
+                    batch_size=args.batch_size,
+                    journal_mode=args.journal_mode,
+                    synchronous=args.synchronous,
+                    cache_size=args.cache_size,
+                    jobs=args.jobs,
+                    rebuild=args.rebuild)
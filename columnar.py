@@ -0,0 +1,96 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A packed columnar file format that the UI can read into typed arrays without
+# copying. A file is a little-endian uint32 header length, a JSON header and then
+# the column data. The header describes every column by its typed array type,
+# byte offset and number of values, along with any other metadata. Columns are
+# aligned to 8 bytes so that every typed array can be a view into the file.
+
+import array
+import json
+import struct
+import sys
+
+ALIGNMENT = 8
+
+# Typed array types and the matching array module type codes.
+TYPES = {
+    'Int8': 'b',
+    'Uint8': 'B',
+    'Int16': 'h',
+    'Uint16': 'H',
+    'Int32': 'i',
+    'Uint32': 'I',
+    'Float32': 'f',
+    'Float64': 'd',
+}
+
+
+def padding(length):
+    return -length % ALIGNMENT
+
+
+# Columns are given as (name, type, values) tuples, where type is one of TYPES.
+def encode_columns(columns, metadata=None):
+    header = dict(metadata or {})
+    header['columns'] = {}
+
+    data = []
+    for (name, column_type, values) in columns:
+        values = array.array(TYPES[column_type], values)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        data.append((name, column_type, len(values), values.tobytes()))
+
+    # Column offsets depend on the size of the header, which in turn depends on
+    # the offsets, so lay the columns out until the header size settles.
+    header_length = 0
+    while True:
+        offset = 4 + header_length + padding(4 + header_length)
+        for (name, column_type, length, column_bytes) in data:
+            header['columns'][name] = {'type': column_type, 'offset': offset, 'length': length}
+            offset += len(column_bytes) + padding(len(column_bytes))
+        header_bytes = json.dumps(header, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        if len(header_bytes) == header_length:
+            break
+        header_length = len(header_bytes)
+
+    chunks = [struct.pack('<I', len(header_bytes)), header_bytes, b'\0' * padding(4 + len(header_bytes))]
+    for (name, column_type, length, column_bytes) in data:
+        chunks.append(column_bytes)
+        chunks.append(b'\0' * padding(len(column_bytes)))
+    return b''.join(chunks)
+
+
+def write_columns(path, columns, metadata=None):
+    data = encode_columns(columns, metadata)
+    with open(path, 'wb') as columns_file:
+        columns_file.write(data)
+    return len(data)
+
+
+# Returns the header metadata, with 'columns' mapping each name to an array.
+def decode_columns(data):
+    (header_length,) = struct.unpack_from('<I', data, 0)
+    header = json.loads(data[4:4 + header_length].decode('utf-8'))
+    columns = {}
+    for (name, column) in header['columns'].items():
+        values = array.array(TYPES[column['type']])
+        values.frombytes(data[column['offset']:column['offset'] + column['length'] * values.itemsize])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        columns[name] = values
+    header['columns'] = columns
+    return header
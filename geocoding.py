@@ -0,0 +1,222 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import json
+import re
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+class GeocodingError(Exception):
+    pass
+
+
+# Raised when a backend definitively knows nothing about an address. These
+# failures are cached, while any other error is retried.
+class NoResultError(GeocodingError):
+    pass
+
+
+class GoogleBackend(object):
+    def __init__(self):
+        # Only needed when actually geocoding with Google.
+        from googlegeocoder import GoogleGeocoder
+        self.geocoder = GoogleGeocoder()
+
+    def geocode(self, address):
+        try:
+            search = self.geocoder.get(address)
+        except ValueError as error:
+            # googlegeocoder reports the API status as a ValueError.
+            if 'ZERO_RESULTS' in str(error):
+                raise NoResultError(address)
+            raise
+        if not search:
+            raise NoResultError(address)
+        return [search[0].geometry.location.lat, search[0].geometry.location.lng]
+
+
+# Queries any HTTP geocoder that takes the address as a URL parameter, such as
+# Nominatim or a local stub server. The URL is a template with an {address}
+# placeholder. Responses may be a [latitude, longitude] pair, an object with
+# lat and lng (or lon) members, or a list of such objects of which the first
+# is used. An empty list or a 404 means that there is no result.
+class HTTPBackend(object):
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def geocode(self, address):
+        url = self.url.format(address=urllib.parse.quote(address))
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                result = json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                raise NoResultError(address)
+            raise
+
+        if isinstance(result, list) and result and isinstance(result[0], dict):
+            result = result[0]
+        if isinstance(result, dict):
+            return [float(result['lat']), float(result['lng'] if 'lng' in result else result['lon'])]
+        if isinstance(result, list) and len(result) == 2:
+            return [float(result[0]), float(result[1])]
+        raise NoResultError(address)
+
+
+# A token bucket shared by all worker threads. Each request takes one token, and
+# tokens are refilled at a fixed rate up to the size of the bucket, which allows
+# short bursts while keeping the average rate fixed.
+class TokenBucket(object):
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Geocodes many addresses at once with a pool of worker threads. Requests are
+# rate limited by a token bucket, identical addresses are only sent once, and
+# requests that fail with anything other than NoResultError are retried with
+# exponential backoff.
+class GeocodingPipeline(object):
+    def __init__(self, backend, rate=5.0, burst=1, workers=4, retries=3, backoff=1.0):
+        self.backend = backend
+        self.bucket = TokenBucket(rate, burst)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+    def geocode(self, address):
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                return self.backend.geocode(address)
+            except NoResultError:
+                raise
+            except Exception:
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * (2 ** attempt))
+
+    # Yields (address, location, error) for every unique address as soon as it
+    # is resolved. The location is None when there was no result or an error.
+    def geocode_all(self, addresses):
+        unique_addresses = list(dict.fromkeys(addresses))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = dict((executor.submit(self.geocode, address), address) for address in unique_addresses)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    yield (futures[future], future.result(), None)
+                except Exception as error:
+                    yield (futures[future], None, error)
+
+
+# Reduces an intersection string to the form used as a cache key, so that the
+# same intersection is only geocoded once however SWITRS happens to spell it:
+# "MARKET ST  and 10th st" and "10TH ST and MARKET ST" share one key.
+def normalize_location_key(location_key):
+    roads = [re.sub(r'\s+', ' ', road).strip().upper() for road in location_key.split(' and ')]
+    return ' and '.join(sorted(road for road in roads if road))
+
+
+# A geocode cache stored in SQLite. Every lookup reads only the row it needs and
+# every new location is committed as soon as it arrives, so an interrupted run
+# keeps what it has already paid for. Entries live in a namespace, usually the
+# city name, so one cache can be shared between cities. Locations that could not
+# be geocoded are stored with no coordinates.
+class LocationCache(object):
+    def __init__(self, path, namespace):
+        self.namespace = namespace
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS locations(' + \
+            'namespace text, ' + \
+            'normalized_key text, ' + \
+            'location_key text, ' + \
+            'latitude real, ' + \
+            'longitude real, ' + \
+            'updated integer, ' + \
+            'PRIMARY KEY (namespace, normalized_key))')
+        self.connection.commit()
+        self.memo = {}
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM locations WHERE namespace = ?',
+                                       (self.namespace,)).fetchone()[0]
+
+    def lookup(self, location_key):
+        normalized_key = normalize_location_key(location_key)
+        if normalized_key not in self.memo:
+            row = self.connection.execute('SELECT latitude, longitude FROM locations ' + \
+                                          'WHERE namespace = ? AND normalized_key = ?',
+                                          (self.namespace, normalized_key)).fetchone()
+            if row is None:
+                return (False, None)
+            self.memo[normalized_key] = None if row[0] is None else [row[0], row[1]]
+        return (True, self.memo[normalized_key])
+
+    def __contains__(self, location_key):
+        return self.lookup(location_key)[0]
+
+    def items(self):
+        for (location_key, latitude, longitude) in self.connection.execute(
+                'SELECT location_key, latitude, longitude FROM locations ' + \
+                'WHERE namespace = ? AND latitude IS NOT NULL', (self.namespace,)):
+            yield (location_key, [latitude, longitude])
+
+    def get(self, location_key):
+        return self.lookup(location_key)[1]
+
+    def store_many(self, locations):
+        rows = []
+        for (location_key, location) in locations:
+            normalized_key = normalize_location_key(location_key)
+            self.memo[normalized_key] = location
+            (latitude, longitude) = location if location is not None else (None, None)
+            rows.append((self.namespace, normalized_key, location_key, latitude, longitude, int(time.time())))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def store(self, location_key, location):
+        self.store_many([(location_key, location)])
+
+    def import_json(self, path):
+        with open(path, 'r') as location_file:
+            locations = json.loads(location_file.read())
+        self.store_many(sorted(locations.items()))
+        return len(locations)
@@ -0,0 +1,131 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Ranks the places with the most harmful collisions. Collisions found through the
+# spatial index are binned into square cells of a grid measured in meters, and
+# every collision adds a weight for its severity plus a weight for the injury
+# of each of its victims to its cell. Cells are ranked by their total weight,
+# optionally smoothed with a Gaussian kernel over the neighbouring cells, so a
+# cluster of collisions that straddles a cell boundary still ranks as one place.
+
+import collections
+import math
+import spatial
+import switrs
+
+# Weights by collision_severity and by victim degree_of_injury, which share the
+# same codes: 1 fatal, 2 severe injury, 3 other visible injury, 4 complaint of
+# pain and 0 property damage only or no injury.
+SEVERITY_WEIGHTS = {1: 10.0, 2: 5.0, 3: 2.0, 4: 1.0, 0: 0.5}
+INJURY_WEIGHTS = {1: 10.0, 2: 5.0, 3: 2.0, 4: 1.0, 0: 0.0}
+
+DEFAULT_CELL_SIZE = 50.0
+
+# Only the columns needed for ranking are read, since reading whole rows of the
+# wide collisions table takes far longer than the index lookup itself.
+WeightedCollision = collections.namedtuple('WeightedCollision', ['latitude', 'longitude', 'collision_severity',
+                                                                 'killed_count', 'injured_count', 'primary_road',
+                                                                 'secondary_road', 'weight'])
+COLUMNS = ', '.join('c.' + name for name in WeightedCollision._fields[:-1])
+
+Hotspot = collections.namedtuple('Hotspot', ['score', 'latitude', 'longitude', 'location', 'collisions',
+                                             'killed', 'injured', 'weight'])
+
+
+def injury_weight_column(injury_weights):
+    cases = ' '.join('WHEN {0} THEN {1!r}'.format(code, float(weight)) for (code, weight) in sorted(injury_weights.items()))
+    return '(SELECT coalesce(sum(CASE v.degree_of_injury {0} ELSE 0 END), 0) '.format(cases) + \
+           'FROM victims AS v WHERE v.collision_id = c.id)'
+
+
+# Returns a WeightedCollision for every located collision in a (south, west,
+# north, east) box, or in the whole database when bbox is None.
+def weighted_collisions(connection, bbox=None, where=None, parameters=(),
+                        severity_weights=SEVERITY_WEIGHTS, injury_weights=INJURY_WEIGHTS):
+    if bbox is None:
+        bbox = (-90.0, -180.0, 90.0, 180.0)
+    rows = spatial.collisions_in_bbox(connection, *bbox, columns=COLUMNS + ', ' + injury_weight_column(injury_weights),
+                                      where=where, parameters=parameters)
+    return [WeightedCollision._make(row[:-1] + (severity_weights.get(row[2], 0.0) + row[-1],)) for row in rows]
+
+
+class Grid(object):
+    def __init__(self, cell_size, reference_latitude):
+        self.cell_size = cell_size
+        self.meters_per_degree = math.radians(spatial.EARTH_RADIUS)
+        self.longitude_scale = math.cos(math.radians(reference_latitude))
+
+    def cell(self, latitude, longitude):
+        return (int(math.floor(latitude * self.meters_per_degree / self.cell_size)),
+                int(math.floor(longitude * self.meters_per_degree * self.longitude_scale / self.cell_size)))
+
+
+class Cell(object):
+    def __init__(self):
+        self.weight = 0.0
+        self.latitude = 0.0
+        self.longitude = 0.0
+        self.collisions = 0
+        self.killed = 0
+        self.injured = 0
+        self.locations = collections.Counter()
+
+    def add(self, collision):
+        self.weight += collision.weight
+        self.latitude += collision.latitude
+        self.longitude += collision.longitude
+        self.collisions += 1
+        self.killed += collision.killed_count or 0
+        self.injured += collision.injured_count or 0
+        self.locations[switrs.intersection_string(collision.primary_road, collision.secondary_road)] += 1
+
+
+# Returns the score of every cell: its own weight when bandwidth is zero, and
+# otherwise the weights of the cells within three bandwidths of it, each scaled
+# by a Gaussian of the distance between the cell centers.
+def smoothed_scores(cells, cell_size, bandwidth):
+    if bandwidth <= 0:
+        return dict((key, cell.weight) for (key, cell) in cells.items())
+
+    reach = int(math.ceil(3 * bandwidth / cell_size))
+    kernel = {}
+    for row_offset in range(-reach, reach + 1):
+        for column_offset in range(-reach, reach + 1):
+            squared_distance = (row_offset ** 2 + column_offset ** 2) * cell_size ** 2
+            if squared_distance <= (3 * bandwidth) ** 2:
+                kernel[(row_offset, column_offset)] = math.exp(-squared_distance / (2 * bandwidth ** 2))
+
+    scores = collections.defaultdict(float)
+    for ((row, column), cell) in cells.items():
+        for ((row_offset, column_offset), factor) in kernel.items():
+            scores[(row + row_offset, column + column_offset)] += cell.weight * factor
+    return dict((key, scores[key]) for key in cells)
+
+
+def rank_hotspots(weighted, cell_size=DEFAULT_CELL_SIZE, bandwidth=0.0, limit=50):
+    if not weighted:
+        return []
+
+    reference_latitude = sum(collision.latitude for collision in weighted) / len(weighted)
+    grid = Grid(cell_size, reference_latitude)
+    cells = collections.defaultdict(Cell)
+    for collision in weighted:
+        cells[grid.cell(collision.latitude, collision.longitude)].add(collision)
+
+    scores = smoothed_scores(cells, cell_size, bandwidth)
+    ranked = sorted(cells, key=lambda key: (-scores[key], key))[:limit]
+    return [Hotspot(scores[key], cells[key].latitude / cells[key].collisions, cells[key].longitude / cells[key].collisions,
+                    cells[key].locations.most_common(1)[0][0], cells[key].collisions,
+                    cells[key].killed, cells[key].injured, cells[key].weight)
+            for key in ranked]
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import geocoding
+import os
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import a locations.json geocode cache into an SQLite location cache.')
+    parser.add_argument('json_file', help='locations.json file mapping intersection strings to [latitude, longitude]')
+    parser.add_argument('--location-cache',
+                        help='SQLite location cache to import into (default: locations.db next to the JSON file)')
+    parser.add_argument('--namespace',
+                        help='namespace for the imported locations (default: name of the directory holding the JSON file)')
+    args = parser.parse_args()
+
+    directory = os.path.dirname(os.path.abspath(args.json_file))
+    cache = geocoding.LocationCache(args.location_cache or os.path.join(directory, 'locations.db'),
+                                    args.namespace or os.path.basename(directory))
+    try:
+        print('Imported {0} locations'.format(cache.import_json(args.json_file)))
+    finally:
+        cache.close()
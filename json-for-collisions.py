@@ -14,31 +14,140 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import calendar
+# Exports the bike and pedestrian collisions of every jurisdiction for the map UI
+# as a manifest.json that lists the jurisdictions, and for each jurisdiction a
+# directory of content-hashed columnar tiles with a manifest of them. The tiles
+# are written as the collisions stream out of SQLite, and jurisdictions whose
+# input has not changed are not written again. This replaced the per-year JSON
+# files and markers.js, which the UI no longer reads, so they are not written.
+
+import argparse
+import assets
 import collections
+import columnar
+import concurrent.futures
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
+import jurisdictions
+import markers
 import os
+import profiling
+import shutil
 import sqlite3
 import switrs
-import sys
+import tiles
+import urllib.parse
+
+# Bike (G) and pedestrian (B) collisions are the only ones shown on the map.
+BIKE_AND_PEDESTRIAN = "motor_vehicle_with IN ('G', 'B')"
+
+# Collisions whose date or time could not be parsed cannot be placed on the timeline.
+EXPORTED = BIKE_AND_PEDESTRIAN + ' AND timestamp IS NOT NULL'
+
+# The columns that the exported files are made from. Change EXPORT_VERSION
+# whenever these or the exported files change for the same collisions, so that
+# the next export does not skip any jurisdiction. See input_fingerprint.
+EXPORT_VERSION = 2
+FINGERPRINT_COLUMNS = ['id', 'motor_vehicle_with', 'primary_road', 'secondary_road', 'latitude', 'longitude', 'timestamp']
+FINGERPRINT_VICTIM_COLUMNS = ['age', 'sex', 'degree_of_injury']
+
+FINGERPRINT_BATCH_SIZE = 1000
+INSERT_BATCH_SIZE = 10000
+
+# The first of two passes over a jurisdiction's collisions, which only reads
+# their locations to give each collision its marker. Clustered markers are placed
+# at the center of all of their collisions, so no marker has a tile until every
+# collision has been seen. Each collision's marker, year and position in rowid
+# order across the databases go into a temporary table of its database's
+# connection for read_collisions_by_tile. A collision in more than one database
+# is only read from the first. Returns the years with collisions.
+def assign_markers(connections, where, parameters, marker_index):
+    seen = set()
+    years = set()
+    sequence = 0
+    for connection in connections:
+        connection.execute('CREATE TEMP TABLE export_markers ' + \
+                           '(collision_rowid INTEGER PRIMARY KEY, marker INTEGER, year INTEGER, sequence INTEGER);')
+        rows = []
+        for (rowid, collision_id, latitude, longitude, timestamp) in connection.execute(
+                'SELECT rowid, id, latitude, longitude, timestamp FROM collisions WHERE {0} ORDER BY rowid;'.format(where),
+                parameters):
+            if len(connections) > 1:
+                if collision_id in seen:
+                    continue
+                seen.add(collision_id)
+
+            year = timestamp_year(timestamp)
+            years.add(year)
+            rows.append((rowid, marker_index.index_for_location(float(latitude), float(longitude)), year, sequence))
+            sequence += 1
+            if len(rows) >= INSERT_BATCH_SIZE:
+                connection.executemany('INSERT INTO export_markers VALUES (?, ?, ?, ?);', rows)
+                rows = []
+        connection.executemany('INSERT INTO export_markers VALUES (?, ?, ?, ?);', rows)
+    return sorted(years)
+
+def create_marker_tiles(connection, marker_locations, zoom):
+    connection.execute('CREATE TEMP TABLE export_tiles (marker INTEGER PRIMARY KEY, tile_order INTEGER, '
+                       'x INTEGER, y INTEGER);')
+    rows = []
+    for (marker, location) in enumerate(marker_locations):
+        tile = tiles.tile_for_location(location[0], location[1], zoom)
+        rows.append((marker, tiles.tile_order(tile)) + tile)
+    connection.executemany('INSERT INTO export_tiles VALUES (?, ?, ?, ?);', rows)
 
-YEARS = [2008, 2009, 2010, 2011, 2012, 2013]
+# The second pass, which reads whole collisions with their victims attached from
+# a second query in the same order, so only one collision is held at a time.
+# Collisions come ordered by the detail tile of their marker, in tiles.tile_order,
+# then by year and then as in assign_markers, as (tile order, tile, year,
+# sequence, marker, collision).
+def read_collisions_by_tile(connection):
+    tables = 'FROM temp.export_markers AS m JOIN temp.export_tiles AS t ON t.marker = m.marker ' + \
+             'JOIN collisions AS c ON c.rowid = m.collision_rowid '
+    order = 'ORDER BY t.tile_order, m.year, m.sequence'
+    victim_rows = connection.execute('SELECT m.sequence, v.* ' + tables + \
+                                     'JOIN victims AS v ON v.collision_id = c.id ' + order + ', v.rowid;')
+    victim_row = next(victim_rows, None)
+    for row in connection.execute('SELECT t.tile_order, t.x, t.y, m.year, m.sequence, m.marker, c.* ' + \
+                                  tables + order + ';'):
+        collision = switrs.Collision(row[6:])
+        while victim_row is not None and victim_row[0] == row[4]:
+            collision.victims.append(switrs.Victim(victim_row[1:]))
+            victim_row = next(victim_rows, None)
+        yield (row[0], (row[1], row[2]), row[3], row[4], row[5], collision)
 
-def read_all_data_from_database(city_directory):
-    connection = sqlite3.connect(os.path.join(city_directory, "all-collisions.db"))
-    for row in connection.execute('SELECT * FROM collisions;'):
-        switrs.Collision(row)
-    for party in [switrs.Party(row) for row in connection.execute('SELECT * FROM parties;')]:
-        switrs.Collision.collisions[party.collision_id].parties.append(party)
-    for victim in [switrs.Victim(row) for row in connection.execute('SELECT * FROM victims;')]:
-        switrs.Collision.collisions[victim.collision_id].victims.append(victim)
-    connection.close()
+# A digest of everything an export of these collisions depends on: the export
+# options, EXPORT_VERSION and the columns the export reads from the collisions
+# and their victims, so that geocoding or reloading a single collision changes
+# it. Only reading those columns makes this much cheaper than an export.
+def input_fingerprint(database_paths, where, parameters, options):
+    digest = hashlib.sha1(json.dumps([EXPORT_VERSION, options]).encode('utf-8'))
+    collision_columns = ', '.join('collisions.' + column for column in FINGERPRINT_COLUMNS)
+    victim_columns = ', '.join('victims.' + column for column in FINGERPRINT_VICTIM_COLUMNS)
+    for database_path in database_paths:
+        connection = sqlite3.connect('file:{0}?mode=ro'.format(urllib.parse.quote(database_path)), uri=True)
+        try:
+            for query in ['SELECT {0} FROM collisions WHERE {{0}} ORDER BY rowid;'.format(collision_columns),
+                          'SELECT collisions.id, {0} FROM victims '.format(victim_columns) + \
+                          'JOIN collisions ON collisions.id = victims.collision_id ' + \
+                          'WHERE {0} ORDER BY collisions.rowid, victims.rowid;']:
+                digest.update(query.encode('utf-8'))
+                cursor = connection.execute(query.format(where), parameters)
+                rows = cursor.fetchmany(FINGERPRINT_BATCH_SIZE)
+                while rows:
+                    digest.update(repr(rows).encode('utf-8'))
+                    rows = cursor.fetchmany(FINGERPRINT_BATCH_SIZE)
+        finally:
+            connection.close()
+    return digest.hexdigest()
 
-def find_all_bike_and_pedestrian_collision():
-    for collision in switrs.Collision.collisions.values():
-        if collision.motor_vehicle_with == 'G' or collision.motor_vehicle_with == 'B':
-            yield collision
+# Timestamps are the reported local date and time as if it were UTC. See
+# switrs.collision_timestamp.
+def timestamp_year(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).year
 
 def collision_type_as_number(collision):
     if collision.motor_vehicle_with == 'B': # pedestrian
@@ -54,51 +163,421 @@ def victim_sex_as_number(victim):
         return 1
     return 2
 
-def get_marker_index_for_collision(collision, markers):
-    location = [float(collision.latitude), float(collision.longitude)]
-    for (i, marker) in enumerate(markers):
-        if marker == location:
-            return i
+# Collect stores ages and injuries that are blank or malformed as NULL. They are
+# exported as SWITRS codes them when they are not stated: age 998 and no injury,
+# which the UI counts as other.
+UNSTATED_AGE = 998
+UNSTATED_INJURY = 0
+
+# These match AGE_GROUPS.ranges and TIMES_OF_DAY in ui/main.js.
+AGE_GROUP_LIMITS = [14, 24, 49, 75, 150]
+
+def age_group(age):
+    for (group, limit) in enumerate(AGE_GROUP_LIMITS):
+        if age <= limit:
+            return group
+    return len(AGE_GROUP_LIMITS)
+
+def time_of_day(hour):
+    if hour <= 5:
+        return 3
+    if hour <= 11:
+        return 0
+    if hour <= 17:
+        return 1
+    return 2
+
+# SWITRS numbers injuries from the most severe, 1 for killed, down to 4 for
+# complaint of pain, and uses 0 for no injury. The UI orders injuries from most
+# severe (fatal, 0) to least severe (other, 4), so 1-4 shift down by one and 0
+# goes last.
+def injury_severity(degree_of_injury):
+    if degree_of_injury == 0:
+        return 4
+    return degree_of_injury - 1
+
+def encode_collision_columns(collisions):
+    intersections = []
+    intersection_indices = {}
+    victim_offsets = [0]
+    victims = []
+    for collision in collisions:
+        if collision['intersection'] not in intersection_indices:
+            intersection_indices[collision['intersection']] = len(intersections)
+            intersections.append(collision['intersection'])
+        victims.extend(collision['victims'])
+        victim_offsets.append(len(victims))
+
+    # The victims of collision i are those from victim_offsets[i] up to
+    # victim_offsets[i + 1]. Intersections are indices into a string table.
+    return columnar.encode_columns([
+        ('type', 'Uint8', [collision['type'] for collision in collisions]),
+        ('marker', 'Uint32', [collision['marker'] for collision in collisions]),
+        ('time', 'Uint32', [collision['time'] for collision in collisions]),
+        ('intersection', 'Uint32', [intersection_indices[collision['intersection']] for collision in collisions]),
+        ('victim_offsets', 'Uint32', victim_offsets),
+        ('victim_age', 'Uint16', [victim['age'] for victim in victims]),
+        ('victim_sex', 'Uint8', [victim['sex'] for victim in victims]),
+        ('victim_injury', 'Uint8', [victim['injury'] for victim in victims]),
+    ], {'intersections': intersections})
+
+# Groups collisions into cells that are indistinguishable to the UI's filters:
+# the same marker, year, type, time of day and combination of victims. The UI
+# answers a filter change by summing cell counts instead of visiting every
+# collision and victim.
+def build_filter_cube(collisions):
+    cells = collections.OrderedDict()
+    for (year, collision) in collisions:
+        victims = tuple(sorted((victim['sex'], age_group(victim['age']), injury_severity(victim['injury']))
+                               for victim in collision['victims']))
+        key = (collision['marker'], year, collision['type'], time_of_day(collision['time'] // 3600 % 24), victims)
+        cells[key] = cells.get(key, 0) + 1
+    return cells
+
+def filter_cube_columns(cells):
+    victim_offsets = [0]
+    victims = []
+    for key in cells:
+        victims.extend(key[4])
+        victim_offsets.append(len(victims))
+
+    # The victims of cell i are those from victim_offsets[i] up to
+    # victim_offsets[i + 1], and stand for the victims of each of its collisions.
+    return [
+        ('marker', 'Uint32', [key[0] for key in cells]),
+        ('year', 'Uint16', [key[1] for key in cells]),
+        ('type', 'Uint8', [key[2] for key in cells]),
+        ('time_of_day', 'Uint8', [key[3] for key in cells]),
+        ('count', 'Uint32', list(cells.values())),
+        ('victim_offsets', 'Uint32', victim_offsets),
+        ('victim_sex', 'Uint8', [victim[0] for victim in victims]),
+        ('victim_age_group', 'Uint8', [victim[1] for victim in victims]),
+        ('victim_injury', 'Uint8', [victim[2] for victim in victims]),
+    ]
+
+# The markers and filter cube cells that fall in one tile. Marker indices in a
+# tile's cells and collisions are local to the tile. Below the detail zoom, a
+# tile's markers are clusters placed at the center of the collisions they hold.
+class Tile(object):
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.marker_indices = {}
+        self.markers = []
+        self.cells = collections.OrderedDict()
+        self.collisions = []
+
+    def add_cell(self, group, location, key, count):
+        index = self.marker_indices.get(group)
+        if index is None:
+            index = len(self.markers)
+            self.marker_indices[group] = index
+            self.markers.append([location, 0.0, 0.0, 0])
+
+        marker = self.markers[index]
+        marker[1] += location[0] * count
+        marker[2] += location[1] * count
+        marker[3] += count
+
+        key = (index,) + key[1:]
+        self.cells[key] = self.cells.get(key, 0) + count
+
+    def marker_locations(self):
+        if not self.cluster:
+            return [marker[0] for marker in self.markers]
+        return [[latitude / count, longitude / count] for (location, latitude, longitude, count) in self.markers]
+
+    # Returns the names of the tile and of its collisions, or None when it has
+    # no collisions.
+    def write(self, directory, name):
+        locations = self.marker_locations()
+        tile_name = assets.write_hashed(directory, name + '.{hash}.bin', columnar.encode_columns([
+            ('latitude', 'Float64', [location[0] for location in locations]),
+            ('longitude', 'Float64', [location[1] for location in locations]),
+        ] + filter_cube_columns(self.cells)))
+
+        collisions_name = None
+        if self.collisions:
+            collisions_name = assets.write_hashed(directory, name + '-collisions.{hash}.bin',
+                                                  encode_collision_columns(self.collisions))
+        return (tile_name, collisions_name)
+
+def add_cells_to_tiles(zoom_tiles, cells, marker_locations, zoom, cluster):
+    for (key, count) in cells.items():
+        location = marker_locations[key[0]]
+        tile = tiles.tile_for_location(location[0], location[1], zoom)
+        if tile not in zoom_tiles:
+            zoom_tiles[tile] = Tile(cluster)
+
+        group = key[0]
+        if cluster:
+            group = tiles.cluster_for_location(location[0], location[1], zoom)
+        zoom_tiles[tile].add_cell(group, location, key, count)
 
-    markers.append(location)
-    return len(markers) - 1
+def add_collisions_to_tiles(zoom_tiles, collisions, marker_locations, zoom):
+    for (year, collision) in collisions:
+        location = marker_locations[collision['marker']]
+        tile = zoom_tiles[tiles.tile_for_location(location[0], location[1], zoom)]
+        tile_collision = dict(collision)
+        tile_collision['marker'] = tile.marker_indices[collision['marker']]
+        tile.collisions.append(tile_collision)
+
+# The hash in a tile name, which the manifest lists for the UI to fill in.
+def name_hash(name):
+    return name.rsplit('.', 2)[1]
+
+# Writes a pyramid of tiles from min_zoom to detail_zoom. The UI only fetches
+# the tiles that cover the map, and the collision details of a detail tile only
+# when one of its popups is opened. Collisions are given as (tile, year, record)
+# ordered by detail tile in tiles.tile_order, so each detail tile is written as
+# soon as its last collision is read, and each clustered tile as soon as the
+# detail tiles move out of it. Returns the tiles section of the manifest, which
+# maps each tile to the hash in its name.
+def write_tiles(output_directory, collisions, marker_locations, min_zoom, detail_zoom):
+    available = dict((str(zoom), {}) for zoom in range(min_zoom, detail_zoom + 1))
+    collision_hashes = {}
+
+    def write_tile(zoom, tile, data):
+        (tile_name, collisions_name) = data.write(output_directory, 'tiles/' + tiles.tile_name(zoom, tile))
+        available[str(zoom)]['{0}/{1}'.format(*tile)] = name_hash(tile_name)
+        if collisions_name is not None:
+            collision_hashes['{0}/{1}'.format(*tile)] = name_hash(collisions_name)
+
+    cluster_tiles = dict((zoom, {}) for zoom in range(min_zoom, detail_zoom))
+    for (tile, tile_collisions) in itertools.groupby(collisions, key=lambda collision: collision[0]):
+        tile_collisions = [(year, record) for (tile, year, record) in tile_collisions]
+        cells = build_filter_cube(tile_collisions)
+
+        detail_tiles = {}
+        add_cells_to_tiles(detail_tiles, cells, marker_locations, detail_zoom, False)
+        add_collisions_to_tiles(detail_tiles, tile_collisions, marker_locations, detail_zoom)
+        for (detail_tile, data) in detail_tiles.items():
+            write_tile(detail_zoom, detail_tile, data)
+
+        for (zoom, zoom_tiles) in cluster_tiles.items():
+            shift = detail_zoom - zoom
+            if (tile[0] >> shift, tile[1] >> shift) not in zoom_tiles:
+                for (cluster_tile, data) in zoom_tiles.items():
+                    write_tile(zoom, cluster_tile, data)
+                zoom_tiles.clear()
+            add_cells_to_tiles(zoom_tiles, cells, marker_locations, zoom, True)
+
+    for (zoom, zoom_tiles) in cluster_tiles.items():
+        for (tile, data) in zoom_tiles.items():
+            write_tile(zoom, tile, data)
+
+    return {'tiles': {
+        'url': 'tiles/{z}/{x}/{y}.{hash}.bin',
+        'collisions_url': 'tiles/{z}/{x}/{y}-collisions.{hash}.bin',
+        'min_zoom': min_zoom,
+        'detail_zoom': detail_zoom,
+        'available': available,
+        'collisions': collision_hashes,
+    }}
+
+# The names of every file a manifest refers to, relative to its directory.
+def manifest_files(manifest):
+    section = manifest['tiles']
+    files = []
+    for (zoom, available) in section['available'].items():
+        for (tile, tile_hash) in available.items():
+            (x, y) = tile.split('/')
+            files.append(section['url'].format(z=zoom, x=x, y=y, hash=tile_hash))
+            if int(zoom) == section['detail_zoom'] and tile in section['collisions']:
+                files.append(section['collisions_url'].format(z=zoom, x=x, y=y, hash=section['collisions'][tile]))
+    return files
+
+# Converts a collision to the record the UI reads.
+def collision_record(collision, marker):
+    victims = []
+    for victim in collision.victims:
+        victims.append({
+            'age': UNSTATED_AGE if victim.age is None else int(victim.age),
+            'sex': victim_sex_as_number(victim),
+            'injury': UNSTATED_INJURY if victim.degree_of_injury is None else int(victim.degree_of_injury),
+        })
+
+    return {
+        'type': collision_type_as_number(collision),
+        'intersection': collision.intersection_string(),
+        'marker': marker,
+        'time': collision.timestamp,
+        'victims': victims,
+    }
+
+def jurisdiction_directory(code):
+    return 'jurisdictions/{0}/'.format(code)
+
+# Describes an exported jurisdiction for the UI, which centers the map on it.
+# Every marker is counted once for each of its collisions.
+def jurisdiction_summary(jurisdiction, years, marker_index, manifest_name, fingerprint):
+    locations = marker_index.markers()
+    count = sum(marker_index.counts)
+    summary = collections.OrderedDict([
+        ('code', jurisdiction.code),
+        ('name', jurisdiction.name),
+        ('county', jurisdiction.county),
+        ('path', jurisdiction_directory(jurisdiction.code)),
+        ('manifest', manifest_name),
+        ('years', years),
+        ('collisions', count),
+    ])
+    if count:
+        weighted = list(zip(locations, marker_index.counts))
+        summary['center'] = [sum(location[0] * collisions for (location, collisions) in weighted) / count,
+                             sum(location[1] * collisions for (location, collisions) in weighted) / count]
+        summary['bounds'] = [[min(location[0] for location in locations), min(location[1] for location in locations)],
+                             [max(location[0] for location in locations), max(location[1] for location in locations)]]
+    summary['fingerprint'] = fingerprint
+    return summary
+
+# Exports the collisions of one jurisdiction into its own directory, unless the
+# previous export of it had the same input fingerprint and its manifest is still
+# there. Returns its summary and the files its manifest refers to, or None for
+# the files when it was skipped. This runs in worker processes, so it only takes
+# arguments that can be pickled.
+def export_jurisdiction(jurisdiction, output_directory, marker_options, min_zoom=tiles.DEFAULT_MIN_ZOOM,
+                        detail_zoom=tiles.DEFAULT_DETAIL_ZOOM, previous=None):
+    # Without statistics, SQLite only picks the county_city_location index when
+    # its term comes first, and otherwise scans every collision in rowid order.
+    where = 'county_city_location = ? AND ' + EXPORTED
+    parameters = (jurisdiction.code,)
+    directory = os.path.join(output_directory, jurisdiction_directory(jurisdiction.code))
+
+    with profiling.phase('fingerprint'):
+        fingerprint = input_fingerprint(jurisdiction.database_paths, where, parameters,
+                                        [list(marker_options), min_zoom, detail_zoom])
+    if previous is not None and previous.get('fingerprint') == fingerprint and \
+       os.path.isfile(os.path.join(directory, previous.get('manifest', ''))):
+        summary = collections.OrderedDict(previous)
+        summary['name'] = jurisdiction.name
+        return (summary, None)
+
+    marker_index = markers.MarkerIndex(*marker_options)
+    os.makedirs(directory, exist_ok=True)
+    connections = [sqlite3.connect('file:{0}?mode=ro'.format(urllib.parse.quote(database_path)), uri=True)
+                   for database_path in jurisdiction.database_paths]
+    try:
+        with profiling.phase('markers'):
+            years = assign_markers(connections, where, parameters, marker_index)
+            marker_locations = marker_index.markers()
+            for connection in connections:
+                create_marker_tiles(connection, marker_locations, detail_zoom)
+
+        with profiling.phase('tiles'):
+            collisions = heapq.merge(*[read_collisions_by_tile(connection) for connection in connections],
+                                     key=lambda collision: (collision[0], collision[2], collision[3]))
+            manifest = write_tiles(directory, ((tile, year, collision_record(collision, marker))
+                                               for (order, tile, year, sequence, marker, collision) in collisions),
+                                   marker_locations, min_zoom, detail_zoom)
+            manifest_name = assets.write_hashed(directory, 'manifest.{hash}.json',
+                                                json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    finally:
+        for connection in connections:
+            connection.close()
+    return (jurisdiction_summary(jurisdiction, years, marker_index, manifest_name, fingerprint),
+            manifest_files(manifest) + [manifest_name])
+
+def read_previous_summaries(output_directory):
+    try:
+        with open(os.path.join(output_directory, 'manifest.json'), 'r') as file:
+            return dict((summary['code'], summary) for summary in json.load(file)['jurisdictions'])
+    except (IOError, ValueError, KeyError, TypeError):
+        return {}
+
+def remove_stale_jurisdictions(output_directory, codes):
+    # Tiles written before each jurisdiction had its own directory.
+    if os.path.isdir(os.path.join(output_directory, 'tiles')):
+        shutil.rmtree(os.path.join(output_directory, 'tiles'))
+
+    # Only the directories of jurisdictions that are no longer exported are
+    # removed, leaving anything else that was put in the directory alone.
+    jurisdictions_directory = os.path.join(output_directory, 'jurisdictions')
+    for name in os.listdir(jurisdictions_directory):
+        path = os.path.join(jurisdictions_directory, name)
+        if jurisdictions.is_code(name) and name not in codes and os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+
+# Exports every jurisdiction found in the databases of the given city
+# directories. Each is an independent partition, so with more than one job they
+# are exported by a pool of worker processes, largest first so that a big city
+# does not start last and hold up the whole export. Jurisdictions whose input
+# has not changed since the last export are skipped unless force is set.
+#
+# manifest.json lists the jurisdictions for the UI, along with the name of the
+# content-hashed manifest of each, and is the only file an export overwrites. It
+# is replaced after every new file is written and before the files it no longer
+# refers to are removed, so the UI never finds a file missing.
+def export_cities(city_directories, marker_options, output_directory='ui', min_zoom=tiles.DEFAULT_MIN_ZOOM,
+                  detail_zoom=tiles.DEFAULT_DETAIL_ZOOM, jobs=1, names=None, force=False):
+    with profiling.phase('discover'):
+        found = jurisdictions.find_jurisdictions(city_directories, EXPORTED, names or {})
+    by_size = sorted(found, key=lambda jurisdiction: -sum(jurisdiction.years.values()))
+    arguments = (output_directory, marker_options, min_zoom, detail_zoom)
+    previous = {} if force else read_previous_summaries(output_directory)
+
+    def report(summary, files):
+        print('{0} {1}'.format('Exported' if files is not None else 'Unchanged', summary['name']))
+
+    results = {}
+    if jobs > 1 and len(found) > 1:
+        # Workers forked while the parent profiles would inherit its profiler.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=profiling.disable) as executor:
+            futures = [(jurisdiction.code, executor.submit(export_jurisdiction, jurisdiction, *arguments,
+                                                           previous=previous.get(jurisdiction.code)))
+                       for jurisdiction in by_size]
+            for (code, future) in futures:
+                results[code] = future.result()
+                report(*results[code])
+    else:
+        for jurisdiction in by_size:
+            results[jurisdiction.code] = export_jurisdiction(jurisdiction, *arguments,
+                                                             previous=previous.get(jurisdiction.code))
+            report(*results[jurisdiction.code])
+
+    # The UI numbers years from the first, so list every year up to the last.
+    years = [year for (summary, files) in results.values() for year in summary['years']]
+    index = collections.OrderedDict([
+        ('years', list(range(min(years), max(years) + 1)) if years else []),
+        ('jurisdictions', [results[jurisdiction.code][0] for jurisdiction in found]),
+    ])
+    temporary_path = os.path.join(output_directory, 'manifest.json.tmp')
+    with open(temporary_path, 'w') as file:
+        file.write(json.dumps(index))
+    os.replace(temporary_path, os.path.join(output_directory, 'manifest.json'))
+
+    os.makedirs(os.path.join(output_directory, 'jurisdictions'), exist_ok=True)
+    remove_stale_jurisdictions(output_directory, results)
+    for (code, (summary, files)) in results.items():
+        if files is not None:
+            assets.remove_unreferenced(os.path.join(output_directory, jurisdiction_directory(code)), files)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Must specify city directory")
-        sys.exit(1)
-
-    markers = []
-    collisions = collections.defaultdict(lambda: [])
-
-    read_all_data_from_database(sys.argv[1])
-
-    for collision in find_all_bike_and_pedestrian_collision():
-        victims = []
-        for victim in collision.victims:
-            victims.append({
-                'age': int(victim.age),
-                'sex': victim_sex_as_number(victim),
-                'injury': int(victim.degree_of_injury),
-            })
-
-        # No clue where this time comes from, but work around it for now.
-        if (collision.time == "2500"):
-            collision.time = "0000"
-
-        date = datetime.datetime.strptime(collision.date + collision.time, "%Y%m%d%H%M")
-        collision = {
-            'type': collision_type_as_number(collision),
-            'intersection': collision.intersection_string(),
-            'marker': get_marker_index_for_collision(collision, markers),
-            'time': calendar.timegm(date.utctimetuple()),
-            'victims': victims,
-        }
-        collisions[date.year].append(collision)
-
-    for year in YEARS:
-        with open(os.path.join('ui', 'oakland-' + str(year) + '.json'), 'w') as file:
-            file.write(json.dumps(collisions[year]))
-
-    with open(os.path.join('ui', 'markers.js'), 'w') as file:
-        file.write('Marker.addFromJSON(' + json.dumps(markers) + ');\n')
+    parser = argparse.ArgumentParser(description='Export bike and pedestrian collisions for the map UI.')
+    parser.add_argument('city_directories', nargs='+', metavar='city_directory',
+                        help='directories with an all-collisions.db, from one city up to every city in the state')
+    parser.add_argument('--output-directory', default='ui',
+                        help='directory of the UI to export into (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of jurisdictions to export in parallel worker processes (default: %(default)s)')
+    parser.add_argument('--names',
+                        help='CSV file of county_city_location code, name rows naming the jurisdictions in the UI')
+    parser.add_argument('--marker-precision', type=int, default=markers.DEFAULT_PRECISION,
+                        help='decimal places of latitude and longitude that distinguish two markers (default: %(default)s)')
+    parser.add_argument('--cluster-distance', type=float, default=None,
+                        help='merge collisions within grid cells of roughly this many meters into one marker')
+    parser.add_argument('--min-zoom', type=int, default=tiles.DEFAULT_MIN_ZOOM,
+                        help='lowest zoom level with clustered tiles (default: %(default)s)')
+    parser.add_argument('--detail-zoom', type=int, default=tiles.DEFAULT_DETAIL_ZOOM,
+                        help='zoom level of the tiles holding every marker and collision (default: %(default)s)')
+    parser.add_argument('--force', action='store_true',
+                        help='export every jurisdiction, even those whose collisions have not changed since the last export')
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.enable(args.profile, 'export')
+
+    if args.min_zoom > args.detail_zoom:
+        parser.error('--min-zoom must not be greater than --detail-zoom')
+
+    export_cities(args.city_directories, (args.marker_precision, args.cluster_distance),
+                  output_directory=args.output_directory, min_zoom=args.min_zoom, detail_zoom=args.detail_zoom, jobs=args.jobs,
+                  names=jurisdictions.read_names(args.names) if args.names else {}, force=args.force)
@@ -0,0 +1,114 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Jurisdictions are the places collisions happened in, identified by the SWITRS
+# county_city_location code. Its first two digits number the county, in the
+# same alphabetical order as the list below, and the last two the city within
+# the county, where 00 is the unincorporated part of the county. This is not
+# the jurisdiction field, which is the agency that wrote the report and, for
+# example, is the CHP for collisions on freeways within a city.
+
+import collections
+import csv
+import os
+import re
+import sqlite3
+import urllib.parse
+
+COUNTIES = [
+    'Alameda', 'Alpine', 'Amador', 'Butte', 'Calaveras', 'Colusa', 'Contra Costa', 'Del Norte',
+    'El Dorado', 'Fresno', 'Glenn', 'Humboldt', 'Imperial', 'Inyo', 'Kern', 'Kings', 'Lake',
+    'Lassen', 'Los Angeles', 'Madera', 'Marin', 'Mariposa', 'Mendocino', 'Merced', 'Modoc', 'Mono',
+    'Monterey', 'Napa', 'Nevada', 'Orange', 'Placer', 'Plumas', 'Riverside', 'Sacramento',
+    'San Benito', 'San Bernardino', 'San Diego', 'San Francisco', 'San Joaquin', 'San Luis Obispo',
+    'San Mateo', 'Santa Barbara', 'Santa Clara', 'Santa Cruz', 'Shasta', 'Sierra', 'Siskiyou',
+    'Solano', 'Sonoma', 'Stanislaus', 'Sutter', 'Tehama', 'Trinity', 'Tulare', 'Tuolumne',
+    'Ventura', 'Yolo', 'Yuba',
+]
+
+# Every code is four digits, which also makes codes safe to use as file names.
+CODE_FORMAT = re.compile(r'[0-9]{4}$')
+
+# The collisions of one jurisdiction, which may be spread over the databases of
+# several city directories, with the number of them in each year.
+Jurisdiction = collections.namedtuple('Jurisdiction', ['code', 'name', 'county', 'database_paths', 'years'])
+
+
+def is_code(value):
+    return CODE_FORMAT.match(value) is not None
+
+
+def county_name(code):
+    try:
+        return COUNTIES[int(code[:2]) - 1]
+    except (ValueError, IndexError):
+        return None
+
+
+# A code's name comes from the names file if it has one, and otherwise from the
+# directory of the database where it is the most common code, since a city's
+# directory holds mostly that city's collisions. Anything else is named by its
+# county.
+def jurisdiction_name(code, names, directory_names):
+    if code in names:
+        return names[code]
+    if code in directory_names:
+        return directory_names[code]
+    county = county_name(code)
+    if county is None:
+        return code
+    if code.endswith('00'):
+        return 'Unincorporated {0} County'.format(county)
+    return '{0} County {1}'.format(county, code)
+
+
+# Reads a CSV file of code, name rows.
+def read_names(path):
+    with open(path, 'r', newline='') as names_file:
+        return dict((row[0].strip(), row[1].strip()) for row in csv.reader(names_file) if len(row) >= 2)
+
+
+# Returns every jurisdiction with collisions matching where in the databases of
+# the given city directories, ordered by code. Collisions without a well-formed
+# code are left out.
+def find_jurisdictions(city_directories, where, names=None):
+    names = names or {}
+    years = collections.defaultdict(collections.Counter)
+    database_paths = collections.defaultdict(list)
+    directory_names = {}
+    for city_directory in city_directories:
+        database_path = os.path.join(city_directory, 'all-collisions.db')
+        connection = sqlite3.connect('file:{0}?mode=ro'.format(urllib.parse.quote(database_path)), uri=True)
+        try:
+            rows = connection.execute('SELECT county_city_location, date / 10000, count(*) FROM collisions ' + \
+                                      "WHERE {0} AND county_city_location <> '' ".format(where) + \
+                                      'GROUP BY 1, 2').fetchall()
+        finally:
+            connection.close()
+
+        totals = collections.Counter()
+        for (code, year, count) in rows:
+            if not is_code(code):
+                continue
+            years[code][year] += count
+            totals[code] += count
+            if database_path not in database_paths[code]:
+                database_paths[code].append(database_path)
+        if totals:
+            code = totals.most_common(1)[0][0]
+            directory_names.setdefault(code, os.path.basename(os.path.normpath(os.path.abspath(city_directory))))
+
+    return [Jurisdiction(code, jurisdiction_name(code, names, directory_names), county_name(code),
+                         database_paths[code], collections.OrderedDict(sorted(years[code].items())))
+            for code in sorted(years)]
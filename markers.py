@@ -0,0 +1,69 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+DEFAULT_PRECISION = 7
+METERS_PER_DEGREE_OF_LATITUDE = 111320.0
+
+
+# Assigns each collision location a stable marker index. Locations are hashed
+# after snapping them to a number of decimal places, so looking up a marker does
+# not depend on how many markers already exist. With a cluster distance, nearby
+# locations are instead grouped into grid cells of roughly that many meters and
+# share one marker placed at the center of the collisions it holds.
+class MarkerIndex(object):
+    def __init__(self, precision=DEFAULT_PRECISION, cluster_distance=None):
+        self.precision = precision
+        self.cluster_distance = cluster_distance
+        self.indices = {}
+        self.locations = []
+        self.sums = []
+        self.counts = []
+
+    def __len__(self):
+        return len(self.locations)
+
+    def key_for_location(self, latitude, longitude):
+        if not self.cluster_distance:
+            return (round(latitude, self.precision), round(longitude, self.precision))
+
+        # Cells are square on the ground, so they are wider in degrees of
+        # longitude the further they are from the equator.
+        cell_height = self.cluster_distance / METERS_PER_DEGREE_OF_LATITUDE
+        row = math.floor(latitude / cell_height)
+        row_latitude = math.radians((row + 0.5) * cell_height)
+        cell_width = cell_height / max(math.cos(row_latitude), 0.01)
+        return (row, math.floor(longitude / cell_width))
+
+    def index_for_location(self, latitude, longitude):
+        key = self.key_for_location(latitude, longitude)
+        index = self.indices.get(key)
+        if index is None:
+            index = len(self.locations)
+            self.indices[key] = index
+            self.locations.append([latitude, longitude])
+            self.sums.append([0.0, 0.0])
+            self.counts.append(0)
+
+        self.sums[index][0] += latitude
+        self.sums[index][1] += longitude
+        self.counts[index] += 1
+        return index
+
+    def markers(self):
+        if not self.cluster_distance:
+            return self.locations
+        return [[latitude / count, longitude / count]
+                for ((latitude, longitude), count) in zip(self.sums, self.counts)]
@@ -0,0 +1,91 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Opt-in timing and profiling of the phases of a pipeline stage. Stages wrap their
+# phases in profiling.phase(name), which does nothing until the script's --profile
+# option enables it. Once enabled, every phase is timed and run under cProfile,
+# and when the script exits, the profile of each phase is dumped to
+# DIRECTORY/STAGE-PHASE.prof and the timings to DIRECTORY/STAGE-phases.json.
+# Phases that run more than once accumulate into the same profile.
+
+import atexit
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import time
+
+profiler = None
+
+
+class StageProfiler(object):
+    def __init__(self, directory, stage):
+        self.directory = directory
+        self.stage = stage
+        self.timings = collections.OrderedDict()
+        self.profiles = collections.OrderedDict()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - start
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for (name, profile) in self.profiles.items():
+            profile.dump_stats(os.path.join(self.directory, '{0}-{1}.prof'.format(self.stage, name)))
+
+        total = time.perf_counter() - self.start
+        with open(os.path.join(self.directory, '{0}-phases.json'.format(self.stage)), 'w') as phases_file:
+            json.dump({'stage': self.stage, 'total': total, 'phases': self.timings}, phases_file, indent=2)
+
+        for (name, seconds) in self.timings.items():
+            print('{0}: {1} took {2:.3f}s'.format(self.stage, name, seconds), file=sys.stderr)
+        print('{0}: {1:.3f}s in total'.format(self.stage, total), file=sys.stderr)
+
+
+def add_argument(parser):
+    parser.add_argument('--profile', metavar='DIRECTORY',
+                        help='time each phase and write the timings and a cProfile dump per phase to DIRECTORY')
+
+
+def enable(directory, stage):
+    global profiler
+    if directory is None:
+        return
+    profiler = StageProfiler(directory, stage)
+    atexit.register(profiler.write)
+
+
+# Worker processes forked while a phase is being profiled inherit the profiler
+# and its hook, so they turn both off before doing their own work.
+def disable():
+    global profiler
+    profiler = None
+    sys.setprofile(None)
+
+
+def phase(name):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
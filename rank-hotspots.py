@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lists the most dangerous places in a geocoded city, or with --near, the
+# collisions within --radius meters of a location.
+
+import argparse
+import hotspots
+import json
+import os
+import spatial
+import sqlite3
+import sys
+import time
+
+TYPES = {'bike': 'G', 'pedestrian': 'B'}
+
+
+def parse_floats(count):
+    def parse(value):
+        try:
+            values = tuple(float(part) for part in value.split(','))
+        except ValueError:
+            values = ()
+        if len(values) != count:
+            raise argparse.ArgumentTypeError('expected {0} comma-separated numbers'.format(count))
+        return values
+    return parse
+
+
+def collision_filter(args):
+    clauses = []
+    parameters = []
+    if args.type != 'any':
+        types = list(TYPES.values()) if args.type is None else [TYPES[args.type]]
+        clauses.append('c.motor_vehicle_with IN ({0})'.format(', '.join('?' * len(types))))
+        parameters.extend(types)
+    if args.since is not None:
+        clauses.append('c.date >= ?')
+        parameters.append(args.since * 10000)
+    if args.until is not None:
+        clauses.append('c.date < ?')
+        parameters.append((args.until + 1) * 10000)
+    return (' AND '.join(clauses) or None, parameters)
+
+
+def print_hotspots(ranked):
+    print('{0:>4} {1:>8} {2:>10} {3:>6} {4:>7} {5:>11} {6:>12}  {7}'.format(
+        'rank', 'score', 'collisions', 'killed', 'injured', 'latitude', 'longitude', 'location'))
+    for (rank, hotspot) in enumerate(ranked, 1):
+        print('{0:>4} {1.score:>8.1f} {1.collisions:>10} {1.killed:>6} {1.injured:>7} '.format(rank, hotspot) + \
+              '{0.latitude:>11.6f} {0.longitude:>12.6f}  {0.location}'.format(hotspot))
+
+
+def print_nearby(nearby):
+    print('{0:>8} {1:>10} {2:>8} {3:>8}  {4}'.format('meters', 'case', 'date', 'severity', 'location'))
+    for (meters, row) in nearby:
+        print('{0:>8.1f} {1:>10} {2:>8} {3:>8}  {4}'.format(meters, *row[2:]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rank the places with the most harmful collisions in a city.')
+    parser.add_argument('city_directory')
+    parser.add_argument('--type', choices=sorted(TYPES) + ['any'],
+                        help='collisions to include (default: bike and pedestrian collisions)')
+    parser.add_argument('--since', type=int, metavar='YEAR', help='leave out collisions before YEAR')
+    parser.add_argument('--until', type=int, metavar='YEAR', help='leave out collisions after YEAR')
+    parser.add_argument('--bbox', type=parse_floats(4), metavar='WEST,SOUTH,EAST,NORTH',
+                        help='only rank collisions inside this box')
+    parser.add_argument('--cell-size', type=float, default=hotspots.DEFAULT_CELL_SIZE,
+                        help='width in meters of the grid cells that are ranked (default: %(default)s)')
+    parser.add_argument('--bandwidth', type=float, default=0.0,
+                        help='smooth cell weights with a Gaussian kernel of this many meters (default: no smoothing)')
+    parser.add_argument('--limit', type=int, default=50, help='number of hotspots to list (default: %(default)s)')
+    parser.add_argument('--near', type=parse_floats(2), metavar='LATITUDE,LONGITUDE',
+                        help='list the collisions near a location instead of ranking hotspots')
+    parser.add_argument('--radius', type=float, default=100.0,
+                        help='distance in meters from --near to search (default: %(default)s)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(os.path.join(args.city_directory, 'all-collisions.db'))
+    with connection:
+        spatial.create_spatial_index(connection)
+
+    start = time.perf_counter()
+    (where, parameters) = collision_filter(args)
+    if args.near is not None:
+        results = spatial.collisions_within(connection, args.near[0], args.near[1], args.radius,
+                                            columns='c.latitude, c.longitude, c.id, c.date, c.collision_severity, ' + \
+                                                    "c.primary_road || ' and ' || c.secondary_road",
+                                            where=where, parameters=parameters)
+    else:
+        bbox = None
+        if args.bbox is not None:
+            (west, south, east, north) = args.bbox
+            bbox = (south, west, north, east)
+        weighted = hotspots.weighted_collisions(connection, bbox, where, parameters)
+        results = hotspots.rank_hotspots(weighted, args.cell_size, args.bandwidth, args.limit)
+    elapsed = time.perf_counter() - start
+    connection.close()
+
+    if args.json and args.near is not None:
+        print(json.dumps([dict(zip(['meters', 'latitude', 'longitude', 'id', 'date', 'severity', 'location'],
+                                   (meters,) + tuple(row))) for (meters, row) in results], indent=2))
+    elif args.json:
+        print(json.dumps([hotspot._asdict() for hotspot in results], indent=2))
+    elif args.near is not None:
+        print_nearby(results)
+    else:
+        print_hotspots(results)
+    print('Found {0} results in {1:.1f}ms'.format(len(results), elapsed * 1000), file=sys.stderr)
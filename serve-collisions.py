@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Serves the UI and filtered aggregates of the bike and pedestrian collisions in
+# all-collisions.db, so that clients can download only the slice they need.
+#
+#   /api/summary   counts by year, type, time of day, injury, sex and age group
+#   /api/markers   collision counts and most severe injury per location
+#
+# Both take the same filters, each a comma separated list of values:
+#
+#   bbox=west,south,east,north
+#   year=2012,2013
+#   type=bike,pedestrian
+#   injury=fatal,severe,visible,pain,other
+#   time_of_day=morning,afternoon,evening,night
+#
+# An injury filter keeps the collisions with at least one victim that has one
+# of the injuries, and only those victims are counted.
+
+import argparse
+import assets
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import queue
+import sqlite3
+import urllib.parse
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+DEFAULT_CONNECTIONS = 4
+DEFAULT_CACHE_SIZE = 256
+
+MAX_REQUEST_HEAD = 16 * 1024
+GZIP_MINIMUM_LENGTH = 256
+GZIP_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+# Exported files with a hash of their contents in their name never change, so
+# browsers can keep them without asking again. Everything else, including the
+# manifest.json that names them, is revalidated on every use.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+TYPES = collections.OrderedDict([('bike', 'G'), ('pedestrian', 'B')])
+INJURIES = collections.OrderedDict([('fatal', 1), ('severe', 2), ('visible', 3), ('pain', 4), ('other', 0)])
+TIMES_OF_DAY = ['morning', 'afternoon', 'evening', 'night']
+SEXES = collections.OrderedDict([('female', 'F'), ('male', 'M')])
+AGE_GROUPS = [('0-14', 14), ('15-24', 24), ('25-49', 49), ('50-74', 75), ('75+', 150)]
+
+# Locations are grouped by rounding them to this many decimal places, which is
+# about ten meters.
+MARKER_PRECISION = 4
+
+# Years outside of this range are rejected rather than passed on to SQLite, which
+# cannot bind integers of more than 64 bits.
+YEAR_RANGE = (1900, 2100)
+
+HOUR = "c.time / 100"
+TIME_OF_DAY = ("(CASE WHEN {0} <= 5 THEN 'night' WHEN {0} <= 11 THEN 'morning' " + \
+               "WHEN {0} <= 17 THEN 'afternoon' ELSE 'evening' END)").format(HOUR)
+AGE_GROUP = "(CASE " + \
+    " ".join("WHEN v.age <= {0} THEN '{1}'".format(limit, name) for (name, limit) in AGE_GROUPS) + \
+    " ELSE 'N/A' END)"
+SEX = "(CASE " + " ".join("WHEN v.sex = '{0}' THEN '{1}'".format(code, name)
+                         for (name, code) in SEXES.items()) + " ELSE 'N/A' END)"
+INJURY = "(CASE " + " ".join("WHEN v.degree_of_injury = {0} THEN '{1}'".format(degree, name)
+                            for (name, degree) in INJURIES.items()) + " END)"
+UI_INJURY = "(CASE WHEN v.degree_of_injury = 0 THEN 4 ELSE v.degree_of_injury - 1 END)"
+
+
+class BadRequest(Exception):
+    pass
+
+
+def parse_list(value, choices):
+    values = value.split(',')
+    for item in values:
+        if item not in choices:
+            raise BadRequest('{0!r} is not one of {1}'.format(item, ', '.join(map(str, choices))))
+    return tuple(sorted(set(values), key=list(choices).index))
+
+
+def parse_bbox(value):
+    try:
+        bbox = [float(coordinate) for coordinate in value.split(',')]
+    except ValueError:
+        raise BadRequest('bbox must be four numbers')
+    if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise BadRequest('bbox must be west,south,east,north')
+    return tuple(bbox)
+
+
+def parse_years(value):
+    try:
+        years = tuple(sorted(set(int(year) for year in value.split(','))))
+    except ValueError:
+        raise BadRequest('year must be a list of years')
+    if years[0] < YEAR_RANGE[0] or years[-1] > YEAR_RANGE[1]:
+        raise BadRequest('years must be between {0} and {1}'.format(*YEAR_RANGE))
+    return years
+
+
+FILTERS = {
+    'bbox': parse_bbox,
+    'year': parse_years,
+    'type': lambda value: parse_list(value, TYPES),
+    'injury': lambda value: parse_list(value, INJURIES),
+    'time_of_day': lambda value: parse_list(value, TIMES_OF_DAY),
+}
+
+
+# Parses and normalizes a query string, so that equivalent requests share a
+# cache entry no matter how their parameters are ordered or repeated.
+def parse_filters(query_string):
+    filters = {}
+    for (name, value) in urllib.parse.parse_qsl(query_string, keep_blank_values=True):
+        if name not in FILTERS:
+            raise BadRequest('unknown parameter {0!r}'.format(name))
+        if name in filters:
+            raise BadRequest('{0!r} given more than once'.format(name))
+        filters[name] = FILTERS[name](value)
+    return tuple(sorted(filters.items()))
+
+
+def placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+# Builds the WHERE clause for collisions (c) and, when victims (v) are joined,
+# for victims. Only the number of placeholders varies between requests, so each
+# connection's statement cache keeps the few distinct statements prepared.
+def where_clauses(filters):
+    # Like the exporter, leave out collisions without a valid date and time.
+    collision_clauses = ['c.motor_vehicle_with IN ({0}) AND c.timestamp IS NOT NULL']
+    types = list(TYPES.values())
+    victim_clauses = []
+    parameters = []
+    victim_parameters = []
+
+    filters = dict(filters)
+    if 'type' in filters:
+        types = [TYPES[name] for name in filters['type']]
+    collision_clauses[0] = collision_clauses[0].format(placeholders(types))
+    parameters.extend(types)
+
+    if 'bbox' in filters:
+        (west, south, east, north) = filters['bbox']
+        collision_clauses.append('c.latitude BETWEEN ? AND ? AND c.longitude BETWEEN ? AND ?')
+        parameters.extend([south, north, west, east])
+    if 'year' in filters:
+        collision_clauses.append('c.date / 10000 IN ({0})'.format(placeholders(filters['year'])))
+        parameters.extend(filters['year'])
+    if 'time_of_day' in filters:
+        collision_clauses.append('{0} IN ({1})'.format(TIME_OF_DAY, placeholders(filters['time_of_day'])))
+        parameters.extend(filters['time_of_day'])
+    if 'injury' in filters:
+        degrees = [INJURIES[name] for name in filters['injury']]
+        collision_clauses.append('EXISTS (SELECT 1 FROM victims AS v WHERE v.collision_id = c.id ' + \
+                                 'AND v.degree_of_injury IN ({0}))'.format(placeholders(degrees)))
+        parameters.extend(degrees)
+        victim_clauses.append('v.degree_of_injury IN ({0})'.format(placeholders(degrees)))
+        victim_parameters.extend(degrees)
+
+    return (' AND '.join(collision_clauses), parameters,
+            ' AND '.join(['1'] + victim_clauses), victim_parameters)
+
+
+def summary(connection, filters):
+    (where, parameters, victim_where, victim_parameters) = where_clauses(filters)
+    result = collections.OrderedDict([
+        ('collisions', 0),
+        ('victims', 0),
+        ('years', collections.OrderedDict()),
+        ('types', collections.OrderedDict((name, 0) for name in TYPES)),
+        ('times_of_day', collections.OrderedDict((name, 0) for name in TIMES_OF_DAY)),
+        ('injuries', collections.OrderedDict((name, 0) for name in INJURIES)),
+        ('sexes', collections.OrderedDict((name, 0) for name in list(SEXES) + ['N/A'])),
+        ('age_groups', collections.OrderedDict((name, 0) for (name, limit) in AGE_GROUPS + [('N/A', None)])),
+    ])
+    type_names = dict((code, name) for (name, code) in TYPES.items())
+
+    rows = connection.execute('SELECT c.date / 10000, c.motor_vehicle_with, {0}, COUNT(*) '.format(TIME_OF_DAY) + \
+                              'FROM collisions AS c WHERE {0} GROUP BY 1, 2, 3 ORDER BY 1;'.format(where),
+                              parameters)
+    for (year, motor_vehicle_with, time_of_day, count) in rows:
+        result['collisions'] += count
+        result['years'][str(year)] = result['years'].get(str(year), 0) + count
+        result['types'][type_names[motor_vehicle_with]] += count
+        result['times_of_day'][time_of_day] += count
+
+    rows = connection.execute('SELECT {0}, {1}, {2}, COUNT(*) '.format(INJURY, SEX, AGE_GROUP) + \
+                              'FROM collisions AS c JOIN victims AS v ON v.collision_id = c.id ' + \
+                              'WHERE {0} AND {1} GROUP BY 1, 2, 3;'.format(where, victim_where),
+                              parameters + victim_parameters)
+    for (injury, sex, age_group, count) in rows:
+        result['victims'] += count
+        if injury is not None:
+            result['injuries'][injury] += count
+        result['sexes'][sex] += count
+        result['age_groups'][age_group] += count
+    return result
+
+
+# Each marker is [latitude, longitude, collisions, most severe injury], where
+# injuries are numbered as in the UI, from 0 (fatal) to 4 (other).
+def markers(connection, filters):
+    (where, parameters, victim_where, victim_parameters) = where_clauses(filters)
+    rows = connection.execute('SELECT ROUND(c.latitude, {0}), ROUND(c.longitude, {0}), '.format(MARKER_PRECISION) + \
+                              'COUNT(DISTINCT c.id), MIN({0}) '.format(UI_INJURY) + \
+                              'FROM collisions AS c LEFT JOIN victims AS v ' + \
+                              'ON v.collision_id = c.id AND {0} '.format(victim_where) + \
+                              'WHERE {0} AND c.latitude IS NOT NULL '.format(where) + \
+                              'GROUP BY 1, 2 ORDER BY 3 DESC, 1, 2;',
+                              victim_parameters + parameters)
+    return [[latitude, longitude, count, 4 if injury is None else injury]
+            for (latitude, longitude, count, injury) in rows]
+
+
+ENDPOINTS = {
+    '/api/summary': summary,
+    '/api/markers': markers,
+}
+
+
+def open_read_only(path):
+    return sqlite3.connect('file:{0}?mode=ro'.format(urllib.parse.quote(path)), uri=True, check_same_thread=False)
+
+
+# A fixed set of read-only connections shared by the worker threads that run
+# queries, so that requests do not pay for opening the database.
+class ConnectionPool(object):
+    def __init__(self, path, size):
+        self.connections = queue.Queue()
+        for i in range(size):
+            self.connections.put(open_read_only(path))
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+class Response(object):
+    def __init__(self, status, body, content_type, etag=None, last_modified=None, cache_control=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.cache_control = cache_control
+        self.gzipped = None
+
+        if len(body) >= GZIP_MINIMUM_LENGTH and content_type.startswith(GZIP_TYPES):
+            self.gzipped = gzip.compress(body)
+
+
+def json_response(status, value):
+    body = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    return Response(status, body, 'application/json', '"{0}"'.format(hashlib.sha1(body).hexdigest()))
+
+
+def error_response(status, message):
+    return json_response(status, {'error': message})
+
+
+STATUS_TEXT = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+
+class CollisionServer(object):
+    def __init__(self, database_path, static_directory, connections=DEFAULT_CONNECTIONS,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self.database_path = database_path
+        self.static_directory = os.path.realpath(static_directory)
+        self.pool = ConnectionPool(database_path, connections)
+        self.version_connection = open_read_only(database_path)
+        self.executor = concurrent.futures.ThreadPoolExecutor(connections)
+        self.cache = collections.OrderedDict()
+        self.static_cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+        self.version_connection.close()
+
+    # Changes whenever the data does. In WAL mode, writes by other processes stay
+    # in the -wal file until a checkpoint, so the database file's modification
+    # time alone misses them, but SQLite's data_version counts every commit made
+    # by another connection. The modification time still catches a database that
+    # was rebuilt and replaced.
+    def data_version(self):
+        return (self.version_connection.execute('PRAGMA data_version').fetchone()[0],
+                os.stat(self.database_path).st_mtime_ns)
+
+    def run_query(self, endpoint, filters):
+        with self.pool.connection() as connection:
+            return endpoint(connection, filters)
+
+    # Responses are cached on the endpoint and normalized filters. The data
+    # version is part of the key, so loading or geocoding collisions invalidates
+    # every cached response.
+    async def api_response(self, path, query_string):
+        try:
+            filters = parse_filters(query_string)
+        except BadRequest as error:
+            return error_response(400, str(error))
+
+        key = (path, filters, self.data_version())
+        response = self.cache.get(key)
+        if response is not None:
+            self.cache.move_to_end(key)
+            return response
+
+        result = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.run_query, ENDPOINTS[path], filters)
+        response = json_response(200, result)
+        self.cache[key] = response
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return response
+
+    def static_response(self, path):
+        if path.endswith('/'):
+            path += 'index.html'
+        full_path = os.path.realpath(os.path.join(self.static_directory, urllib.parse.unquote(path).lstrip('/')))
+        if not full_path.startswith(self.static_directory + os.sep) or not os.path.isfile(full_path):
+            return error_response(404, 'not found')
+
+        # Files are cached on their ETag, so they are only read and compressed
+        # again once they change.
+        stat = os.stat(full_path)
+        etag = '"{0:x}-{1:x}"'.format(stat.st_size, stat.st_mtime_ns)
+        key = (full_path, etag)
+        response = self.static_cache.get(key)
+        if response is not None:
+            self.static_cache.move_to_end(key)
+            return response
+
+        with open(full_path, 'rb') as static_file:
+            body = static_file.read()
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        response = Response(200, body, content_type, etag, email.utils.formatdate(stat.st_mtime, usegmt=True),
+                            IMMUTABLE if assets.is_hashed(full_path) else REVALIDATE)
+        self.static_cache[key] = response
+        if len(self.static_cache) > self.cache_size:
+            self.static_cache.popitem(last=False)
+        return response
+
+    async def response_for(self, method, target):
+        if method not in ('GET', 'HEAD'):
+            return error_response(405, 'only GET and HEAD are supported')
+
+        (path, _, query_string) = target.partition('?')
+        if path in ENDPOINTS:
+            return await self.api_response(path, query_string)
+        return self.static_response(path)
+
+    async def write_response(self, writer, response, headers, head_only):
+        status = response.status
+        body = response.body
+        lines = ['Content-Type: ' + response.content_type]
+        if response.etag is not None:
+            lines.append('ETag: ' + response.etag)
+            if response.etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+                status = 304
+                body = b''
+        if response.last_modified is not None:
+            lines.append('Last-Modified: ' + response.last_modified)
+        if response.cache_control is not None:
+            lines.append('Cache-Control: ' + response.cache_control)
+        if response.gzipped is not None:
+            lines.append('Vary: Accept-Encoding')
+            if status == 200 and 'gzip' in headers.get('accept-encoding', ''):
+                lines.append('Content-Encoding: gzip')
+                body = response.gzipped
+        lines.append('Content-Length: {0}'.format(len(body)))
+
+        head = 'HTTP/1.1 {0} {1}\r\n{2}\r\n\r\n'.format(status, STATUS_TEXT[status], '\r\n'.join(lines))
+        writer.write(head.encode('latin-1'))
+        if not head_only:
+            writer.write(body)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+
+                lines = head.decode('latin-1').split('\r\n')
+                request = lines[0].split(' ')
+                headers = {}
+                for line in lines[1:]:
+                    (name, _, value) = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                if len(request) != 3:
+                    await self.write_response(writer, error_response(400, 'malformed request'), headers, False)
+                    break
+
+                (method, target, version) = request
+                try:
+                    response = await self.response_for(method, target)
+                except Exception as error:
+                    response = error_response(500, str(error))
+                await self.write_response(writer, response, headers, method == 'HEAD')
+
+                if version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close':
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_REQUEST_HEAD)
+        print('Serving {0} on http://{1}:{2}/'.format(self.static_directory, host, port))
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve the UI and filtered collision aggregates.')
+    parser.add_argument('city_directory')
+    parser.add_argument('--ui-directory', default='ui',
+                        help='directory of static files to serve (default: %(default)s)')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS,
+                        help='database connections and query threads (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='number of API responses and of static files to keep in memory (default: %(default)s)')
+    args = parser.parse_args()
+
+    server = CollisionServer(os.path.join(args.city_directory, 'all-collisions.db'), args.ui_directory,
+                             args.connections, args.cache_size)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,102 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# An R*Tree index of collision locations, kept in all-collisions.db next to the
+# collisions table, and bounding box and radius queries that use it instead of
+# scanning every collision. Triggers keep the index up to date as collisions are
+# geocoded and removed. Bulk loads drop the index and create it again once they
+# finish, rather than running the triggers for every row they insert.
+#
+# The index is keyed by collision rowid. R*Tree stores coordinates as 32-bit
+# floats rounded outwards, so index lookups may return collisions slightly
+# outside of the query, which the queries then filter using the exact columns.
+
+import math
+
+EARTH_RADIUS = 6371008.8
+
+# The geocoder stores [0, 0] for collisions it could not locate, so those are
+# left out of the index along with collisions that have no location at all.
+LOCATED = 'latitude IS NOT NULL AND longitude IS NOT NULL AND NOT (latitude = 0 AND longitude = 0)'
+
+
+def create_spatial_index(connection):
+    exists = connection.execute("SELECT count(*) FROM sqlite_master WHERE name = 'collision_locations'").fetchone()[0]
+    if exists:
+        return
+
+    connection.execute('CREATE VIRTUAL TABLE collision_locations USING rtree(' + \
+        'id, min_latitude, max_latitude, min_longitude, max_longitude)')
+    located = LOCATED.replace('latitude', 'new.latitude').replace('longitude', 'new.longitude')
+
+    # An insert may reuse the rowid of a collision that was removed, so it always
+    # clears the entry for its rowid first.
+    connection.execute('CREATE TRIGGER collision_locations_insert AFTER INSERT ON collisions BEGIN ' + \
+        'DELETE FROM collision_locations WHERE id = new.rowid; ' + \
+        'INSERT INTO collision_locations SELECT new.rowid, new.latitude, new.latitude, ' + \
+        'new.longitude, new.longitude WHERE {0}; END'.format(located))
+    connection.execute('CREATE TRIGGER collision_locations_update AFTER UPDATE OF latitude, longitude ON collisions BEGIN ' + \
+        'DELETE FROM collision_locations WHERE id = old.rowid; ' + \
+        'INSERT INTO collision_locations SELECT new.rowid, new.latitude, new.latitude, ' + \
+        'new.longitude, new.longitude WHERE {0}; END'.format(located))
+    connection.execute('CREATE TRIGGER collision_locations_delete AFTER DELETE ON collisions BEGIN ' + \
+        'DELETE FROM collision_locations WHERE id = old.rowid; END')
+
+    connection.execute('INSERT INTO collision_locations SELECT rowid, latitude, latitude, longitude, longitude ' + \
+                       'FROM collisions WHERE {0}'.format(LOCATED))
+
+
+def drop_spatial_index(connection):
+    for trigger in ['collision_locations_insert', 'collision_locations_update', 'collision_locations_delete']:
+        connection.execute('DROP TRIGGER IF EXISTS {0}'.format(trigger))
+    connection.execute('DROP TABLE IF EXISTS collision_locations')
+
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+    latitude1 = math.radians(latitude1)
+    latitude2 = math.radians(latitude2)
+    half_chord = math.sin((latitude2 - latitude1) / 2) ** 2 + \
+        math.cos(latitude1) * math.cos(latitude2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, half_chord)))
+
+
+# Returns the (south, west, north, east) box that contains every point within
+# radius meters of a location.
+def bbox_around(latitude, longitude, radius):
+    latitude_delta = math.degrees(radius / EARTH_RADIUS)
+    longitude_scale = math.cos(math.radians(min(89.0, abs(latitude) + latitude_delta)))
+    longitude_delta = min(180.0, latitude_delta / longitude_scale)
+    return (latitude - latitude_delta, longitude - longitude_delta,
+            latitude + latitude_delta, longitude + longitude_delta)
+
+
+# Returns the rows of collisions inside a box, with the given columns of the
+# collisions table, and optional extra SQL conditions on the collision "c".
+def collisions_in_bbox(connection, south, west, north, east, columns='c.*', where=None, parameters=()):
+    query = 'SELECT {0} FROM collision_locations AS r JOIN collisions AS c ON c.rowid = r.id '.format(columns) + \
+            'WHERE r.max_latitude >= ? AND r.min_latitude <= ? AND r.max_longitude >= ? AND r.min_longitude <= ? ' + \
+            'AND c.latitude BETWEEN ? AND ? AND c.longitude BETWEEN ? AND ?'
+    if where:
+        query += ' AND ({0})'.format(where)
+    return connection.execute(query, (south, north, west, east, south, north, west, east) + tuple(parameters)).fetchall()
+
+
+# Returns (distance in meters, row) for every collision within radius meters of
+# a location, nearest first. The columns must start with latitude and longitude.
+def collisions_within(connection, latitude, longitude, radius, columns='c.latitude, c.longitude, c.*',
+                      where=None, parameters=()):
+    (south, west, north, east) = bbox_around(latitude, longitude, radius)
+    rows = collisions_in_bbox(connection, south, west, north, east, columns, where, parameters)
+    nearby = [(distance(latitude, longitude, row[0], row[1]), row) for row in rows]
+    return sorted([(meters, row) for (meters, row) in nearby if meters <= radius], key=lambda item: item[0])
@@ -0,0 +1,263 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline geocoding of SWITRS intersections. Road names from SWITRS and from map
+# data are normalized to the abbreviated style SWITRS uses ("MARTIN LUTHER KING
+# JR WY", "RT 580"), and an IntersectionIndex maps pairs of normalized names to
+# coordinates, falling back to fuzzy matching for misspelled or truncated names.
+
+import collections
+import csv
+import difflib
+import geocoding
+import json
+import re
+import xml.etree.ElementTree
+
+# SWITRS spells street types the way the left column does.
+STREET_TYPES = {
+    'AVENUE': 'AV', 'AVE': 'AV',
+    'STREET': 'ST', 'STR': 'ST',
+    'BOULEVARD': 'BL', 'BLVD': 'BL',
+    'WAY': 'WY',
+    'ROAD': 'RD',
+    'DRIVE': 'DR',
+    'PARKWAY': 'PKWY',
+    'COURT': 'CT',
+    'PLACE': 'PL',
+    'TERRACE': 'TER',
+    'LANE': 'LN',
+    'CIRCLE': 'CIR',
+    'HIGHWAY': 'HWY',
+    'EXPRESSWAY': 'EXPY',
+    'FREEWAY': 'FWY',
+    'PLAZA': 'PZ',
+    'SQUARE': 'SQ',
+    'JUNIOR': 'JR',
+}
+STREET_TYPE_ABBREVIATIONS = set(STREET_TYPES.values())
+
+DIRECTIONS = {'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W'}
+
+ORDINALS = {
+    'FIRST': '1ST', 'SECOND': '2ND', 'THIRD': '3RD', 'FOURTH': '4TH', 'FIFTH': '5TH',
+    'SIXTH': '6TH', 'SEVENTH': '7TH', 'EIGHTH': '8TH', 'NINTH': '9TH', 'TENTH': '10TH',
+    'ELEVENTH': '11TH', 'TWELFTH': '12TH', 'THIRTEENTH': '13TH', 'FOURTEENTH': '14TH',
+    'FIFTEENTH': '15TH', 'SIXTEENTH': '16TH', 'SEVENTEENTH': '17TH', 'EIGHTEENTH': '18TH',
+    'NINETEENTH': '19TH', 'TWENTIETH': '20TH',
+}
+
+# State routes and interstates are all "RT <number>" in SWITRS.
+ROUTE_PATTERN = re.compile(r'^(?:RT|RTE|ROUTE|SR|CA|HWY|STATE ROUTE|STATE HIGHWAY|I|INTERSTATE|US) ?-? ?(\d+)\b(.*)$')
+
+# House numbers and block numbers that SWITRS sometimes includes in road names,
+# as in "BROADWAY 2100" or "2000 BLK HIGH ST".
+BLOCK_PATTERN = re.compile(r'^\d+ BLK ')
+TRAILING_NUMBER_PATTERN = re.compile(r',? \d+$')
+NUMBER_PATTERN = re.compile(r'\d+')
+
+# Locations that geocoders cannot work out from the road names, given as the words
+# that identify them and their coordinates.
+SPECIAL_LOCATIONS = [
+    # The Bay Bridge metering lights.
+    (('RT 80', 'METERING'), [37.82479, -122.31384]),
+]
+
+
+def special_location(location_key):
+    for (words, location) in SPECIAL_LOCATIONS:
+        if all(word in location_key for word in words):
+            return location
+    return None
+
+
+def normalize_road(name):
+    name = re.sub(r'[^A-Z0-9 ]', ' ', name.upper().replace('-', ' '))
+    name = re.sub(r'\s+', ' ', name).strip()
+    name = BLOCK_PATTERN.sub('', name)
+
+    route = ROUTE_PATTERN.match(name)
+    if route:
+        return ('RT ' + route.group(1) + route.group(2)).strip()
+
+    name = TRAILING_NUMBER_PATTERN.sub('', name)
+
+    words = []
+    for word in name.split(' '):
+        word = ORDINALS.get(word, word)
+        word = DIRECTIONS.get(word, word)
+        word = STREET_TYPES.get(word, word)
+        words.append(word)
+    return ' '.join(words)
+
+
+# The name of a road without its street type, which is often dropped or wrong
+# in SWITRS records ("INTERNATIONAL" for "INTERNATIONAL BL").
+def base_road_name(road):
+    words = road.split(' ')
+    if len(words) > 1 and words[-1] in STREET_TYPE_ABBREVIATIONS:
+        words = words[:-1]
+    return ' '.join(words)
+
+
+def split_location_key(location_key):
+    return [normalize_road(road) for road in location_key.split(' and ') if road.strip()]
+
+
+class IntersectionIndex(object):
+    def __init__(self, fuzzy_cutoff=0.85):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.crossings = collections.defaultdict(dict)
+        self.base_crossings = collections.defaultdict(dict)
+        self.exact = {}
+
+    def __len__(self):
+        return sum(len(crossings) for crossings in self.crossings.values()) // 2
+
+    def add_intersection(self, road, other_road, location):
+        (road, other_road) = (normalize_road(road), normalize_road(other_road))
+        if not road or not other_road or road == other_road:
+            return
+        self.crossings[road].setdefault(other_road, location)
+        self.crossings[other_road].setdefault(road, location)
+        self.base_crossings[base_road_name(road)].setdefault(base_road_name(other_road), location)
+        self.base_crossings[base_road_name(other_road)].setdefault(base_road_name(road), location)
+
+    # Adds an already geocoded location key, such as those from locations.json.
+    def add_location(self, location_key, location):
+        if location is None:
+            return
+        self.exact[geocoding.normalize_location_key(location_key)] = location
+        roads = split_location_key(location_key)
+        if len(roads) == 2:
+            self.add_intersection(roads[0], roads[1], location)
+
+    def load_locations(self, locations):
+        for (location_key, location) in locations:
+            self.add_location(location_key, location)
+
+    def load_json(self, path):
+        with open(path, 'r') as location_file:
+            self.load_locations(json.loads(location_file.read()).items())
+
+    # A CSV file with one intersection per row: road, other road, latitude and
+    # longitude. A header row is skipped.
+    def load_csv(self, path):
+        with open(path, 'r', newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                try:
+                    location = [float(row[2]), float(row[3])]
+                except (ValueError, IndexError):
+                    continue
+                self.add_intersection(row[0], row[1], location)
+
+    # An OpenStreetMap XML extract. Every node shared by named highways with
+    # different names is an intersection of those roads.
+    def load_osm(self, path):
+        nodes = {}
+        roads_at_node = collections.defaultdict(set)
+        way_nodes = []
+        for (event, element) in xml.etree.ElementTree.iterparse(path):
+            if element.tag == 'node':
+                nodes[element.get('id')] = [float(element.get('lat')), float(element.get('lon'))]
+            elif element.tag == 'nd':
+                way_nodes.append(element.get('ref'))
+            elif element.tag == 'way':
+                tags = dict((tag.get('k'), tag.get('v')) for tag in element.iter('tag'))
+                if 'highway' in tags:
+                    for key in ('name', 'ref'):
+                        if key in tags:
+                            for name in tags[key].split(';'):
+                                for node in way_nodes:
+                                    roads_at_node[node].add(name)
+                way_nodes = []
+            if element.tag in ('node', 'way', 'relation'):
+                element.clear()
+
+        for (node, roads) in roads_at_node.items():
+            if len(roads) > 1 and node in nodes:
+                roads = sorted(roads)
+                for (i, road) in enumerate(roads):
+                    for other_road in roads[i + 1:]:
+                        self.add_intersection(road, other_road, nodes[node])
+
+    def load(self, path):
+        if path.endswith('.osm'):
+            self.load_osm(path)
+        elif path.endswith('.json'):
+            self.load_json(path)
+        else:
+            self.load_csv(path)
+
+    def closest_road(self, road, candidates):
+        # Numbered streets that are spelled alike are still different streets, so
+        # only names with the same numbers are considered.
+        numbers = NUMBER_PATTERN.findall(road)
+        candidates = [candidate for candidate in candidates if NUMBER_PATTERN.findall(candidate) == numbers]
+        matches = difflib.get_close_matches(road, candidates, n=1, cutoff=self.fuzzy_cutoff)
+        if matches:
+            return matches[0]
+        return None
+
+    def resolve_pair(self, road, other_road):
+        crossings = self.crossings.get(road)
+        if crossings and other_road in crossings:
+            return crossings[other_road]
+
+        base_crossings = self.base_crossings.get(base_road_name(road))
+        if base_crossings and base_road_name(other_road) in base_crossings:
+            return base_crossings[base_road_name(other_road)]
+
+        # Fuzzy matching, first of the road and then of the road crossing it.
+        matched_road = road if crossings else self.closest_road(road, self.crossings.keys())
+        if matched_road is None:
+            return None
+        crossings = self.crossings[matched_road]
+        matched_other_road = self.closest_road(other_road, crossings.keys())
+        if matched_other_road is None:
+            return None
+        return crossings[matched_other_road]
+
+    def resolve(self, location_key):
+        location = special_location(location_key)
+        if location is not None:
+            return location
+
+        location = self.exact.get(geocoding.normalize_location_key(location_key))
+        roads = split_location_key(location_key)
+        if location is not None or len(roads) != 2:
+            return location
+
+        return self.resolve_pair(roads[0], roads[1]) or self.resolve_pair(roads[1], roads[0])
+
+    def resolve_all(self, location_keys):
+        return dict((location_key, self.resolve(location_key)) for location_key in set(location_keys))
+
+
+# Resolves addresses against an IntersectionIndex with the same interface as
+# geocoding.GeocodingPipeline, so it can stand in for a network geocoder.
+# Addresses are "<location key>, <city>, <state>". Unresolved addresses are
+# reported as ordinary errors rather than NoResultError, so they are not cached
+# as failures and a network geocoder can still try them later.
+class OfflineGeocoder(object):
+    def __init__(self, index):
+        self.index = index
+
+    def geocode_all(self, addresses):
+        for address in dict.fromkeys(addresses):
+            location = self.index.resolve(address.split(', ')[0])
+            if location is None:
+                yield (address, None, geocoding.GeocodingError('not in the offline street index'))
+            else:
+                yield (address, location, None)
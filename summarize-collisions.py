@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Prints multi-year rollups of the collisions in one or more city databases:
+# collisions by year and type, severity by year, bike and pedestrian collisions
+# by hour and time of day, and bike and pedestrian victims by injury and sex.
+
+import analytics
+import argparse
+import json
+import os
+import sys
+import time
+
+TYPE_NAMES = ['pedestrian', 'bike', 'other']
+SEX_NAMES = ['female', 'male', 'N/A']
+INJURY_NAMES = ['other', 'fatal', 'severe', 'visible', 'pain']
+TIME_OF_DAY_NAMES = ['6am-12pm', '12pm-6pm', '6pm-12am', '12am-6am']
+
+
+def load_cities(city_directories, use_cache):
+    cities = []
+    for city_directory in city_directories:
+        cache_path = os.path.join(city_directory, 'all-collisions.npz') if use_cache else None
+        cities.append(analytics.load_database(os.path.join(city_directory, 'all-collisions.db'), cache_path))
+
+    if len(cities) == 1:
+        return cities[0]
+    return dict((table, analytics.concatenate_tables(city[table] for city in cities)) for table in cities[0])
+
+
+# Joins each group's key values into a string, looking up the names of values
+# that are indices into a list of names.
+def name_keys(counts, *names):
+    def name(value, value_names):
+        if value_names is None:
+            return str(value)
+        if 0 <= value < len(value_names):
+            return value_names[value]
+        return 'N/A'
+
+    return dict(('/'.join(name(value, value_names) for (value, value_names) in zip(key, names)), count)
+                for (key, count) in counts.items())
+
+
+def summarize(tables):
+    collisions = tables['collisions']
+    victims = tables['victims']
+    years = analytics.years(collisions)
+    types = analytics.collision_types(collisions)
+
+    bike_and_pedestrian = types < 2
+    victim_rows = analytics.collision_rows(collisions, victims)
+    victim_in_bike_and_pedestrian = victim_rows >= 0
+    victim_in_bike_and_pedestrian[victim_in_bike_and_pedestrian] = \
+        bike_and_pedestrian[victim_rows[victim_in_bike_and_pedestrian]]
+    victims = victims.select(victim_in_bike_and_pedestrian)
+    map_collisions = collisions.select(bike_and_pedestrian)
+
+    return {
+        'collisions': len(collisions),
+        'by_year_and_type': name_keys(analytics.group_counts([years, types]), None, TYPE_NAMES),
+        'severity_by_year': dict((str(key[0]), row)
+                                 for (key, row) in analytics.severity_rollup(collisions, [years]).items()),
+        'bike_and_pedestrian_by_hour': analytics.hour_histogram(map_collisions).tolist(),
+        'bike_and_pedestrian_by_time_of_day': name_keys(
+            analytics.group_counts([analytics.times_of_day(map_collisions)]), TIME_OF_DAY_NAMES),
+        'bike_and_pedestrian_victims_by_injury_and_sex': name_keys(
+            analytics.group_counts([victims['degree_of_injury'], analytics.victim_sexes(victims)]),
+            INJURY_NAMES, SEX_NAMES),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Print collision rollups for one or more city databases.')
+    parser.add_argument('city_directories', nargs='+', metavar='city_directory')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always read the databases instead of the arrays saved in all-collisions.npz')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tables = load_cities(args.city_directories, not args.no_cache)
+    loaded = time.perf_counter()
+    summary = summarize(tables)
+    finished = time.perf_counter()
+
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    print('Loaded in {0:.3f}s, summarized in {1:.3f}s'.format(loaded - start, finished - loaded), file=sys.stderr)
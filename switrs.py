@@ -1,95 +1,293 @@
-def field_to_float(value):
-    try:
-        return float(value)
-    except:
+import calendar
+import collections
+import datetime
+
+# Converters turn a non-empty CSV field into the value stored in the database,
+# raising ValueError when the field is malformed. Empty fields are stored as
+# NULL in numeric columns and as empty strings in text columns.
+
+# Dates are YYYYMMDD and are kept in that form, but must be real dates.
+def parse_date(value):
+    date = int(value)
+    datetime.date(date // 10000, date // 100 % 100, date % 100)
+    return date
+
+# Times are HHMM on a 24 hour clock.
+def parse_time(value):
+    time = int(value)
+
+    # No clue where this time comes from, but it appears often enough that it
+    # is treated as midnight rather than as an error.
+    if time == 2500:
         return 0
 
+    if time < 0 or time // 100 >= 24 or time % 100 >= 60:
+        raise ValueError('invalid time {0!r}'.format(value))
+    return time
+
+def parse_code(*codes):
+    codes = frozenset(codes)
+    def parse(value):
+        if value not in codes:
+            raise ValueError('unknown code {0!r}'.format(value))
+        return value
+    return parse
+
+def parse_integer_code(*codes):
+    codes = frozenset(codes)
+    def parse(value):
+        code = int(value)
+        if code not in codes:
+            raise ValueError('unknown code {0!r}'.format(value))
+        return code
+    return parse
+
+# The date and time of a collision as seconds since the epoch. SWITRS times are
+# local to California, and like the exporter, this treats them as if they were
+# UTC, so the result can be turned back into the reported date and time without
+# any time zone database.
+def collision_timestamp(date, time):
+    if date is None or time is None:
+        return None
+    return calendar.timegm((date // 10000, date // 100 % 100, date % 100, time // 100, time % 100, 0))
+
+# Names the location of a collision after its roads.
+def intersection_string(primary_road, secondary_road):
+    if secondary_road.startswith(primary_road):
+        return secondary_road
+    return '{0} and {1}'.format(primary_road, secondary_road)
+
+DEFAULT_CONVERTERS = {
+    'integer': int,
+    'real': float,
+}
+
+# A field computed from other, already converted fields of the same record rather
+# than read from the CSV files. Derived fields come after every CSV field.
+class Derived(object):
+    def __init__(self, function, *sources):
+        self.function = function
+        self.sources = sources
+
+Field = collections.namedtuple('Field', ['name', 'column_type', 'converter'])
+
+# The SWITRS record layouts, in the order the fields appear in the raw CSV files
+# and in the tables of all-collisions.db. Each entry is a field name, its SQLite
+# column type and optionally the converter that parses and validates it, which
+# otherwise comes from the column type. Counts, dates, times and coordinates are
+# stored as numbers so that they can be compared and indexed in SQL.
+COLLISION_SCHEMA = (
+    ('id', 'text primary key'),
+    ('year', 'integer'),
+    ('process_date', 'integer', parse_date),
+    ('jurisdiction', 'text'),
+    ('date', 'integer', parse_date),
+    ('time', 'integer', parse_time),
+    ('officer_id', 'text'),
+    ('reporting_district', 'text'),
+    ('day_of_week', 'text', parse_code('1', '2', '3', '4', '5', '6', '7')),
+    ('chp_shift', 'text'),
+    ('population', 'text'),
+    ('county_city_location', 'text'),
+    ('special_condition', 'text'),
+    ('beat_type', 'text'),
+    ('chp_beat_type', 'text'),
+    ('city_division_lapd', 'text'),
+    ('chp_beat_class', 'text'),
+    ('beat_number', 'text'),
+    ('primary_road', 'text'),
+    ('secondary_road', 'text'),
+    ('distance', 'real'),
+    ('direction', 'text'),
+    ('intersection', 'text'),
+    ('weather1', 'text'),
+    ('weather2', 'text'),
+    ('state_highway', 'text'),
+    ('caltrans_county', 'text'),
+    ('caltrans_distruct', 'text'),
+    ('state_route', 'text'),
+    ('route_suffix', 'text'),
+    ('postmile_prefix', 'text'),
+    ('postmile', 'real'),
+    ('location_type', 'text'),
+    ('ramp_intersection', 'text'),
+    ('side_of_highway', 'text'),
+    ('tow_away', 'text'),
+    ('collision_severity', 'integer', parse_integer_code(0, 1, 2, 3, 4)),
+    ('killed_count', 'integer'),
+    ('injured_count', 'integer'),
+    ('party_count', 'integer'),
+    ('primary_collision_factor', 'text'),
+    ('pcf_violation_code', 'text'),
+    ('pcf_violation_category', 'text'),
+    ('pcf_violation', 'text'),
+    ('pcf_violation_subsection', 'text'),
+    ('hit_and_run', 'text'),
+    ('collision_type', 'text'),
+    ('motor_vehicle_with', 'text', parse_code('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', '-')),
+    ('pedestrian_action', 'text'),
+    ('road_surface', 'text'),
+    ('road_condition1', 'text'),
+    ('road_condition2', 'text'),
+    ('lighting', 'text'),
+    ('control_device', 'text'),
+    ('chp_road_type', 'text'),
+    ('pedestrian_collision', 'text'),
+    ('bicycle_collision', 'text'),
+    ('motorcycle_collision', 'text'),
+    ('truck_collision', 'text'),
+    ('not_private_property', 'text'),
+    ('alcohol_involved', 'text'),
+    ('statewide_vehicle_type_at_fault', 'text'),
+    ('chp_vehicle_type_at_fault', 'text'),
+    ('severe_injury_count', 'integer'),
+    ('other_visible_injury_count', 'integer'),
+    ('complaint_of_pain_injury_count', 'integer'),
+    ('pedestrian_killed_count', 'integer'),
+    ('pedestrian_injured_count', 'integer'),
+    ('bicyclist_killed_count', 'integer'),
+    ('bicyclist_injured_count', 'integer'),
+    ('motorcyclist_killed_count', 'integer'),
+    ('motorcyclist_injured_count', 'integer'),
+    ('primary_ramp', 'text'),
+    ('secondary_ramp', 'text'),
+    ('latitude', 'real'),
+    ('longitude', 'real'),
+    ('timestamp', 'integer', Derived(collision_timestamp, 'date', 'time')),
+)
+
+PARTY_SCHEMA = (
+    ('collision_id', 'text'),
+    ('number', 'integer'),
+    ('party_type', 'text'),
+    ('at_fault', 'text'),
+    ('sex', 'text', parse_code('F', 'M', '-')),
+    ('age', 'integer'),
+    ('sobriety', 'text'),
+    ('impairment', 'text'),
+    ('direction_of_travel', 'text'),
+    ('safety_equipment1', 'text'),
+    ('safety_equipment2', 'text'),
+    ('financial_responsibility', 'text'),
+    ('special_information1', 'text'),
+    ('special_information2', 'text'),
+    ('special_information3', 'text'),
+    ('oaf_violation_code', 'text'),
+    ('oaf_violation_category', 'text'),
+    ('oaf_violation_section', 'text'),
+    ('oaf_violation_suffix', 'text'),
+    ('other_associated_factor', 'text'),
+    ('other_associated_factor2', 'text'),
+    ('number_killed', 'integer'),
+    ('number_injured', 'integer'),
+    ('movement_preceding_collision', 'text'),
+    ('vehicle_year', 'integer'),
+    ('vehicle_make', 'text'),
+    ('statewide_vehicle_type', 'text'),
+    ('chp_vehicle_type_towing', 'text'),
+    ('chp_vehicle_type_towed', 'text'),
+    ('race', 'text'),
+)
+
+VICTIM_SCHEMA = (
+    ('collision_id', 'text'),
+    ('party_id', 'integer'),
+    ('role', 'text'),
+    ('sex', 'text', parse_code('F', 'M', '-')),
+    ('age', 'integer'),
+    ('degree_of_injury', 'integer', parse_integer_code(0, 1, 2, 3, 4)),
+    ('seating_position', 'text'),
+    ('safety_equipment1', 'text'),
+    ('safety_equipment2', 'text'),
+    ('ejected', 'text'),
+)
+
+
+def schema_fields(schema):
+    fields = []
+    for entry in schema:
+        (name, column_type) = entry[0:2]
+        converter = entry[2] if len(entry) > 2 else DEFAULT_CONVERTERS.get(column_type.split()[0])
+        fields.append(Field(name, column_type, converter))
+    return fields
+
+def field_names(schema):
+    return tuple(field.name for field in schema_fields(schema))
+
+# The fields that are read from the CSV files, leaving out derived ones.
+def source_field_names(schema):
+    return tuple(field.name for field in schema_fields(schema) if not isinstance(field.converter, Derived))
+
+def column_types(schema):
+    return collections.OrderedDict((field.name, field.column_type) for field in schema_fields(schema))
+
+
+def record_initializer(fields):
+    # Like collections.namedtuple, generate the code for the record constructor
+    # once, so that building a record is a flat run of slot assignments rather
+    # than a loop over the schema.
+    source = 'def set_fields(self, row):\n'
+    for (index, field) in enumerate(fields):
+        source += '    self.{0} = row[{1}]\n'.format(field, index)
+    namespace = {}
+    exec(source, namespace)
+    return namespace['set_fields']
+
+
+# Converts raw CSV rows into rows of typed values for one of the schemas, counting
+# the malformed values of each field, which are stored as NULL. Like the record
+# initializers, the conversion of a whole row is generated once as straight-line
+# code. Extra trailing CSV fields are ignored and missing ones are empty.
+class RecordParser(object):
+    def __init__(self, schema):
+        self.fields = schema_fields(schema)
+        self.errors = collections.Counter()
+        self.parse_row = self.row_parser()
+
+    def row_parser(self):
+        source_count = sum(1 for field in self.fields if not isinstance(field.converter, Derived))
+        namespace = {'errors': self.errors, 'padding': [''] * source_count}
+        source = 'def parse_row(row):\n'
+        source += '    if len(row) < {0}:\n'.format(source_count)
+        source += '        row = row + padding[len(row):]\n'
+        for (index, field) in enumerate(self.fields):
+            namespace['convert_{0}'.format(index)] = field.converter
+            if field.converter is None:
+                source += '    value_{0} = row[{0}]\n'.format(index)
+                continue
+
+            if isinstance(field.converter, Derived):
+                names = [source_field.name for source_field in self.fields]
+                indices = [names.index(name) for name in field.converter.sources]
+                namespace['convert_{0}'.format(index)] = field.converter.function
+                call = 'convert_{0}({1})'.format(index, ', '.join('value_{0}'.format(i) for i in indices))
+            else:
+                call = "convert_{0}(row[{0}]) if row[{0}] != '' else {1}".format(
+                    index, "''" if field.column_type.startswith('text') else 'None')
+            source += '    try:\n'
+            source += '        value_{0} = {1}\n'.format(index, call)
+            source += '    except ValueError:\n'
+            source += '        value_{0} = None\n'.format(index)
+            source += '        errors[{0!r}] += 1\n'.format(field.name)
+        source += '    return ({0},)\n'.format(', '.join('value_{0}'.format(i) for i in range(len(self.fields))))
+        exec(source, namespace)
+        return namespace['parse_row']
+
+    def parse_rows(self, rows):
+        parse_row = self.parse_row
+        for row in rows:
+            yield parse_row(row)
+
 
 class Collision(object):
-    collisions = {}
+    fields = field_names(COLLISION_SCHEMA)
+    __slots__ = fields + ('parties', 'victims')
+    set_fields = record_initializer(fields)
+
     def __init__(self, csvarray):
         self.parties = []
         self.victims = []
-
-        self.array = list(csvarray)
-        self.id = csvarray[0]
-        self.year = csvarray[1]
-        self.process_date = csvarray[2]
-        self.jurisdiction = csvarray[3]
-        self.date = csvarray[4]
-        self.time = csvarray[5]
-        self.officer_id = csvarray[6]
-        self.reporting_district = csvarray[7]
-        self.day_of_week = csvarray[8]
-        self.chp_shift = csvarray[9]
-        self.population = csvarray[10]
-        self.county_city_location = csvarray[11]
-        self.special_condition = csvarray[12]
-        self.beat_type = csvarray[13]
-        self.chp_beat_type = csvarray[14]
-        self.city_division_lapd = csvarray[15]
-        self.chp_beat_class = csvarray[16]
-        self.beat_number = csvarray[17]
-        self.primary_road = csvarray[18]
-        self.secondary_road = csvarray[19]
-        self.distance = csvarray[20]
-        self.direction = csvarray[21]
-        self.intersection = csvarray[22]
-        self.weather1 = csvarray[23]
-        self.weather2 = csvarray[24]
-        self.state_highway = csvarray[25]
-        self.caltrans_county = csvarray[26]
-        self.caltrans_distruct = csvarray[27]
-        self.state_route = csvarray[28]
-        self.route_suffix = csvarray[29]
-        self.postmile_prefix = csvarray[30]
-        self.postmile = csvarray[31]
-        self.location_type = csvarray[32]
-        self.ramp_intersection = csvarray[33]
-        self.side_of_highway = csvarray[34]
-        self.tow_away = csvarray[35]
-        self.collision_severity = csvarray[36]
-        self.killed_count = csvarray[37]
-        self.injured_count = csvarray[38]
-        self.party_count = csvarray[39]
-        self.primary_collision_factor = csvarray[40]
-        self.pcf_violation_code = csvarray[41]
-        self.pcf_violation_category = csvarray[42]
-        self.pcf_violation = csvarray[43]
-        self.pcf_violation_subsection = csvarray[44]
-        self.hit_and_run = csvarray[45]
-        self.collision_type = csvarray[46]
-        self.motor_vehicle_with = csvarray[47]
-        self.pedestrian_action = csvarray[48]
-        self.road_surface = csvarray[49]
-        self.road_condition1 = csvarray[50]
-        self.road_condition2 = csvarray[51]
-        self.lighting = csvarray[52]
-        self.control_device = csvarray[53]
-        self.chp_road_type = csvarray[54]
-        self.pedestrian_collision = csvarray[55]
-        self.bicycle_collision = csvarray[56]
-        self.motorcycle_collision = csvarray[57]
-        self.truck_collision = csvarray[58]
-        self.not_private_property = csvarray[59]
-        self.alcohol_involved = csvarray[60]
-        self.statewide_vehicle_type_at_fault = csvarray[61]
-        self.chp_vehicle_type_at_fault = csvarray[62]
-        self.severe_injury_count = csvarray[63]
-        self.other_visible_injury_count = csvarray[64]
-        self.complaint_of_pain_injury_count = csvarray[65]
-        self.pedestrian_killed_count = csvarray[66]
-        self.pedestrian_injured_count = csvarray[66]
-        self.bicyclist_killed_count = csvarray[67]
-        self.bicyclist_injured_count = csvarray[69]
-        self.motorcyclist_killed_count = csvarray[70]
-        self.motorcyclist_injured_count = csvarray[71]
-        self.primary_ramp = csvarray[72]
-        self.secondary_ramp = csvarray[73]
-        self.latitude = csvarray[74]
-        self.longitude = csvarray[75]
-
-        self.__class__.collisions[self.id] = self
+        self.set_fields(csvarray)
 
     def collision_with(self):
         collision_mapping = {
@@ -108,9 +306,7 @@ class Collision(object):
         return collision_mapping[self.motor_vehicle_with]
 
     def intersection_string(self):
-        if self.secondary_road.startswith(self.primary_road):
-            return self.secondary_road
-        return '{0} and {1}'.format(self.primary_road, self.secondary_road)
+        return intersection_string(self.primary_road, self.secondary_road)
 
     def __str__(self):
         return "{0} car/{1} at {2}, {3}".format(self.intersection_string(),
@@ -120,50 +316,118 @@ class Collision(object):
 
 
 class Party(object):
+    fields = field_names(PARTY_SCHEMA)
+    __slots__ = fields
+    set_fields = record_initializer(fields)
+
     def __init__(self, csvarray):
-        self.array = csvarray
-        self.collision_id = csvarray[0]
-        self.number = csvarray[1]
-        self.party_type = csvarray[2]
-        self.at_fault = csvarray[3]
-        self.sex = csvarray[4]
-        self.age = csvarray[5]
-        self.sobriety = csvarray[6]
-        self.impairment = csvarray[7]
-        self.direction_of_travel = csvarray[8]
-        self.safety_equipment1 = csvarray[9]
-        self.safety_equipment2 = csvarray[10]
-        self.financial_responsibility = csvarray[11]
-        self.special_information1 = csvarray[12]
-        self.special_information2 = csvarray[13]
-        self.special_information3 = csvarray[14]
-        self.oaf_violation_code = csvarray[15]
-        self.oaf_violation_category = csvarray[16]
-        self.oaf_violation_section = csvarray[17]
-        self.oaf_violation_suffix = csvarray[18]
-        self.other_associated_factor = csvarray[19]
-        self.other_associated_factor2 = csvarray[20]
-        self.number_killed = csvarray[21]
-        self.number_injured = csvarray[22]
-        self.movement_preceding_collision = csvarray[23]
-        self.vehicle_year = csvarray[24]
-        self.vehicle_make = csvarray[25]
-        self.statewide_vehicle_type = csvarray[26]
-        self.chp_vehicle_type_towing = csvarray[27]
-        self.chp_vehicle_type_towed = csvarray[28]
-        self.race = csvarray[29]
+        self.set_fields(csvarray)
+
 
 class Victim(object):
+    fields = field_names(VICTIM_SCHEMA)
+    __slots__ = fields
+    set_fields = record_initializer(fields)
+
     def __init__(self, csvarray):
-        self.array = csvarray
-        self.collision_id = csvarray[0]
-        self.party_id = csvarray[1]
-        self.role = csvarray[2]
-        self.sex = csvarray[3]
-        self.age = csvarray[4]
-        self.degree_of_injury = csvarray[5]
-        self.seating_position = csvarray[6]
-        self.safety_equipment1 = csvarray[7]
-        self.safety_equipment2 = csvarray[8]
-        self.ejected = csvarray[9]
+        self.set_fields(csvarray)
+
+
+# Owns a set of collisions along with their parties and victims, and keeps
+# secondary indexes so that common queries do not need to scan every record.
+# Stores are independent of each other, so several datasets can be loaded into
+# one process and dropped when they are no longer needed. Each index maps a key
+# to a dict of the collisions with it by id, which keeps them in the order they
+# were added and lets a collision be removed without searching for it.
+class CollisionStore(object):
+    def __init__(self):
+        self.collisions = {}
+        self.by_year = collections.defaultdict(dict)
+        self.by_motor_vehicle_with = collections.defaultdict(dict)
+        self.by_intersection = collections.defaultdict(dict)
+        self.parties_by_collision_id = collections.defaultdict(list)
+        self.victims_by_collision_id = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self.collisions)
+
+    def __iter__(self):
+        return iter(self.collisions.values())
+
+    def __contains__(self, collision_id):
+        return collision_id in self.collisions
+
+    def get(self, collision_id):
+        return self.collisions.get(collision_id)
+
+    def indexes(self, collision):
+        return [(self.by_year, collision.year),
+                (self.by_motor_vehicle_with, collision.motor_vehicle_with),
+                (self.by_intersection, collision.intersection_string())]
+
+    def unindex(self, collision):
+        for (index, key) in self.indexes(collision):
+            del index[key][collision.id]
+            if not index[key]:
+                del index[key]
+
+    def add_collision(self, collision):
+        # Later records with the same id replace earlier ones, but keep the
+        # parties and victims that were already added for the id.
+        previous = self.collisions.pop(collision.id, None)
+        if previous is not None:
+            self.unindex(previous)
+        self.collisions[collision.id] = collision
+
+        # Parties and victims may be added before or after their collision, so
+        # the collision shares the list kept in the index.
+        collision.parties = self.parties_by_collision_id[collision.id]
+        collision.victims = self.victims_by_collision_id[collision.id]
+
+        for (index, key) in self.indexes(collision):
+            index[key][collision.id] = collision
+        return collision
+
+    def remove_collision(self, collision_id):
+        collision = self.collisions.pop(collision_id, None)
+        if collision is None:
+            return None
+        self.unindex(collision)
+        self.parties_by_collision_id.pop(collision_id, None)
+        self.victims_by_collision_id.pop(collision_id, None)
+        return collision
+
+    def add_party(self, party):
+        self.parties_by_collision_id[party.collision_id].append(party)
+        return party
+
+    def add_victim(self, victim):
+        self.victims_by_collision_id[victim.collision_id].append(victim)
+        return victim
+
+    def add_rows(self, collision_rows=(), party_rows=(), victim_rows=()):
+        for row in collision_rows:
+            self.add_collision(Collision(row))
+        for row in party_rows:
+            self.add_party(Party(row))
+        for row in victim_rows:
+            self.add_victim(Victim(row))
+
+    # Years are integers, as they are in the collisions table.
+    def in_year(self, year):
+        return list(self.by_year.get(year, {}).values())
+
+    def with_motor_vehicle(self, *codes):
+        return [collision for code in codes for collision in self.by_motor_vehicle_with.get(code, {}).values()]
+
+    def intersections(self):
+        return list(self.by_intersection)
+
+    def at_intersection(self, intersection):
+        return list(self.by_intersection.get(intersection, {}).values())
+
+    def parties_for(self, collision_id):
+        return list(self.parties_by_collision_id.get(collision_id, []))
 
+    def victims_for(self, collision_id):
+        return list(self.victims_by_collision_id.get(collision_id, []))
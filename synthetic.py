@@ -0,0 +1,151 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Generates SWITRS-shaped CSV files for benchmarks, laid out like a city
+# directory, with collisions spread over a grid of street intersections.
+
+import csv
+import math
+import os
+import random
+import switrs
+
+STREET_SUFFIXES = ['ST', 'AV', 'BL', 'WY', 'DR']
+CROSS_STREET_NAMES = ['BROADWAY', 'TELEGRAPH', 'MARKET', 'GRAND', 'HIGH', 'FRUITVALE', 'LAKESHORE',
+                      'INTERNATIONAL', 'FOOTHILL', 'MACARTHUR', 'PIEDMONT', 'SAN PABLO', 'COLLEGE',
+                      'CLAREMONT', 'SHATTUCK', 'ADELINE', 'MARTIN LUTHER KING JR', 'WEBSTER']
+GRID_ORIGIN = (37.75, -122.30)
+GRID_SPACING = 0.002
+
+# Roughly the mix of SWITRS motor_vehicle_with codes, with pedestrians (B) and
+# bicycles (G) making up about a quarter of all collisions.
+MOTOR_VEHICLE_WITH = ['B', 'G', 'C', 'C', 'C', 'D', 'E', 'I']
+
+COLLISION_FIELDS = dict((name, index) for (index, name) in enumerate(switrs.Collision.fields))
+
+
+def numbered_street(number):
+    if number % 100 in (11, 12, 13):
+        suffix = 'TH'
+    else:
+        suffix = {1: 'ST', 2: 'ND', 3: 'RD'}.get(number % 10, 'TH')
+    return '{0}{1} ST'.format(number, suffix)
+
+
+def cross_street(number):
+    name = CROSS_STREET_NAMES[number % len(CROSS_STREET_NAMES)]
+    if number >= len(CROSS_STREET_NAMES):
+        name = '{0} {1}'.format(name, number // len(CROSS_STREET_NAMES) + 1)
+    return '{0} {1}'.format(name, STREET_SUFFIXES[number % len(STREET_SUFFIXES)])
+
+
+# Returns (primary road, secondary road, latitude, longitude) for each of the
+# given number of intersections, on a roughly square grid of streets.
+def intersections(count):
+    side = max(1, int(math.ceil(math.sqrt(count))))
+    result = []
+    for index in range(count):
+        (row, column) = divmod(index, side)
+        result.append((numbered_street(row + 1), cross_street(column),
+                       round(GRID_ORIGIN[0] + row * GRID_SPACING, 7),
+                       round(GRID_ORIGIN[1] + column * GRID_SPACING, 7)))
+    return result
+
+
+def collision_row(rng, case_id, year, intersection, geocoded):
+    row = [''] * len(switrs.source_field_names(switrs.COLLISION_SCHEMA))
+    fields = COLLISION_FIELDS
+    motor_vehicle_with = rng.choice(MOTOR_VEHICLE_WITH)
+    party_count = rng.randint(1, 3)
+    victim_count = rng.randint(0, 2) if motor_vehicle_with in ('B', 'G') else rng.randint(0, 1)
+
+    row[fields['id']] = case_id
+    row[fields['year']] = str(year)
+    row[fields['process_date']] = '{0}1231'.format(year)
+    row[fields['jurisdiction']] = '0109'
+    row[fields['date']] = '{0}{1:02d}{2:02d}'.format(year, rng.randint(1, 12), rng.randint(1, 28))
+    row[fields['time']] = '{0:02d}{1:02d}'.format(rng.randint(0, 23), rng.randint(0, 59))
+    row[fields['day_of_week']] = str(rng.randint(1, 7))
+    row[fields['county_city_location']] = '0109'
+    row[fields['primary_road']] = intersection[0]
+    row[fields['secondary_road']] = intersection[1]
+    row[fields['distance']] = str(rng.choice([0, 0, 0, 25, 50, 100]))
+    row[fields['intersection']] = rng.choice(['Y', 'N'])
+    row[fields['collision_severity']] = str(rng.randint(0, 4))
+    row[fields['killed_count']] = '0'
+    row[fields['injured_count']] = str(victim_count)
+    row[fields['party_count']] = str(party_count)
+    row[fields['motor_vehicle_with']] = motor_vehicle_with
+    row[fields['pedestrian_collision']] = 'Y' if motor_vehicle_with == 'B' else ''
+    row[fields['bicycle_collision']] = 'Y' if motor_vehicle_with == 'G' else ''
+    for name in switrs.Collision.fields[63:72]:
+        row[fields[name]] = '0'
+    if geocoded:
+        row[fields['latitude']] = str(intersection[2])
+        row[fields['longitude']] = str(intersection[3])
+    return (row, party_count, victim_count)
+
+
+def party_row(rng, case_id, number):
+    # Party records carry three extra undocumented fields beyond the schema.
+    row = [''] * (len(switrs.PARTY_SCHEMA) + 3)
+    row[0] = case_id
+    row[1] = str(number)
+    row[2] = '1'
+    row[3] = rng.choice(['Y', 'N'])
+    row[4] = rng.choice(['M', 'F', '-'])
+    row[5] = str(rng.randint(16, 90))
+    row[21] = '0'
+    row[22] = '0'
+    row[24] = str(rng.randint(1980, 2013))
+    return row
+
+
+def victim_row(rng, case_id):
+    row = [''] * len(switrs.VICTIM_SCHEMA)
+    row[0] = case_id
+    row[1] = '1'
+    row[2] = rng.choice(['2', '3', '4'])
+    row[3] = rng.choice(['M', 'F', '-'])
+    row[4] = str(rng.choice([rng.randint(0, 90), 998]))
+    row[5] = str(rng.choice([0, 1, 2, 3, 4, 4, 4]))
+    return row
+
+
+# Writes CollisionRecords.txt, PartyRecords.txt and VictimRecords.txt for each
+# year into city_directory/<year>. With geocoded set, collisions already carry
+# the coordinates of their intersection, so the geocoding stage can be skipped.
+def write_city(city_directory, years, collisions_per_year, intersection_count, seed=0, geocoded=False):
+    rng = random.Random(seed)
+    points = intersections(intersection_count)
+    case_id = 1000000
+    for year in years:
+        year_directory = os.path.join(city_directory, str(year))
+        os.makedirs(year_directory, exist_ok=True)
+        with open(os.path.join(year_directory, 'CollisionRecords.txt'), 'w', newline='') as collision_file, \
+             open(os.path.join(year_directory, 'PartyRecords.txt'), 'w', newline='') as party_file, \
+             open(os.path.join(year_directory, 'VictimRecords.txt'), 'w', newline='') as victim_file:
+            collision_writer = csv.writer(collision_file)
+            party_writer = csv.writer(party_file)
+            victim_writer = csv.writer(victim_file)
+            for i in range(collisions_per_year):
+                case_id += 1
+                (row, party_count, victim_count) = collision_row(rng, str(case_id), year,
+                                                                 rng.choice(points), geocoded)
+                collision_writer.writerow(row)
+                for number in range(1, party_count + 1):
+                    party_writer.writerow(party_row(rng, str(case_id), number))
+                for number in range(victim_count):
+                    victim_writer.writerow(victim_row(rng, str(case_id)))
+    return points
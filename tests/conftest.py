@@ -0,0 +1,46 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import os
+import pytest
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import synthetic
+
+
+# The pipeline stages are scripts with dashes in their names, so they are loaded
+# by path rather than imported.
+@pytest.fixture
+def load_script():
+    def load(name):
+        spec = importlib.util.spec_from_file_location(name.replace('-', '_')[:-3], os.path.join(ROOT, name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
+
+
+# A small geocoded synthetic city, collected into all-collisions.db.
+@pytest.fixture
+def city_directory(tmp_path):
+    directory = str(tmp_path / 'City')
+    synthetic.write_city(directory, [2013], 200, 20, geocoded=True)
+    subprocess.run([sys.executable, os.path.join(ROOT, 'collect-switr-data-into-sqlite.py'), directory],
+                   check=True, stdout=subprocess.DEVNULL)
+    return directory
@@ -0,0 +1,72 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import analytics
+import csv
+import os
+import sqlite3
+import synthetic
+
+
+def set_first_collision_time(city_directory, time):
+    path = os.path.join(city_directory, '2013', 'CollisionRecords.txt')
+    with open(path, newline='') as records:
+        rows = list(csv.reader(records))
+    rows[0][synthetic.COLLISION_FIELDS['time']] = time
+    with open(path, 'w', newline='') as records:
+        csv.writer(records).writerows(rows)
+    return rows[0][synthetic.COLLISION_FIELDS['id']]
+
+
+# SWITRS records an unknown time as 2500, which both loaders treat as midnight.
+def test_csv_and_database_agree_on_unknown_time(tmp_path):
+    city_directory = str(tmp_path / 'City')
+    synthetic.write_city(city_directory, [2013], 50, 5)
+    collision_id = set_first_collision_time(city_directory, '2500')
+
+    from_csv = analytics.load_csv(os.path.join(city_directory, '2013', 'CollisionRecords.txt'), 'collisions')
+    histogram = analytics.hour_histogram(from_csv)
+    assert len(histogram) == 24
+    assert histogram.sum() == len(from_csv)
+
+    unknown = from_csv['id'].values() == collision_id
+    assert analytics.hours(from_csv)[unknown].tolist() == [0]
+    assert analytics.times_of_day(from_csv)[unknown].tolist() == [3]
+
+
+def test_csv_matches_database(city_directory):
+    from_csv = analytics.load_csv(os.path.join(city_directory, '2013', 'CollisionRecords.txt'), 'collisions')
+    connection = sqlite3.connect(os.path.join(city_directory, 'all-collisions.db'))
+    from_database = analytics.load_table(connection, 'collisions')
+    connection.close()
+
+    assert analytics.hour_histogram(from_csv).tolist() == analytics.hour_histogram(from_database).tolist()
+    assert analytics.years(from_csv).tolist() == analytics.years(from_database).tolist()
+
+
+def test_cached_tables_include_commits_in_the_wal(city_directory, tmp_path):
+    database_path = os.path.join(city_directory, 'all-collisions.db')
+    cache_path = str(tmp_path / 'tables.npz')
+    loaded = analytics.load_database(database_path, cache_path)
+
+    # Until the last connection closes, the commit stays in the -wal file and the
+    # database file itself is unchanged.
+    connection = sqlite3.connect(database_path)
+    try:
+        with connection:
+            connection.execute('DELETE FROM collisions WHERE rowid IN (SELECT rowid FROM collisions LIMIT 10)')
+        reloaded = analytics.load_database(database_path, cache_path)
+    finally:
+        connection.close()
+    assert len(reloaded['collisions']) == len(loaded['collisions']) - 10
@@ -0,0 +1,94 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import archives
+import csv
+import gzip
+import os
+import pytest
+import shutil
+import synthetic
+import zipfile
+
+FILENAMES = ['CollisionRecords.txt', 'PartyRecords.txt', 'VictimRecords.txt']
+
+
+def read_rows(location):
+    with archives.open_records(location) as records:
+        return list(csv.reader(records))
+
+
+def compress_year(directory, suffix):
+    for filename in FILENAMES:
+        path = os.path.join(directory, filename)
+        with open(path, 'rb') as records, archives.COMPRESSED_SUFFIXES[suffix](path + suffix, 'wb') as compressed:
+            shutil.copyfileobj(records, compressed)
+        os.remove(path)
+
+
+def zip_year(directory, zip_path, prefix):
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for filename in FILENAMES:
+            archive.write(os.path.join(directory, filename), prefix + filename)
+
+
+# Every way of storing a year reads the same rows as the extracted files.
+def test_archived_years_read_like_extracted_files(tmp_path):
+    city_directory = str(tmp_path / 'City')
+    synthetic.write_city(city_directory, [2013], 50, 10)
+    plain_directory = os.path.join(city_directory, '2013')
+    expected = dict((filename, read_rows((os.path.join(plain_directory, filename), None))) for filename in FILENAMES)
+    with open(os.path.join(plain_directory, 'CollisionRecords.txt'), newline='') as records:
+        assert expected['CollisionRecords.txt'] == list(csv.reader(records))
+
+    for (year, suffix) in [('2014', '.gz'), ('2015', '.bz2'), ('2016', '.xz')]:
+        shutil.copytree(plain_directory, os.path.join(city_directory, year))
+        compress_year(os.path.join(city_directory, year), suffix)
+    # A zip archive inside a year directory, and a year that is a zip archive
+    # with its files in a subdirectory.
+    os.makedirs(os.path.join(city_directory, '2017'))
+    zip_year(plain_directory, os.path.join(city_directory, '2017', 'records.zip'), '')
+    zip_year(plain_directory, os.path.join(city_directory, '2018.zip'), 'CollisionRecords/')
+
+    sources = archives.find_year_sources(city_directory, FILENAMES)
+    assert [source.key for source in sources] == ['2013', '2014', '2015', '2016', '2017', '2018.zip']
+    assert sources[1].paths == sorted(os.path.join(city_directory, '2014', filename + '.gz') for filename in FILENAMES)
+    assert sources[4].paths == [os.path.join(city_directory, '2017', 'records.zip')]
+    for source in sources:
+        for filename in FILENAMES:
+            assert read_rows(source.records[filename]) == expected[filename], (source.key, filename)
+
+
+def test_missing_records_are_an_error(tmp_path):
+    city_directory = str(tmp_path / 'City')
+    synthetic.write_city(city_directory, [2013], 10, 5)
+    os.remove(os.path.join(city_directory, '2013', 'VictimRecords.txt'))
+    with pytest.raises(IOError, match='VictimRecords.txt'):
+        archives.find_year_sources(city_directory, FILENAMES)
+
+
+# Closing a reader part way through has to stop its thread, which is blocked
+# waiting for room in the full queue of chunks.
+def test_closing_reader_mid_stream_stops_thread(tmp_path):
+    path = str(tmp_path / 'records.gz')
+    with gzip.open(path, 'wb') as records:
+        records.write(b'0123456789' * 10000)
+
+    reader = archives.BackgroundReader(lambda: gzip.open(path, 'rb'), chunk_size=16)
+    assert reader.read(16) == b'0123456789012345'
+    assert reader.thread.is_alive()
+    reader.close()
+    assert not reader.thread.is_alive()
+    assert reader.closed
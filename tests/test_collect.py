@@ -0,0 +1,165 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import os
+import shutil
+import spatial
+import sqlite3
+import subprocess
+import sys
+import synthetic
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Returns the years that were read. The script is run in a separate process,
+# since its worker processes need to import it by name.
+def collect(city_directory, *arguments):
+    output = subprocess.run([sys.executable, os.path.join(ROOT, 'collect-switr-data-into-sqlite.py'), city_directory] + \
+                            list(arguments), check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return [line[len('Reading data from '):] for line in output.splitlines() if line.startswith('Reading data from ')]
+
+
+def database(city_directory):
+    return os.path.join(city_directory, 'all-collisions.db')
+
+
+def query(database_path, statement):
+    connection = sqlite3.connect(database_path)
+    try:
+        return connection.execute(statement).fetchall()
+    finally:
+        connection.close()
+
+
+# Changes the time of the first collision of a year to the unknown time, which
+# is loaded as midnight, and returns its id.
+def modify_year(city_directory, year):
+    path = os.path.join(city_directory, str(year), 'CollisionRecords.txt')
+    with open(path, newline='') as records:
+        rows = list(csv.reader(records))
+    rows[0][synthetic.COLLISION_FIELDS['time']] = '2500'
+    with open(path, 'w', newline='') as records:
+        csv.writer(records).writerows(rows)
+    return rows[0][synthetic.COLLISION_FIELDS['id']]
+
+
+def contents(database_path):
+    return [query(database_path, 'SELECT * FROM {0} ORDER BY 1, 2'.format(table))
+            for table in ['collisions', 'parties', 'victims']]
+
+
+def assert_spatial_index_matches(database_path):
+    indexed = query(database_path, 'SELECT count(*) FROM collision_locations')
+    located = query(database_path, 'SELECT count(*) FROM collisions WHERE {0}'.format(spatial.LOCATED))
+    assert indexed == located
+
+
+def test_rerun_without_changes_reads_nothing(tmp_path):
+    city_directory = str(tmp_path / 'City')
+    synthetic.write_city(city_directory, [2013, 2014], 100, 10, geocoded=True)
+    assert collect(city_directory) == ['2013', '2014']
+    loaded = contents(database(city_directory))
+
+    assert collect(city_directory) == []
+    assert contents(database(city_directory)) == loaded
+
+
+def test_modified_year_is_the_only_one_read_again(tmp_path):
+    city_directory = str(tmp_path / 'City')
+    synthetic.write_city(city_directory, [2013, 2014, 2015], 100, 10, geocoded=True)
+    collect(city_directory)
+    database_path = database(city_directory)
+    counts = [len(rows) for rows in contents(database_path)]
+
+    collision_id = modify_year(city_directory, 2014)
+    assert collect(city_directory) == ['2014']
+    assert [len(rows) for rows in contents(database_path)] == counts
+    assert query(database_path, "SELECT time FROM collisions WHERE id = '{0}'".format(collision_id)) == [(0,)]
+
+
+def test_reloaded_year_leaves_no_orphans_in_spatial_index(tmp_path):
+    city_directory = str(tmp_path / 'City')
+    synthetic.write_city(city_directory, [2013, 2014], 100, 10, geocoded=True)
+    # A third source with the same collision ids as 2013.
+    shutil.copytree(os.path.join(city_directory, '2013'), os.path.join(city_directory, '2015'))
+    database_path = database(city_directory)
+    collect(city_directory)
+    assert_spatial_index_matches(database_path)
+
+    modify_year(city_directory, 2014)
+    collect(city_directory)
+    assert_spatial_index_matches(database_path)
+    assert query(database_path, 'SELECT count(*) FROM collision_locations') == [(200,)]
+
+
+def test_collision_from_two_sources_is_loaded_once(tmp_path):
+    city_directory = str(tmp_path / 'City')
+    synthetic.write_city(city_directory, [2013], 100, 10, geocoded=True)
+    database_path = database(city_directory)
+    collect(city_directory)
+    loaded = contents(database_path)
+
+    # A copy of 2013, which provides every one of its collisions a second time.
+    shutil.copytree(os.path.join(city_directory, '2013'), os.path.join(city_directory, '2014'))
+    collect(city_directory)
+    assert contents(database_path) == loaded
+
+    modify_year(city_directory, 2014)
+    collect(city_directory)
+    assert [len(rows) for rows in contents(database_path)] == [len(rows) for rows in loaded]
+
+    # 2013 still provides the collisions of the removed copy, in its own version.
+    shutil.rmtree(os.path.join(city_directory, '2014'))
+    collect(city_directory)
+    assert contents(database_path) == loaded
+
+
+def test_parallel_load_matches_serial_load(tmp_path):
+    serial_directory = str(tmp_path / 'Serial')
+    parallel_directory = str(tmp_path / 'Parallel')
+    for city_directory in [serial_directory, parallel_directory]:
+        synthetic.write_city(city_directory, [2012, 2013, 2014], 100, 10, geocoded=True)
+        # A source whose collisions overlap another's, to exercise the merge order.
+        shutil.copytree(os.path.join(city_directory, '2013'), os.path.join(city_directory, '2015'))
+
+    collect(serial_directory)
+    collect(parallel_directory, '-j', '3')
+    assert contents(database(parallel_directory)) == contents(database(serial_directory))
+    assert_spatial_index_matches(database(parallel_directory))
+
+    modify_year(serial_directory, 2013)
+    modify_year(parallel_directory, 2013)
+    collect(serial_directory)
+    collect(parallel_directory, '-j', '3')
+    assert contents(database(parallel_directory)) == contents(database(serial_directory))
+    assert query(database(parallel_directory), 'SELECT * FROM source_collisions ORDER BY 1, 2') == \
+        query(database(serial_directory), 'SELECT * FROM source_collisions ORDER BY 1, 2')
+
+
+# A load has to take time in proportion to its size. Work that grows with the
+# rows already loaded, like a scan of every party for each new collision, makes
+# eight times the rows take far more than eight times as long.
+def test_load_time_grows_linearly(load_script, tmp_path, capsys):
+    module = load_script('collect-switr-data-into-sqlite.py')
+    elapsed = []
+    for collisions_per_year in [200, 1600]:
+        city_directory = str(tmp_path / str(collisions_per_year))
+        synthetic.write_city(city_directory, range(2008, 2016), collisions_per_year, 50)
+        start = time.perf_counter()
+        module.update_database(database(city_directory), city_directory)
+        elapsed.append(time.perf_counter() - start)
+    assert elapsed[1] < 16 * elapsed[0]
@@ -0,0 +1,90 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import columnar
+import json
+import os
+import struct
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Struct formats for the typed arrays, for reading values one at a time.
+STRUCT_FORMATS = {
+    'Int8': '<b', 'Uint8': '<B', 'Int16': '<h', 'Uint16': '<H',
+    'Int32': '<i', 'Uint32': '<I', 'Float32': '<f', 'Float64': '<d',
+}
+
+COLUMNS = [
+    ('severity', 'Uint8', [0, 1, 2, 3, 4]),
+    ('age', 'Int8', [-1, 17, 99]),
+    ('year', 'Uint16', [2001, 2013]),
+    ('change', 'Int16', [-300, 300, 0]),
+    ('offsets', 'Uint32', [0, 5, 4000000000]),
+    ('delta', 'Int32', [-2000000000, 7]),
+    ('latitude', 'Float32', [37.5, -122.25]),
+    ('longitude', 'Float64', [-122.271111, 37.804363, 0.1]),
+    ('empty', 'Uint8', []),
+]
+
+
+# Reads a file the way readColumns in ui/main.js does: the header length is a
+# little-endian uint32 at the start, the header follows it at byte 4, and each
+# column is a typed array view of its length in values from its offset.
+def read_like_ui(data):
+    (header_length,) = struct.unpack_from('<I', data, 0)
+    header = json.loads(data[4:4 + header_length].decode('utf-8'))
+    columns = {}
+    for (name, column) in header['columns'].items():
+        item_format = STRUCT_FORMATS[column['type']]
+        size = struct.calcsize(item_format)
+        # A typed array view has to start at a multiple of its element size.
+        assert column['offset'] % size == 0
+        assert column['offset'] >= 4 + header_length
+        assert column['offset'] + column['length'] * size <= len(data)
+        columns[name] = [struct.unpack_from(item_format, data, column['offset'] + i * size)[0]
+                         for i in range(column['length'])]
+    return (header, columns)
+
+
+def test_columns_decode_to_their_values():
+    data = columnar.encode_columns(COLUMNS, {'version': 1})
+    header = columnar.decode_columns(data)
+    assert header['version'] == 1
+    assert dict((name, list(values)) for (name, values) in header['columns'].items()) == \
+        dict((name, values) for (name, column_type, values) in COLUMNS)
+
+
+def test_header_offsets_match_the_ui_reader(tmp_path):
+    path = str(tmp_path / 'columns.bin')
+    assert columnar.write_columns(path, COLUMNS, {'version': 1}) == os.path.getsize(path)
+    with open(path, 'rb') as columns_file:
+        data = columns_file.read()
+    (header, columns) = read_like_ui(data)
+    assert header['version'] == 1
+    assert columns == dict((name, values) for (name, column_type, values) in COLUMNS)
+    assert dict((name, column['type']) for (name, column) in header['columns'].items()) == \
+        dict((name, column_type) for (name, column_type, values) in COLUMNS)
+
+    # Columns do not overlap.
+    spans = sorted((column['offset'], column['offset'] + column['length'] *
+                    struct.calcsize(STRUCT_FORMATS[column['type']])) for column in header['columns'].values())
+    assert all(end <= next_start for ((start, end), (next_start, next_end)) in zip(spans, spans[1:]))
+
+    # read_like_ui only stands in for the UI while readColumns reads the same way.
+    with open(os.path.join(ROOT, 'ui', 'main.js')) as main_js:
+        source = main_js.read()
+    assert 'new DataView(buffer).getUint32(0, true)' in source
+    assert 'new Uint8Array(buffer, 4, headerLength)' in source
+    assert "new window[column.type + 'Array'](buffer, column.offset, column.length)" in source
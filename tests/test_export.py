@@ -0,0 +1,213 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import columnar
+import json
+import jurisdictions
+import markers
+import os
+import pytest
+import sqlite3
+import subprocess
+import sys
+import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def exported_victim_ages(output_directory):
+    with open(os.path.join(output_directory, 'manifest.json')) as manifest_file:
+        index = json.load(manifest_file)
+
+    ages = []
+    for jurisdiction in index['jurisdictions']:
+        directory = os.path.join(output_directory, jurisdiction['path'])
+        with open(os.path.join(directory, jurisdiction['manifest'])) as manifest_file:
+            section = json.load(manifest_file)['tiles']
+        zoom = section['detail_zoom']
+        for (tile, tile_hash) in section['collisions'].items():
+            (x, y) = tile.split('/')
+            path = os.path.join(directory, section['collisions_url'].format(z=zoom, x=x, y=y, hash=tile_hash))
+            with open(path, 'rb') as tile_file:
+                ages.extend(columnar.decode_columns(tile_file.read())['columns']['victim_age'])
+    return ages
+
+
+def test_victim_with_null_age_is_exported_as_unstated(load_script, city_directory, tmp_path):
+    export = load_script('json-for-collisions.py')
+    connection = sqlite3.connect(os.path.join(city_directory, 'all-collisions.db'))
+    with connection:
+        connection.execute('UPDATE victims SET age = NULL, degree_of_injury = NULL WHERE rowid = ' + \
+                           '(SELECT victims.rowid FROM victims JOIN collisions ON collisions.id = victims.collision_id ' + \
+                           'WHERE {0} LIMIT 1)'.format(export.EXPORTED))
+        victims = connection.execute('SELECT count(*) FROM victims JOIN collisions ON collisions.id = victims.collision_id ' + \
+                                     'WHERE {0}'.format(export.EXPORTED)).fetchone()[0]
+    connection.close()
+
+    output_directory = str(tmp_path / 'ui')
+    export.export_cities([city_directory], (markers.DEFAULT_PRECISION, None), output_directory=output_directory)
+    ages = exported_victim_ages(output_directory)
+    assert len(ages) == victims
+    assert ages.count(export.UNSTATED_AGE) >= 1
+
+
+def test_export_removes_only_stale_jurisdiction_directories(load_script, city_directory, tmp_path):
+    export = load_script('json-for-collisions.py')
+    connection = sqlite3.connect(os.path.join(city_directory, 'all-collisions.db'))
+    with connection:
+        connection.execute("UPDATE collisions SET county_city_location = '' WHERE rowid % 2 = 0")
+    connection.close()
+
+    output_directory = str(tmp_path / 'ui')
+    jurisdictions_directory = os.path.join(output_directory, 'jurisdictions')
+    os.makedirs(os.path.join(jurisdictions_directory, '9999'))
+    os.makedirs(os.path.join(jurisdictions_directory, 'shared'))
+    open(os.path.join(jurisdictions_directory, 'README'), 'w').close()
+
+    export.export_cities([city_directory], (markers.DEFAULT_PRECISION, None), output_directory=output_directory)
+    with open(os.path.join(output_directory, 'manifest.json')) as manifest_file:
+        assert [summary['code'] for summary in json.load(manifest_file)['jurisdictions']] == ['0109']
+    assert sorted(os.listdir(jurisdictions_directory)) == ['0109', 'README', 'shared']
+
+
+def collect_city(city_directory, seed):
+    synthetic.write_city(city_directory, [2012, 2013], 100, 10, seed=seed, geocoded=True)
+    subprocess.run([sys.executable, os.path.join(ROOT, 'collect-switr-data-into-sqlite.py'), city_directory],
+                   check=True, stdout=subprocess.DEVNULL)
+
+
+def set_codes(city_directory, statement):
+    connection = sqlite3.connect(os.path.join(city_directory, 'all-collisions.db'))
+    with connection:
+        connection.execute(statement)
+    connection.close()
+
+
+# Oakland's collisions are mostly in 0109 and Berkeley's in 0103, and both have
+# some in 0101, which is exported from both of their databases.
+@pytest.fixture
+def two_cities(tmp_path):
+    oakland = str(tmp_path / 'Oakland')
+    berkeley = str(tmp_path / 'Berkeley')
+    collect_city(oakland, 0)
+    collect_city(berkeley, 1)
+    set_codes(oakland, "UPDATE collisions SET county_city_location = '0101' WHERE rowid % 3 = 0")
+    set_codes(berkeley, "UPDATE collisions SET county_city_location = CASE WHEN rowid % 4 = 0 " + \
+                        "THEN '0101' ELSE '0103' END")
+    return (oakland, berkeley)
+
+
+def test_jurisdictions_are_partitioned_across_databases(two_cities):
+    (oakland, berkeley) = two_cities
+    found = jurisdictions.find_jurisdictions([oakland, berkeley], '1')
+    assert [(jurisdiction.code, jurisdiction.name) for jurisdiction in found] == \
+        [('0101', 'Alameda County 0101'), ('0103', 'Berkeley'), ('0109', 'Oakland')]
+    assert [len(jurisdiction.database_paths) for jurisdiction in found] == [2, 1, 1]
+    assert [list(jurisdiction.years) for jurisdiction in found] == [[2012, 2013]] * 3
+    assert sum(sum(jurisdiction.years.values()) for jurisdiction in found) == 400
+
+
+def test_export_skips_unchanged_and_removes_stale_jurisdictions(load_script, two_cities, tmp_path, capsys):
+    export = load_script('json-for-collisions.py')
+    output_directory = str(tmp_path / 'ui')
+    options = (markers.DEFAULT_PRECISION, None)
+
+    export.export_cities(two_cities, options, output_directory=output_directory)
+    assert sorted(os.listdir(os.path.join(output_directory, 'jurisdictions'))) == ['0101', '0103', '0109']
+    capsys.readouterr()
+    export.export_cities(two_cities, options, output_directory=output_directory)
+    assert sorted(capsys.readouterr().out.split('\n')) == \
+        ['', 'Unchanged Alameda County 0101', 'Unchanged Berkeley', 'Unchanged Oakland']
+
+    # Only Berkeley's collisions change, so only 0101 and 0103 are exported again.
+    set_codes(two_cities[1], "UPDATE collisions SET county_city_location = '0103'")
+    export.export_cities(two_cities, options, output_directory=output_directory)
+    assert sorted(capsys.readouterr().out.split('\n')) == \
+        ['', 'Exported Alameda County 0101', 'Exported Berkeley', 'Unchanged Oakland']
+
+    set_codes(two_cities[0], "UPDATE collisions SET county_city_location = '0109'")
+    export.export_cities(two_cities, options, output_directory=output_directory)
+    with open(os.path.join(output_directory, 'manifest.json')) as manifest_file:
+        assert [summary['code'] for summary in json.load(manifest_file)['jurisdictions']] == ['0103', '0109']
+    assert sorted(os.listdir(os.path.join(output_directory, 'jurisdictions'))) == ['0103', '0109']
+
+
+# Sums the filter cube cells of every tile at each zoom by year, type and time of
+# day, and the victims they stand for by sex, age group and injury.
+def exported_cube_counts(output_directory):
+    with open(os.path.join(output_directory, 'manifest.json')) as manifest_file:
+        index = json.load(manifest_file)
+
+    counts = {}
+    for jurisdiction in index['jurisdictions']:
+        directory = os.path.join(output_directory, jurisdiction['path'])
+        with open(os.path.join(directory, jurisdiction['manifest'])) as manifest_file:
+            section = json.load(manifest_file)['tiles']
+        for (zoom, available) in section['available'].items():
+            (collisions, victims) = counts.setdefault(int(zoom), ({}, {}))
+            for (tile, tile_hash) in available.items():
+                (x, y) = tile.split('/')
+                path = os.path.join(directory, section['url'].format(z=zoom, x=x, y=y, hash=tile_hash))
+                with open(path, 'rb') as tile_file:
+                    columns = columnar.decode_columns(tile_file.read())['columns']
+                for (cell, count) in enumerate(columns['count']):
+                    key = (columns['year'][cell], columns['type'][cell], columns['time_of_day'][cell])
+                    collisions[key] = collisions.get(key, 0) + count
+                    for victim in range(columns['victim_offsets'][cell], columns['victim_offsets'][cell + 1]):
+                        key = (columns['victim_sex'][victim], columns['victim_age_group'][victim],
+                               columns['victim_injury'][victim])
+                        victims[key] = victims.get(key, 0) + count
+    return counts
+
+
+# The same counts straight from the database, with the UI's codes worked out in SQL.
+COLLISION_CUBE_QUERY = '''
+    SELECT CAST(strftime('%Y', timestamp, 'unixepoch') AS INTEGER),
+           CASE motor_vehicle_with WHEN 'B' THEN 0 WHEN 'G' THEN 1 ELSE 2 END,
+           CASE WHEN CAST(strftime('%H', timestamp, 'unixepoch') AS INTEGER) <= 5 THEN 3
+                WHEN CAST(strftime('%H', timestamp, 'unixepoch') AS INTEGER) <= 11 THEN 0
+                WHEN CAST(strftime('%H', timestamp, 'unixepoch') AS INTEGER) <= 17 THEN 1
+                ELSE 2 END,
+           count(*)
+    FROM collisions WHERE {0} GROUP BY 1, 2, 3'''
+VICTIM_CUBE_QUERY = '''
+    SELECT CASE victims.sex WHEN 'F' THEN 0 WHEN 'M' THEN 1 ELSE 2 END,
+           CASE WHEN victims.age IS NULL THEN 5 WHEN victims.age <= 14 THEN 0 WHEN victims.age <= 24 THEN 1
+                WHEN victims.age <= 49 THEN 2 WHEN victims.age <= 75 THEN 3 WHEN victims.age <= 150 THEN 4
+                ELSE 5 END,
+           CASE WHEN coalesce(victims.degree_of_injury, 0) = 0 THEN 4 ELSE victims.degree_of_injury - 1 END,
+           count(*)
+    FROM victims JOIN collisions ON collisions.id = victims.collision_id WHERE {0} GROUP BY 1, 2, 3'''
+
+
+def test_filter_cube_counts_match_sql_group_by(load_script, city_directory, tmp_path):
+    export = load_script('json-for-collisions.py')
+    connection = sqlite3.connect(os.path.join(city_directory, 'all-collisions.db'))
+    with connection:
+        connection.execute('UPDATE victims SET age = NULL, degree_of_injury = NULL WHERE rowid % 7 = 0')
+    expected_collisions = dict((tuple(row[:3]), row[3])
+                               for row in connection.execute(COLLISION_CUBE_QUERY.format(export.EXPORTED)))
+    expected_victims = dict((tuple(row[:3]), row[3])
+                            for row in connection.execute(VICTIM_CUBE_QUERY.format(export.EXPORTED)))
+    connection.close()
+    assert len(expected_collisions) > 1 and len(expected_victims) > 1
+
+    output_directory = str(tmp_path / 'ui')
+    export.export_cities([city_directory], (markers.DEFAULT_PRECISION, None), output_directory=output_directory)
+    counts = exported_cube_counts(output_directory)
+    assert len(counts) > 1
+    # Every zoom covers all of the collisions, however they are clustered.
+    for (zoom, (collisions, victims)) in counts.items():
+        assert collisions == expected_collisions, zoom
+        assert victims == expected_victims, zoom
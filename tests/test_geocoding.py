@@ -0,0 +1,223 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import geocoding
+import http.server
+import json
+import os
+import pytest
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# A local geocoder that answers each address with the next of its responses, a
+# (status, body) pair, repeating the last one, and counts the requests for each.
+# Addresses are first reduced to the keys of the responses with key.
+class StubGeocoder(http.server.ThreadingHTTPServer):
+    def __init__(self, responses, key=None):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.responses = responses
+        self.key = key or (lambda address: address)
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    def respond(self, address):
+        address = self.key(address)
+        with self.lock:
+            responses = self.responses.get(address, [(404, None)])
+            response = responses[min(self.requests[address], len(responses) - 1)]
+            self.requests[address] += 1
+        return response
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/geocode?q={{address}}'.format(self.server_address[1])
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        address = urllib.parse.unquote(self.path.partition('?q=')[2])
+        (status, body) = self.server.respond(address)
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *arguments):
+        pass
+
+
+@pytest.fixture
+def stub():
+    servers = []
+    def start(responses, key=None):
+        server = StubGeocoder(responses, key)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def pipeline(server, **options):
+    options.setdefault('rate', 1000.0)
+    options.setdefault('backoff', 0.01)
+    return geocoding.GeocodingPipeline(geocoding.HTTPBackend(server.url), **options)
+
+
+def test_token_bucket_limits_the_rate_after_a_burst():
+    bucket = geocoding.TokenBucket(rate=50.0, capacity=3)
+    start = time.monotonic()
+    for i in range(3):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.02
+
+    for i in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start >= 5 / 50.0 - 0.01
+
+
+def test_response_formats(stub):
+    server = stub({
+        'pair': [(200, [37.8, -122.2])],
+        'object': [(200, {'lat': '37.8', 'lon': '-122.2'})],
+        'list': [(200, [{'lat': 37.8, 'lng': -122.2}, {'lat': 0, 'lng': 0}])],
+        'empty': [(200, [])],
+    })
+    backend = geocoding.HTTPBackend(server.url)
+    for address in ['pair', 'object', 'list']:
+        assert backend.geocode(address) == [37.8, -122.2]
+    for address in ['empty', 'unknown']:
+        with pytest.raises(geocoding.NoResultError):
+            backend.geocode(address)
+
+
+def test_pipeline_retries_errors_but_not_missing_results(stub):
+    server = stub({
+        'flaky': [(500, None), (200, [37.8, -122.2])],
+        'broken': [(500, None)],
+    })
+    results = dict((address, (location, error)) for (address, location, error) in
+                   pipeline(server, retries=2).geocode_all(['flaky', 'broken', 'missing']))
+
+    assert results['flaky'] == ([37.8, -122.2], None)
+    assert server.requests['flaky'] == 2
+    assert isinstance(results['broken'][1], urllib.error.HTTPError)
+    assert server.requests['broken'] == 3
+    assert isinstance(results['missing'][1], geocoding.NoResultError)
+    assert server.requests['missing'] == 1
+
+
+def test_pipeline_backs_off_exponentially(stub):
+    server = stub({'broken': [(500, None)]})
+    start = time.monotonic()
+    with pytest.raises(urllib.error.HTTPError):
+        pipeline(server, retries=3, backoff=0.05).geocode('broken')
+    # Waits of 0.05, 0.1 and 0.2 seconds between the four attempts.
+    assert time.monotonic() - start >= 0.35
+    assert server.requests['broken'] == 4
+
+
+def test_pipeline_sends_each_address_once(stub):
+    server = stub({'a': [(200, [1, 2])], 'b': [(200, [3, 4])]})
+    results = list(pipeline(server, workers=4).geocode_all(['a', 'b', 'a', 'a', 'b']))
+    assert sorted(address for (address, location, error) in results) == ['a', 'b']
+    assert server.requests == {'a': 1, 'b': 1}
+
+
+def test_collisions_at_one_intersection_are_geocoded_once(load_script, stub, tmp_path):
+    module = load_script('add-location-to-database.py')
+    # Whichever spelling is sent, the stub knows where the intersection is.
+    server = stub({'1ST ST and MARKET ST': [(200, [37.8, -122.2])]},
+                  key=lambda address: geocoding.normalize_location_key(address[:-len(', City, CA')]))
+    city_directory = tmp_path / 'City'
+    city_directory.mkdir()
+    geocoder = module.CollisionGoecoder(str(city_directory), pipeline(server))
+
+    # SWITRS spells the same intersection in several ways.
+    geocoder.geocode_locations(['1ST ST and MARKET ST', 'MARKET ST and 1ST ST', '1st st  and market st',
+                                '1ST ST and MARKET ST', '2ND ST and MARKET ST'])
+    assert sum(server.requests.values()) == 2
+    assert geocoder.get_location('MARKET ST and 1ST ST') == [37.8, -122.2]
+
+    # No result is cached too, so it is only asked for again when retrying failures.
+    assert geocoder.location_database.lookup('2ND ST and MARKET ST') == (True, None)
+    assert geocoder.get_location('2ND ST and MARKET ST') == [0, 0]
+    geocoder.geocode_locations(['2ND ST and MARKET ST', '1ST ST and MARKET ST'])
+    assert sum(server.requests.values()) == 2
+    geocoder.retry_failures = True
+    geocoder.geocode_locations(['2ND ST and MARKET ST', '1ST ST and MARKET ST'])
+    assert sum(server.requests.values()) == 3
+    geocoder.location_database.close()
+
+
+def test_location_cache_round_trip(tmp_path):
+    path = str(tmp_path / 'locations.db')
+    cache = geocoding.LocationCache(path, 'City')
+    assert cache.lookup('1ST ST and MARKET ST') == (False, None)
+    cache.store('1ST ST and MARKET ST', [37.8, -122.2])
+    # A location that could not be found is remembered as such.
+    cache.store('2ND ST and MARKET ST', None)
+    assert cache.get('market st  and 1st st') == [37.8, -122.2]
+    assert cache.lookup('2ND ST and MARKET ST') == (True, None)
+    cache.close()
+
+    # Read back from disk rather than from the memo, and only in its namespace.
+    cache = geocoding.LocationCache(path, 'City')
+    assert len(cache) == 2
+    assert cache.lookup('MARKET ST and 1ST ST') == (True, [37.8, -122.2])
+    assert cache.lookup('MARKET ST and 2ND ST') == (True, None)
+    assert '3RD ST and MARKET ST' not in cache
+    assert list(cache.items()) == [('1ST ST and MARKET ST', [37.8, -122.2])]
+
+    # A negative entry is replaced once the location is found.
+    cache.store('2ND ST and MARKET ST', [37.9, -122.3])
+    assert cache.get('2ND ST and MARKET ST') == [37.9, -122.3]
+    assert len(cache) == 2
+    cache.close()
+
+    other_cache = geocoding.LocationCache(path, 'Other City')
+    assert len(other_cache) == 0
+    assert other_cache.lookup('1ST ST and MARKET ST') == (False, None)
+    other_cache.close()
+
+
+def test_import_legacy_locations_json(tmp_path):
+    city_directory = tmp_path / 'City'
+    city_directory.mkdir()
+    locations = {'1ST ST and MARKET ST': [37.8, -122.2], '2ND ST and MARKET ST': None}
+    (city_directory / 'locations.json').write_text(json.dumps(locations))
+
+    output = subprocess.run([sys.executable, os.path.join(ROOT, 'import-locations-json.py'),
+                             str(city_directory / 'locations.json')],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert output == 'Imported 2 locations\n'
+
+    # The cache goes next to the JSON file, in the namespace of its directory.
+    cache = geocoding.LocationCache(str(city_directory / 'locations.db'), 'City')
+    assert cache.lookup('MARKET ST and 1ST ST') == (True, [37.8, -122.2])
+    assert cache.lookup('2ND ST and MARKET ST') == (True, None)
+    assert len(cache) == 2
+    cache.close()
@@ -0,0 +1,47 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pytest
+
+
+@pytest.fixture
+def server(load_script, city_directory, tmp_path):
+    module = load_script('serve-collisions.py')
+    static_directory = tmp_path / 'ui'
+    static_directory.mkdir()
+    (static_directory / 'main.js').write_text('var collisions = [];\n' * 100)
+    server = module.CollisionServer(os.path.join(city_directory, 'all-collisions.db'), str(static_directory))
+    yield (module, server)
+    server.close()
+
+
+def test_years_out_of_range_are_bad_requests(server):
+    (module, server) = server
+    assert module.parse_filters('year=2013,2014') == (('year', (2013, 2014)),)
+    for years in ['99999999999999999999', '2013,1800']:
+        with pytest.raises(module.BadRequest):
+            module.parse_filters('year=' + years)
+
+
+def test_static_files_are_compressed_once(server, tmp_path):
+    (module, server) = server
+    response = server.static_response('/main.js')
+    assert response.gzipped is not None
+    assert server.static_response('/main.js') is response
+
+    (tmp_path / 'ui' / 'main.js').write_text('var collisions = [1];\n' * 100)
+    changed = server.static_response('/main.js')
+    assert changed.etag != response.etag
+    assert changed.body.startswith(b'var collisions = [1];')
@@ -0,0 +1,89 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hotspots
+import os
+import pytest
+import spatial
+import sqlite3
+import synthetic
+
+
+@pytest.fixture
+def connection(city_directory):
+    connection = sqlite3.connect(os.path.join(city_directory, 'all-collisions.db'))
+    yield connection
+    connection.close()
+
+
+def ids_in_bbox(connection, south, west, north, east):
+    return sorted(row[0] for row in spatial.collisions_in_bbox(connection, south, west, north, east, columns='c.id'))
+
+
+def scanned_ids_in_bbox(connection, south, west, north, east):
+    return sorted(row[0] for row in connection.execute(
+        'SELECT id FROM collisions WHERE {0} AND latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?'.format(
+            spatial.LOCATED), (south, north, west, east)))
+
+
+def test_bbox_query_matches_a_scan(connection):
+    (latitude, longitude) = synthetic.GRID_ORIGIN
+    for size in [0.0, synthetic.GRID_SPACING, 2.5 * synthetic.GRID_SPACING, 1.0]:
+        bbox = (latitude - size / 3, longitude - size / 3, latitude + size, longitude + size)
+        assert ids_in_bbox(connection, *bbox) == scanned_ids_in_bbox(connection, *bbox)
+    assert ids_in_bbox(connection, 0.0, 0.0, 1.0, 1.0) == []
+
+
+def test_radius_query_is_nearest_first_and_within_radius(connection):
+    (latitude, longitude) = synthetic.GRID_ORIGIN
+    radius = 300.0
+    found = spatial.collisions_within(connection, latitude, longitude, radius, columns='c.latitude, c.longitude, c.id')
+    distances = [meters for (meters, row) in found]
+    assert distances == sorted(distances)
+    assert all(meters <= radius for meters in distances)
+
+    everything = connection.execute('SELECT latitude, longitude, id FROM collisions WHERE {0}'.format(spatial.LOCATED))
+    expected = [row[2] for row in everything if spatial.distance(latitude, longitude, row[0], row[1]) <= radius]
+    assert sorted(row[2] for (meters, row) in found) == sorted(expected)
+    assert expected
+
+
+def test_index_follows_geocoding_and_removal(connection):
+    (collision_id,) = connection.execute('SELECT id FROM collisions LIMIT 1').fetchone()
+    with connection:
+        connection.execute('UPDATE collisions SET latitude = 10.0, longitude = 20.0 WHERE id = ?', (collision_id,))
+    assert ids_in_bbox(connection, 9.9, 19.9, 10.1, 20.1) == [collision_id]
+
+    # The geocoder stores [0, 0] for locations it could not find.
+    with connection:
+        connection.execute('UPDATE collisions SET latitude = 0, longitude = 0 WHERE id = ?', (collision_id,))
+    assert ids_in_bbox(connection, -1.0, -1.0, 1.0, 1.0) == []
+
+    with connection:
+        connection.execute('UPDATE collisions SET latitude = 10.0, longitude = 20.0 WHERE id = ?', (collision_id,))
+        connection.execute('DELETE FROM collisions WHERE id = ?', (collision_id,))
+    assert ids_in_bbox(connection, 9.9, 19.9, 10.1, 20.1) == []
+    assert connection.execute('SELECT count(*) FROM collision_locations').fetchone() == \
+        connection.execute('SELECT count(*) FROM collisions WHERE {0}'.format(spatial.LOCATED)).fetchone()
+
+
+def test_hotspots_rank_cells_by_weight(connection):
+    weighted = hotspots.weighted_collisions(connection)
+    assert len(weighted) == connection.execute('SELECT count(*) FROM collisions').fetchone()[0]
+
+    ranked = hotspots.rank_hotspots(weighted, limit=5)
+    assert [hotspot.score for hotspot in ranked] == sorted([hotspot.score for hotspot in ranked], reverse=True)
+    assert sum(hotspot.collisions for hotspot in hotspots.rank_hotspots(weighted, limit=len(weighted))) == len(weighted)
+    # Collisions are all at intersections, so each cell is named after one.
+    assert all(' and ' in hotspot.location for hotspot in ranked)
@@ -0,0 +1,132 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+import streets
+
+OSM = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="37.7750" lon="-122.2240"/>
+  <node id="2" lat="37.7760" lon="-122.2230"/>
+  <node id="3" lat="37.7770" lon="-122.2220"/>
+  <way id="10">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <tag k="highway" v="primary"/>
+    <tag k="name" v="International Boulevard"/>
+    <tag k="ref" v="SR 185"/>
+  </way>
+  <way id="11">
+    <nd ref="2"/>
+    <tag k="highway" v="residential"/>
+    <tag k="name" v="Fruitvale Avenue"/>
+  </way>
+  <way id="12">
+    <nd ref="3"/>
+    <tag k="waterway" v="stream"/>
+    <tag k="name" v="Sausal Creek"/>
+  </way>
+</osm>
+'''
+
+
+@pytest.mark.parametrize('name, normalized', [
+    ('International Boulevard', 'INTERNATIONAL BL'),
+    ('Fruitvale Ave.', 'FRUITVALE AV'),
+    ('Martin Luther King Junior Way', 'MARTIN LUTHER KING JR WY'),
+    ('North Main Street', 'N MAIN ST'),
+    ('E. 14th St', 'E 14TH ST'),
+    ('Third Avenue', '3RD AV'),
+    ('2000 BLK High St', 'HIGH ST'),
+    ('Broadway 2100', 'BROADWAY'),
+    ('Interstate 580', 'RT 580'),
+    ('HWY-24', 'RT 24'),
+    ('State Route 13 E', 'RT 13 E'),
+])
+def test_normalize_road(name, normalized):
+    assert streets.normalize_road(name) == normalized
+
+
+@pytest.fixture
+def index():
+    index = streets.IntersectionIndex()
+    index.add_intersection('International Boulevard', 'Fruitvale Avenue', [37.776, -122.223])
+    index.add_intersection('East 12th Street', '5th Avenue', [37.790, -122.250])
+    return index
+
+
+@pytest.mark.parametrize('location_key, location', [
+    ('INTERNATIONAL BL and FRUITVALE AV', [37.776, -122.223]),
+    ('FRUITVALE AV and INTERNATIONAL BL', [37.776, -122.223]),
+    # Missing street types.
+    ('INTERNATIONAL and FRUITVALE', [37.776, -122.223]),
+    # Misspellings.
+    ('INTERNATONAL BL and FRUITVALE AV', [37.776, -122.223]),
+    ('INTERNATIONAL BL and FRUITVAL AV', [37.776, -122.223]),
+    ('E 12TH ST and 5TH AV', [37.790, -122.250]),
+    # Numbered streets only match the same numbers.
+    ('E 12TH ST and 6TH AV', None),
+    ('E 13TH ST and 5TH AV', None),
+    ('MACARTHUR BL and FRUITVALE AV', None),
+    ('INTERNATIONAL BL', None),
+])
+def test_resolve(index, location_key, location):
+    assert index.resolve(location_key) == location
+
+
+def test_resolve_special_location(index):
+    assert index.resolve('RT 80 and METERING LIGHTS') == [37.82479, -122.31384]
+
+
+def test_load_csv(tmp_path):
+    path = str(tmp_path / 'intersections.csv')
+    with open(path, 'w') as csv_file:
+        csv_file.write('road,other road,latitude,longitude\n')
+        csv_file.write('International Boulevard,Fruitvale Avenue,37.776,-122.223\n')
+        csv_file.write('High Street,Foothill Boulevard,,\n')
+
+    index = streets.IntersectionIndex()
+    index.load(path)
+    assert len(index) == 1
+    assert index.resolve('INTERNATIONAL BL and FRUITVALE AV') == [37.776, -122.223]
+    assert index.resolve('HIGH ST and FOOTHILL BL') is None
+
+
+def test_load_osm(tmp_path):
+    path = str(tmp_path / 'city.osm')
+    with open(path, 'w') as osm_file:
+        osm_file.write(OSM)
+
+    index = streets.IntersectionIndex()
+    index.load(path)
+    # Both the name and the ref of a way cross the other way, but a way never
+    # crosses itself and only highways are roads.
+    assert len(index) == 3
+    assert index.resolve('INTERNATIONAL BL and FRUITVALE AV') == [37.776, -122.223]
+    assert index.resolve('RT 185 and FRUITVALE AV') == [37.776, -122.223]
+    assert index.resolve('INTERNATIONAL BL and SAUSAL CREEK') is None
+
+
+def test_offline_geocoder_reports_misses_as_errors(index):
+    geocoder = streets.OfflineGeocoder(index)
+    results = list(geocoder.geocode_all(['INTERNATIONAL BL and FRUITVALE AV, Oakland, CA',
+                                         'MACARTHUR BL and FRUITVALE AV, Oakland, CA',
+                                         'INTERNATIONAL BL and FRUITVALE AV, Oakland, CA']))
+    assert len(results) == 2
+    assert results[0] == ('INTERNATIONAL BL and FRUITVALE AV, Oakland, CA', [37.776, -122.223], None)
+    (address, location, error) = results[1]
+    assert location is None
+    assert type(error) is streets.geocoding.GeocodingError
@@ -0,0 +1,108 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import switrs
+import synthetic
+
+FIELDS = synthetic.COLLISION_FIELDS
+
+
+def collision_row(**values):
+    (row, party_count, victim_count) = synthetic.collision_row(random.Random(0), '1', 2013,
+                                                               synthetic.intersections(1)[0], True)
+    for (name, value) in values.items():
+        row[FIELDS[name]] = value
+    return row
+
+
+def test_malformed_values_are_counted_and_stored_as_null():
+    parser = switrs.RecordParser(switrs.COLLISION_SCHEMA)
+    rows = [collision_row(date='20130231', time='2460'),
+            collision_row(date='2013', day_of_week='8'),
+            collision_row(time='2500')]
+    parsed = list(parser.parse_rows(rows))
+
+    assert parser.errors == {'date': 2, 'time': 1, 'day_of_week': 1}
+    assert [row[FIELDS['date']] for row in parsed] == [None, None, int(rows[2][FIELDS['date']])]
+    assert [row[FIELDS['time']] for row in parsed] == [None, int(rows[1][FIELDS['time']]), 0]
+    assert parsed[1][FIELDS['day_of_week']] is None
+
+    # The timestamp is derived from the parsed date and time, so it is NULL
+    # without them but not counted as another error.
+    timestamp = switrs.field_names(switrs.COLLISION_SCHEMA).index('timestamp')
+    assert [row[timestamp] is None for row in parsed] == [True, True, False]
+
+
+def test_missing_and_extra_fields():
+    parser = switrs.RecordParser(switrs.PARTY_SCHEMA)
+    (short_row, long_row) = parser.parse_rows([['1', '1'], ['1', '2'] + [''] * (len(switrs.PARTY_SCHEMA) + 3)])
+    assert len(short_row) == len(long_row) == len(switrs.PARTY_SCHEMA)
+    assert short_row[:2] == ('1', 1)
+    assert not parser.errors
+
+
+def parsed_collision(collision_id, year, motor_vehicle_with, primary_road='1ST ST', secondary_road='BROADWAY AV'):
+    row = collision_row(id=collision_id, year=str(year), date='{0}0101'.format(year),
+                        motor_vehicle_with=motor_vehicle_with, primary_road=primary_road,
+                        secondary_road=secondary_road)
+    return next(switrs.RecordParser(switrs.COLLISION_SCHEMA).parse_rows([row]))
+
+
+def party(collision_id, number):
+    return (collision_id, number) + (None,) * (len(switrs.Party.fields) - 2)
+
+
+def test_store_indexes_collisions():
+    store = switrs.CollisionStore()
+    store.add_rows([parsed_collision('1', 2012, 'G'), parsed_collision('2', 2013, 'B'),
+                    parsed_collision('3', 2013, 'C', '2ND ST')],
+                   [party('1', 1), party('1', 2), party('3', 1)])
+
+    assert len(store) == 3 and '2' in store and '4' not in store
+    assert [collision.id for collision in store.in_year(2013)] == ['2', '3']
+    assert store.in_year('2013') == []
+    assert [collision.id for collision in store.with_motor_vehicle('G', 'B')] == ['1', '2']
+    assert store.intersections() == ['1ST ST and BROADWAY AV', '2ND ST and BROADWAY AV']
+    assert [collision.id for collision in store.at_intersection('1ST ST and BROADWAY AV')] == ['1', '2']
+    assert [party.number for party in store.get('1').parties] == [1, 2]
+    assert store.parties_for('2') == []
+
+
+def test_store_replaces_and_removes_collisions():
+    store = switrs.CollisionStore()
+    store.add_party(switrs.Party(party('1', 1)))
+    store.add_rows([parsed_collision('1', 2012, 'G'), parsed_collision('2', 2012, 'G')])
+
+    # A later record with the same id replaces the collision in every index, and
+    # keeps the parties added for its id before either of them.
+    store.add_collision(switrs.Collision(parsed_collision('1', 2013, 'B', '2ND ST')))
+    assert [collision.id for collision in store.in_year(2012)] == ['2']
+    assert [collision.id for collision in store.with_motor_vehicle('B')] == ['1']
+    assert len(store.get('1').parties) == 1
+
+    assert store.remove_collision('1').id == '1'
+    assert store.remove_collision('1') is None
+    assert store.in_year(2013) == [] and 2013 not in store.by_year
+    assert store.intersections() == ['1ST ST and BROADWAY AV']
+    assert store.parties_for('1') == []
+    assert [collision.id for collision in store] == ['2']
+
+
+def test_stores_are_independent():
+    (first, second) = (switrs.CollisionStore(), switrs.CollisionStore())
+    first.add_rows([parsed_collision('1', 2012, 'G')])
+    second.add_rows([parsed_collision('1', 2013, 'B')])
+    assert first.get('1').year == 2012 and second.get('1').year == 2013
+    assert second.in_year(2012) == []
@@ -0,0 +1,100 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import itertools
+import math
+import pytest
+import tiles
+
+
+# The latitude of the northern edge of the tiles in row y.
+def row_latitude(y, zoom):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * y / 2 ** zoom))))
+
+
+# The western edge of the tiles in column x.
+def column_longitude(x, zoom):
+    return x * 360.0 / 2 ** zoom - 180.0
+
+
+@pytest.mark.parametrize('latitude, longitude, zoom, tile', [
+    # Leaflet and OpenStreetMap tiles over San Francisco and Oakland.
+    (37.7749, -122.4194, 12, (655, 1583)),
+    (37.8044, -122.2712, 13, (1313, 3165)),
+    (37.8044, -122.2712, 8, (41, 98)),
+    (37.8044, -122.2712, 0, (0, 0)),
+    # The equator and the prime meridian are the northwest corner of a tile.
+    (0.0, 0.0, 1, (1, 1)),
+    (0.0, -0.000001, 1, (0, 1)),
+    (0.000001, 0.0, 1, (1, 0)),
+    # The edges of the map, and the poles beyond Web Mercator's limits.
+    (85.0511, -180.0, 3, (0, 0)),
+    (-85.0511, 179.999999, 3, (7, 7)),
+    (90.0, 180.0, 3, (7, 0)),
+    (-90.0, -180.0, 3, (0, 7)),
+])
+def test_tile_for_location(latitude, longitude, zoom, tile):
+    assert tiles.tile_for_location(latitude, longitude, zoom) == tile
+
+
+def test_tile_boundaries():
+    zoom = tiles.DEFAULT_DETAIL_ZOOM
+    (x, y) = tiles.tile_for_location(37.8044, -122.2712, zoom)
+    west = column_longitude(x, zoom)
+    east = column_longitude(x + 1, zoom)
+    north = row_latitude(y, zoom)
+    south = row_latitude(y + 1, zoom)
+
+    epsilon = 1e-7
+    assert tiles.tile_for_location(north - epsilon, west + epsilon, zoom) == (x, y)
+    assert tiles.tile_for_location(south + epsilon, east - epsilon, zoom) == (x, y)
+    assert tiles.tile_for_location(north + epsilon, west + epsilon, zoom) == (x, y - 1)
+    assert tiles.tile_for_location(north - epsilon, west - epsilon, zoom) == (x - 1, y)
+    assert tiles.tile_for_location(south - epsilon, east + epsilon, zoom) == (x + 1, y + 1)
+
+
+def test_cluster_is_inside_its_tile():
+    for zoom in range(tiles.DEFAULT_MIN_ZOOM, tiles.DEFAULT_DETAIL_ZOOM):
+        tile = tiles.tile_for_location(37.8044, -122.2712, zoom)
+        cluster = tiles.cluster_for_location(37.8044, -122.2712, zoom)
+        assert (cluster[0] >> tiles.CLUSTER_BITS, cluster[1] >> tiles.CLUSTER_BITS) == tile
+
+
+def test_tile_name():
+    assert tiles.tile_name(13, (1313, 3165)) == '13/1313/3165'
+
+
+@pytest.mark.parametrize('tile, order', [
+    ((0, 0), 0),
+    ((1, 0), 1),
+    ((0, 1), 2),
+    ((1, 1), 3),
+    ((2, 0), 4),
+    ((3, 5), 39),
+    ((1313, 3165), int(''.join(y + x for (x, y) in zip('{0:012b}'.format(1313), '{0:012b}'.format(3165))), 2)),
+])
+def test_tile_order(tile, order):
+    assert tiles.tile_order(tile) == order
+
+
+# Sorted by tile_order, the tiles inside each tile at a lower zoom come one after
+# another, which is what lets the export write clustered tiles as it goes.
+def test_tile_order_keeps_tiles_of_lower_zooms_together():
+    zoom = 5
+    ordered = sorted(itertools.product(range(2 ** zoom), repeat=2), key=tiles.tile_order)
+    assert len(set(tiles.tile_order(tile) for tile in ordered)) == len(ordered)
+    for shift in range(1, zoom + 1):
+        parents = [parent for (parent, group) in itertools.groupby((x >> shift, y >> shift) for (x, y) in ordered)]
+        assert len(parents) == len(set(parents)) == 4 ** (zoom - shift)
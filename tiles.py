@@ -0,0 +1,55 @@
+# Copyright 2014 Martin Robinson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Web Mercator z/x/y tiles, numbered the same way as the map tiles that Leaflet
+# shows, so the UI can work out which data tiles cover the viewport.
+
+import math
+
+DEFAULT_MIN_ZOOM = 8
+DEFAULT_DETAIL_ZOOM = 13
+
+# Below the detail zoom, markers are clustered into a grid of 2 ** CLUSTER_BITS
+# by 2 ** CLUSTER_BITS cells per tile, which is 16 pixels on a side.
+CLUSTER_BITS = 4
+
+
+def tile_for_location(latitude, longitude, zoom):
+    scale = 2 ** zoom
+    latitude = math.radians(max(min(latitude, 85.0511), -85.0511))
+    x = int(math.floor((longitude + 180.0) / 360.0 * scale))
+    y = int(math.floor((1.0 - math.log(math.tan(latitude) + 1.0 / math.cos(latitude)) / math.pi) / 2.0 * scale))
+    return (min(max(x, 0), scale - 1), min(max(y, 0), scale - 1))
+
+
+# A cluster is a tile a few zoom levels further in, so clusters never straddle
+# the tiles at the given zoom.
+def cluster_for_location(latitude, longitude, zoom):
+    return tile_for_location(latitude, longitude, zoom + CLUSTER_BITS)
+
+
+def tile_name(zoom, tile):
+    return '{0}/{1}/{2}'.format(zoom, tile[0], tile[1])
+
+
+# Interleaves the bits of x and y, so that sorting tiles by this puts the tiles
+# inside any tile at a lower zoom one after another.
+def tile_order(tile):
+    (x, y) = tile
+    order = 0
+    bit = 0
+    while x >> bit or y >> bit:
+        order |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+        bit += 1
+    return order
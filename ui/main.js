@@ -16,16 +16,19 @@
 
 var INITIAL_MAP_CENTER = [37.8044, -122.2708];
 var INITIAL_MAP_ZOOM = 13;
-var DATE_FORMAT = d3.time.format('%b %e, %Y');
-var TIME_FORMAT = d3.time.format('%_I:%M%p');
+// Collision times are exported as if the local time of the report were UTC, so
+// they must be formatted in UTC to show the time that was reported.
+var DATE_FORMAT = d3.time.format.utc('%b %e, %Y');
+var TIME_FORMAT = d3.time.format.utc('%_I:%M%p');
 
 var HALF_STAT_WIDTH = 140; // This is a bit of a hack to avoid a lot of calls to offsetWidth;
 var STAT_WIDTH = 275;
 
+// The years are those of the exported data. See setYears.
 var YEARS = {
-    values: [2008, 2009, 2010, 2011, 2012, 2013],
-    names: ['2008', '2009', '2010', '2011', '2012', '2013'],
-    counts: [0, 0, 0, 0, 0, 0],
+    values: [],
+    names: [],
+    counts: [],
     filtered: d3.set(),
     chart_id: 'year_chart',
     chart_width: HALF_STAT_WIDTH,
@@ -76,28 +79,55 @@ var TIMES_OF_DAY = {
 
 var ALL_CATEGORIES = [YEARS, SEXES, COLLISION_TYPES, AGE_GROUPS, INJURIES, TIMES_OF_DAY];
 
+// The tiles section of the shown jurisdiction's manifest. See write_tiles in
+// json-for-collisions.py. Tile names include a hash of their contents, which
+// available and collisions map each tile to.
+var TILES = null;
+
+// The jurisdictions listed in the top-level manifest.json. See export_cities in
+// json-for-collisions.py.
+var JURISDICTIONS = [];
+
+// The exporter lists every year from the first to the last, so a year's index
+// is its distance from the first.
+function setYears(years) {
+    YEARS.values = years;
+    YEARS.names = years.map(String);
+    YEARS.counts = years.map(function() { return 0; });
+}
+
 function updateAfterFilterChange() {
-    Marker.updateFilteredCollisions();
+    Marker.updateFilteredCounts();
     map.addCollisionsToMap();
     statisticsDisplay.update();
 }
 
-function Marker(jsonMarker) {
+// A marker is either a single location on a detail tile or, below the detail
+// zoom, a cluster of nearby locations.
+function Marker(latitude, longitude, tile) {
     var self = this;
-    this.latitude = jsonMarker[0];
-    this.longitude = jsonMarker[1];
+    this.latitude = latitude;
+    this.longitude = longitude;
+    this.tile = tile;
     this.collisions = [];
-    this.filteredCollisions = [];
+    this.filteredCount = 0;
+    this.filteredInjury = 4;
     this.mapOverlay = null;
 
     this.mostSevereInjury = function() {
-        return d3.min(self.filteredCollisions.map(function(collision) {
-             return collision.mostSevereInjury();
-        }));
+        return self.filteredInjury;
+    }
+
+    this.getFilteredCollisions = function() {
+        return self.collisions.filter(function(collision) {
+            return collision.isUnfiltered();
+        });
     }
 
     this.getOverlayRadius = function() {
-        return self.filteredCollisions.length == 1 ? 40 : 60;
+        if (!self.tile.isDetail)
+            return Math.min(6 + 2 * Math.sqrt(self.filteredCount), 30);
+        return self.filteredCount == 1 ? 40 : 60;
     }
 
     this.getOverlayStyle = function() {
@@ -111,11 +141,27 @@ function Marker(jsonMarker) {
     }
 
     this.addToMap = function(map) {
-        self.mapOverlay = L.circle([self.latitude, self.longitude], self.getOverlayRadius(), self.getOverlayStyle()).on('click', function(e) {
-            map.collisionPopup.open(self, map.map);
-        });
+        // Detail markers have a radius in meters, while clusters keep the same
+        // size in pixels at any zoom and zoom in when clicked.
+        if (self.tile.isDetail) {
+            self.mapOverlay = L.circle([self.latitude, self.longitude], self.getOverlayRadius(), self.getOverlayStyle()).on('click', function(e) {
+                map.collisionPopup.open(self, map);
+            });
+        } else {
+            self.mapOverlay = L.circleMarker([self.latitude, self.longitude], self.getOverlayStyle()).on('click', function(e) {
+                map.map.setView([self.latitude, self.longitude], Math.min(self.tile.zoom + 2, TILES.detail_zoom));
+            });
+            self.mapOverlay.setRadius(self.getOverlayRadius());
+        }
         self.mapOverlay.addTo(map.map);
-        self.mapOverlay._container.style.display = self.filteredCollisions.length > 0 ? "" : "none";
+        self.mapOverlay._container.style.display = self.filteredCount > 0 ? "" : "none";
+    }
+
+    this.removeFromMap = function(map) {
+        if (self.mapOverlay === null)
+            return;
+        map.map.removeLayer(self.mapOverlay);
+        self.mapOverlay = null;
     }
 
     this.addOrUpdateMapOverlay = function(map) {
@@ -128,82 +174,148 @@ function Marker(jsonMarker) {
         self.mapOverlay.setStyle(self.getOverlayStyle());
 
         // TODO: Would be good to do this without undocumented API.
-        self.mapOverlay._container.style.display = self.filteredCollisions.length > 0 ? "" : "none";
+        self.mapOverlay._container.style.display = self.filteredCount > 0 ? "" : "none";
     }
 }
 
-Marker.updateFilteredCollisions = function() {
+// Computes the chart counts and the marker sizes and colors of the tiles on the
+// map by summing the cells of their filter cubes instead of visiting every
+// collision. See build_filter_cube in json-for-collisions.py for the layout.
+Marker.updateFilteredCounts = function() {
     ALL_CATEGORIES.forEach(function(category) {
         for (var i = 0; i < category.counts.length; i++)
             category.counts[i] = 0;
     });
 
-    Marker.markers.forEach(function(marker) {
-        marker.filteredCollisions = []
-        marker.collisions.forEach(function(collision) {
-            var yearIndex = collision.year - YEARS.values[0];
+    map.visibleTiles.forEach(function(tile) {
+        tile.updateFilteredCounts();
+    });
+}
+
+// The markers and filter cube of one z/x/y tile. See Tile in
+// json-for-collisions.py.
+function Tile(zoom, x, y, data) {
+    var self = this;
+    this.zoom = zoom;
+    this.x = x;
+    this.y = y;
+    this.isDetail = zoom == TILES.detail_zoom;
+    this.cells = data.columns;
+    this.collisionsRequested = false;
+
+    this.markers = [];
+    for (var i = 0; i < data.columns.latitude.length; i++) {
+        this.markers.push(new Marker(data.columns.latitude[i], data.columns.longitude[i], this));
+    }
+
+    this.url = function(template, hash) {
+        return template.replace('{z}', self.zoom).replace('{x}', self.x).replace('{y}', self.y).replace('{hash}', hash);
+    }
+
+    this.loadCollisions = function(callback) {
+        if (self.collisionsRequested)
+            return;
+        self.collisionsRequested = true;
+        loadColumns(self.url(TILES.collisions_url, TILES.collisions[self.x + '/' + self.y]), function(data) {
+            Collision.addFromColumns(data, self);
+            callback();
+        });
+    }
+
+    this.updateFilteredCounts = function() {
+        self.markers.forEach(function(marker) {
+            marker.filteredCount = 0;
+            marker.filteredInjury = 4;
+        });
+
+        var columns = self.cells;
+        for (var cell = 0; cell < columns.count.length; cell++) {
+            var yearIndex = columns.year[cell] - YEARS.values[0];
             if (YEARS.filtered.has(yearIndex))
-                return;
-            if (COLLISION_TYPES.filtered.has(collision.type))
-                return;
-            if (TIMES_OF_DAY.filtered.has(collision.getTimeOfDay()))
-                return;
+                continue;
+            var type = columns.type[cell];
+            if (COLLISION_TYPES.filtered.has(type))
+                continue;
+            var timeOfDay = columns.time_of_day[cell];
+            if (TIMES_OF_DAY.filtered.has(timeOfDay))
+                continue;
 
-            var allVictimsFiltered = collision.victims.length > 0;
-            collision.getUnfilteredVictims().forEach(function(victim) {
-                SEXES.counts[victim.sex]++;
-                AGE_GROUPS.counts[victim.ageGroup]++;
-                INJURIES.counts[victim.injury]++;
-                allVictimsFiltered = false;
-            });
+            var victimsStart = columns.victim_offsets[cell];
+            var victimsEnd = columns.victim_offsets[cell + 1];
 
             // 4 is "Other." If there are no victims, that's similar to a catchall
             // category of injury. This special case ensures that when "other" is filtered
             // out, we skip these collisions missing victims.
-            if (collision.victims.length == 0 && INJURIES.filtered.has(4))
-                return;
+            if (victimsStart == victimsEnd && INJURIES.filtered.has(4))
+                continue;
+
+            var count = columns.count[cell];
+            var mostSevereInjury = 4;
+            var allVictimsFiltered = victimsStart < victimsEnd;
+            for (var v = victimsStart; v < victimsEnd; v++) {
+                var sex = columns.victim_sex[v];
+                var ageGroup = columns.victim_age_group[v];
+                var injury = columns.victim_injury[v];
+                if (SEXES.filtered.has(sex) || AGE_GROUPS.filtered.has(ageGroup) || INJURIES.filtered.has(injury))
+                    continue;
+
+                SEXES.counts[sex] += count;
+                AGE_GROUPS.counts[ageGroup] += count;
+                INJURIES.counts[injury] += count;
+                mostSevereInjury = Math.min(mostSevereInjury, injury);
+                allVictimsFiltered = false;
+            }
 
             if (allVictimsFiltered)
-                return;
+                continue;
 
-            COLLISION_TYPES.counts[collision.type]++;
-            YEARS.counts[yearIndex]++;
-            TIMES_OF_DAY.counts[collision.getTimeOfDay()]++;
-            marker.filteredCollisions.push(collision);
-        });
-    });
-}
+            COLLISION_TYPES.counts[type] += count;
+            YEARS.counts[yearIndex] += count;
+            TIMES_OF_DAY.counts[timeOfDay] += count;
 
-Marker.addFromJSON = function(data) {
-    if (Marker.markers === undefined) {
-        Marker.markers = [];
+            var marker = self.markers[columns.marker[cell]];
+            marker.filteredCount += count;
+            marker.filteredInjury = Math.min(marker.filteredInjury, mostSevereInjury);
+        }
     }
+}
 
-    for (var i = 0; i < data.length; i++) {
-        Marker.markers.push(new Marker(data[i]));
-    }
+// The same tile numbering as the map tiles. See tiles.py.
+Tile.forLocation = function(latitude, longitude, zoom) {
+    var scale = Math.pow(2, zoom);
+    var latitudeRadians = Math.max(Math.min(latitude, 85.0511), -85.0511) * Math.PI / 180;
+    var x = Math.floor((longitude + 180) / 360 * scale);
+    var y = Math.floor((1 - Math.log(Math.tan(latitudeRadians) + 1 / Math.cos(latitudeRadians)) / Math.PI) / 2 * scale);
+    return [Math.min(Math.max(x, 0), scale - 1), Math.min(Math.max(y, 0), scale - 1)];
 }
 
-function Collision(jsonCollision) {
+// Creates the collision at the given index of a detail tile's collisions file.
+// See encode_collision_columns in json-for-collisions.py for the layout.
+function Collision(data, index, tile) {
     var self = this;
-    this.intersection = jsonCollision.intersection;
-    this.date = new Date(jsonCollision.time * 1000);
-    this.year = this.date.getFullYear();
-    this.sex = jsonCollision.sex;
-    this.type = jsonCollision.type;
-    this.marker = Marker.markers[jsonCollision.marker];
+    var columns = data.columns;
+    this.intersection = data.intersections[columns.intersection[index]];
+    this.date = new Date(columns.time[index] * 1000);
+    this.year = this.date.getUTCFullYear();
+    this.type = columns.type[index];
+    this.marker = tile.markers[columns.marker[index]];
     this.marker.collisions.push(this);
 
     this.victims = [];
-    for (var v = 0; v < jsonCollision.victims.length; v++) {
-        this.victims.push(new Victim(jsonCollision.victims[v]));
+    for (var v = columns.victim_offsets[index]; v < columns.victim_offsets[index + 1]; v++) {
+        this.victims.push(new Victim(columns.victim_age[v], columns.victim_sex[v], columns.victim_injury[v]));
     }
 
-    this.mostSevereInjury = function() {
-        var unfilteredVictims = self.getUnfilteredVictims();
-        if (unfilteredVictims.length == 0)
-            return 4;
-        return d3.min(unfilteredVictims.map(function(v) { return v.injury; }));
+    this.isUnfiltered = function() {
+        if (YEARS.filtered.has(self.year - YEARS.values[0]))
+            return false;
+        if (COLLISION_TYPES.filtered.has(self.type))
+            return false;
+        if (TIMES_OF_DAY.filtered.has(self.getTimeOfDay()))
+            return false;
+        if (self.victims.length == 0)
+            return !INJURIES.filtered.has(4);
+        return self.getUnfilteredVictims().length > 0;
     }
 
     this.getUnfilteredVictims = function() {
@@ -221,7 +333,7 @@ function Collision(jsonCollision) {
     }
 
     this.getTimeOfDay = function() {
-        var hours = self.date.getHours();
+        var hours = self.date.getUTCHours();
         if (hours <= 5)
             return 3;
         if (hours <= 11)
@@ -236,22 +348,14 @@ function Collision(jsonCollision) {
     this.getTimeString = function() { return TIME_FORMAT(self.date).toLowerCase(); }
 }
 
-Collision.addFromJSON = function(data) {
-    if (Collision.collisions === undefined) {
-        Collision.collisions = [];
-    }
-
-    for (var i = 0; i < data.length; i++) {
-        Collision.collisions.push(new Collision(data[i]));
+Collision.addFromColumns = function(data, tile) {
+    var count = data.columns.type.length;
+    for (var i = 0; i < count; i++) {
+        new Collision(data, i, tile);
     }
-
-    // TODO: Eventually we should only filter and add the new collisions for performance reasons.
-    Marker.updateFilteredCollisions();
-    map.addCollisionsToMap();
-    statisticsDisplay.update();
 }
 
-function Victim(victimJSON) {
+function Victim(age, sex, injury) {
     var self = this;
 
     this.sexString = function() {
@@ -277,9 +381,9 @@ function Victim(victimJSON) {
     this.isFatality = function () { return self.injury == 0; }
     this.isSevereInjury = function () { return self.injury == 1; }
 
-    this.injury = victimJSON.injury;
-    this.age = victimJSON.age;
-    this.sex = victimJSON.sex;
+    this.injury = injury;
+    this.age = age;
+    this.sex = sex;
     this.ageGroup = this.calculateAgeGroup();
 
     // The SWITRS injury data is a bit strange, because the least severe injury
@@ -303,7 +407,10 @@ function CollisionPopup(map) {
             .on('popupclose', function() {
                 self.popup = null;
                 self.marker = null;
-            }).openOn(map);
+            }).openOn(map.map);
+
+        // Collision details are only downloaded for tiles whose popups are opened.
+        marker.tile.loadCollisions(self.updatePopupContents);
     }
 
     this.updatePopupContents = function() {
@@ -311,16 +418,16 @@ function CollisionPopup(map) {
             return;
 
         // FIXME: Use documented API when it exists.
-        if (self.marker.filteredCollisions.length == 0)
+        if (self.marker.filteredCount == 0 || self.marker.mapOverlay === null)
             self.popup._close();
 
         self.popup.setContent(self.getPopupContents());
     }
 
     this.getPopupContents = function() {
-        var collisions = self.marker.filteredCollisions;
+        var collisions = self.marker.getFilteredCollisions();
         if (collisions.length == 0)
-            return;
+            return '<div class="collision_detail_popup">Loading...</div>';
 
         collisions.sort(function(a, b) {
             if (a.date > b.date)
@@ -378,17 +485,36 @@ function Map(mapElementID, collisionPopup) {
     if (L.StamenTileLayer !== undefined)
         this.map.addLayer(new L.StamenTileLayer('toner'));
 
+    this.tiles = {};
+    this.visibleTiles = [];
+
+    // Replaces the tiles of the map with those of another jurisdiction. The new
+    // tiles are fetched on the next call to updateVisibleTiles.
+    this.setTiles = function(tiles) {
+        self.map.closePopup();
+        self.visibleTiles.forEach(function(tile) {
+            tile.markers.forEach(function(marker) {
+                marker.removeFromMap(self);
+            });
+        });
+        self.visibleTiles = [];
+        self.tiles = {};
+        TILES = tiles;
+    }
+
     this.addCollisionsToMap = function(c) {
         self.collisionPopup.updatePopupContents();
 
         // Smaller markers last ensure that they can be seen and clicked when markers overlap. We don't
-        // want to sort the static array, since Collision JSON refers to array by index and we may add
-        // more collisions in the future.
-        var markers = Marker.markers.slice(0);
+        // want to sort the tiles' arrays, since cells and collisions refer to markers by index.
+        var markers = [];
+        self.visibleTiles.forEach(function(tile) {
+            markers = markers.concat(tile.markers);
+        });
         markers.sort(function(a, b) {
-            if (a.filteredCollisions.length < b.filteredCollisions.length)
+            if (a.filteredCount < b.filteredCount)
               return 1;
-            if (a.filteredCollisions.length > b.filteredCollisions.length)
+            if (a.filteredCount > b.filteredCount)
               return -1;
             return 0;
         });
@@ -397,6 +523,58 @@ function Map(mapElementID, collisionPopup) {
             markers[i].addOrUpdateMapOverlay(self);
         }
     }
+
+    // Finds the tiles that cover the map at the current zoom level, fetching
+    // the ones that have not been loaded yet. Tiles that scroll out of view keep
+    // their data, but their markers are removed from the map.
+    this.updateVisibleTiles = function() {
+        if (TILES === null)
+            return;
+        var zoom = Math.max(Math.min(self.map.getZoom(), TILES.detail_zoom), TILES.min_zoom);
+        var available = TILES.available[zoom];
+        var bounds = self.map.getBounds();
+        var northWest = Tile.forLocation(bounds.getNorth(), bounds.getWest(), zoom);
+        var southEast = Tile.forLocation(bounds.getSouth(), bounds.getEast(), zoom);
+
+        var visibleTiles = [];
+        for (var x = northWest[0]; x <= southEast[0]; x++) {
+            for (var y = northWest[1]; y <= southEast[1]; y++) {
+                var name = zoom + '/' + x + '/' + y;
+                if (!available.hasOwnProperty(x + '/' + y))
+                    continue;
+                if (self.tiles[name] === undefined) {
+                    self.loadTile(zoom, x, y, available[x + '/' + y]);
+                    continue;
+                }
+                if (self.tiles[name] !== null)
+                    visibleTiles.push(self.tiles[name]);
+            }
+        }
+
+        self.visibleTiles.forEach(function(tile) {
+            if (visibleTiles.indexOf(tile) >= 0)
+                return;
+            tile.markers.forEach(function(marker) {
+                marker.removeFromMap(self);
+            });
+        });
+        self.visibleTiles = visibleTiles;
+        updateAfterFilterChange();
+    }
+
+    this.loadTile = function(zoom, x, y, hash) {
+        var name = zoom + '/' + x + '/' + y;
+        var tiles = self.tiles;
+        tiles[name] = null;
+        var url = TILES.url.replace('{z}', zoom).replace('{x}', x).replace('{y}', y).replace('{hash}', hash);
+        loadColumns(url, function(data) {
+            // Ignore tiles of a jurisdiction that is no longer shown.
+            if (tiles !== self.tiles)
+                return;
+            self.tiles[name] = new Tile(zoom, x, y, data);
+            self.updateVisibleTiles();
+        });
+    }
 }
 
 function StatisticsDisplay(map) {
@@ -505,18 +683,88 @@ function StatisticsDisplay(map) {
     });
 }
 
+// Reads a file written by columnar.py. Every column becomes a typed array view
+// into the downloaded buffer, so no data is copied.
+function readColumns(buffer) {
+    var headerLength = new DataView(buffer).getUint32(0, true);
+    var header = JSON.parse(new TextDecoder('utf-8').decode(new Uint8Array(buffer, 4, headerLength)));
+
+    var columns = {};
+    for (var name in header.columns) {
+        var column = header.columns[name];
+        columns[name] = new window[column.type + 'Array'](buffer, column.offset, column.length);
+    }
+    header.columns = columns;
+    return header;
+}
+
+function loadColumns(url, callback) {
+    d3.xhr(url).responseType('arraybuffer').get(function(error, request) {
+        if (error)
+            return;
+        callback(readColumns(request.response));
+    });
+}
+
+// Shows a jurisdiction from the top-level manifest, which names its own
+// manifest. Tile URLs in that manifest are relative to its directory.
+function showJurisdiction(jurisdiction) {
+    document.getElementById('jurisdiction').value = jurisdiction.code;
+    document.title = 'Pedestrian and Bicycle Collisions in ' + jurisdiction.name + ', CA';
+    window.location.hash = jurisdiction.code;
+
+    d3.json(jurisdiction.path + jurisdiction.manifest, function(manifest) {
+        var tiles = manifest.tiles;
+        tiles.url = jurisdiction.path + tiles.url;
+        tiles.collisions_url = jurisdiction.path + tiles.collisions_url;
+        map.setTiles(tiles);
+        if (jurisdiction.center !== undefined)
+            map.map.setView(jurisdiction.center, INITIAL_MAP_ZOOM);
+        map.updateVisibleTiles();
+    });
+}
+
+function jurisdictionChanged(code) {
+    JURISDICTIONS.forEach(function(jurisdiction) {
+        if (jurisdiction.code == code)
+            showJurisdiction(jurisdiction);
+    });
+}
+
+// Fills the jurisdiction picker and shows the jurisdiction named in the URL,
+// or otherwise the one with the most collisions.
+function createJurisdictionPicker() {
+    var byName = JURISDICTIONS.slice().sort(function(a, b) {
+        return a.name.localeCompare(b.name);
+    });
+    d3.select('#jurisdiction')
+        .selectAll('option')
+        .data(byName)
+            .enter().append('option')
+                .attr('value', function(jurisdiction) { return jurisdiction.code; })
+                .text(function(jurisdiction) { return jurisdiction.name; });
+
+    var initial = null;
+    JURISDICTIONS.forEach(function(jurisdiction) {
+        if (initial === null || jurisdiction.collisions > initial.collisions)
+            initial = jurisdiction;
+    });
+    JURISDICTIONS.forEach(function(jurisdiction) {
+        if (jurisdiction.code == window.location.hash.substring(1))
+            initial = jurisdiction;
+    });
+    if (initial !== null)
+        showJurisdiction(initial);
+}
+
 function bodyLoaded() {
     window.map = new Map('map', new CollisionPopup());
-    window.statisticsDisplay = new StatisticsDisplay(map);
-    ['oakland-2008.json',
-     'oakland-2009.json',
-     'oakland-2010.json',
-     'oakland-2011.json',
-     'oakland-2012.json',
-     'oakland-2013.json'].forEach(function(url) {
-        d3.json(url, function(data) {
-            Collision.addFromJSON(data);
-        });
+    d3.json('manifest.json', function(manifest) {
+        setYears(manifest.years);
+        window.statisticsDisplay = new StatisticsDisplay(map);
+        JURISDICTIONS = manifest.jurisdictions;
+        map.map.on('moveend', map.updateVisibleTiles);
+        createJurisdictionPicker();
     });
 }
 